@@ -0,0 +1,176 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Broker broadcast benchmark.
+
+Measure the CPU cost of broadcasting one node update against the number of
+connected clients, comparing the legacy per-client `write_message` path with
+the encode-once fan-out of `Broker.broadcast`.
+
+Usage:
+    PYTHONPATH=. python3 benchmarks/bench_broadcast.py --clients 10,100,1000
+"""
+
+import argparse
+import json
+import time
+from types import SimpleNamespace
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.websocket import WebSocketProtocol13
+
+from pyaiot.broker.broker import Broker
+from pyaiot.broker.outbound import OutboundQueue
+from pyaiot.common.auth import Keys
+from pyaiot.common.messaging import Message
+
+
+class NullStream():
+    """Stream discarding everything written to it."""
+
+    def __init__(self, done):
+        self.done = done
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        return self.done
+
+    def closed(self):
+        return False
+
+
+def connection(stream):
+    """Return a real server side websocket protocol writing to stream."""
+    protocol = WebSocketProtocol13.__new__(WebSocketProtocol13)
+    protocol.stream = stream
+    protocol.mask_outgoing = False
+    protocol._compressor = None
+    protocol._message_bytes_out = 0
+    protocol._wire_bytes_out = 0
+    protocol.client_terminated = False
+    protocol.server_terminated = False
+    return protocol
+
+
+class Client():
+    """Client handler writing through tornado websocket protocol."""
+
+    def __init__(self, uid, done):
+        self.uid = uid
+        self.ws_connection = connection(NullStream(done))
+        self.queue = OutboundQueue(self)
+
+    def write_message(self, message, binary=False):
+        return self.ws_connection.write_message(message, binary=binary)
+
+
+def legacy_broadcast(broker, message):
+    """Broadcast as done before: one write_message per client."""
+    for uid in broker.clients.keys():
+        broker.clients[uid].write_message(message)
+
+
+def measure(func, broker, message, updates):
+    """Return the process CPU time spent per update, in microseconds."""
+    start = time.process_time()
+    for _ in range(updates):
+        func(broker, message)
+    return (time.process_time() - start) * 1e6 / updates
+
+
+def run(clients, updates, payload_size):
+    done = Future()
+    done.set_result(None)
+    broker = Broker(Keys(private='', secret=''),
+                    options=SimpleNamespace(debug=False, broker_port=0,
+                                            client_queue_size=1000,
+                                            client_queue_policy='drop-oldest',
+                                            client_replay_size=1000,
+                                            client_session_timeout=60,
+                                            batch_messages=False,
+                                            broker_id='bench',
+                                            broker_peers=[],
+                                            peer_timeout=30,
+                                            peer_replay_size=1000,
+                                            auth_timeout=2,
+                                            auth_token_ttl=60,
+                                            auth_max_pending=1000,
+                                            latency_trace_file=None,
+                                            latency_trace_sample=100,
+                                            history_depth=100,
+                                            telemetry_log_dir=None))
+    message = Message.update_node('bench-node', 'temperature',
+                                  'x' * payload_size)
+    results = []
+    for count in clients:
+        broker.clients = {str(uid): Client(str(uid), done)
+                          for uid in range(count)}
+        legacy = measure(legacy_broadcast, broker, message, updates)
+        fanout = measure(Broker.broadcast, broker, message, updates)
+        results.append({'clients': count,
+                        'legacy_us_per_update': round(legacy, 1),
+                        'encode_once_us_per_update': round(fanout, 1),
+                        'speedup': round(legacy / fanout, 2)})
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', default='10,100,1000,5000',
+                        help="Comma separated list of client counts")
+    parser.add_argument('--updates', type=int, default=200,
+                        help="Number of broadcast updates per measure")
+    parser.add_argument('--payload-size', type=int, default=16,
+                        help="Size of the update payload")
+    parser.add_argument('--json', action='store_true',
+                        help="Output results as JSON")
+    args = parser.parse_args()
+    clients = [int(count) for count in args.clients.split(',')]
+
+    results = IOLoop.current().run_sync(
+        lambda: _async_run(clients, args.updates, args.payload_size))
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("{:>8} {:>16} {:>16} {:>8}".format(
+        "clients", "legacy (us)", "encode-once (us)", "speedup"))
+    for result in results:
+        print("{clients:>8} {legacy_us_per_update:>16} "
+              "{encode_once_us_per_update:>16} {speedup:>8}"
+              .format(**result))
+
+
+async def _async_run(clients, updates, payload_size):
+    return run(clients, updates, payload_size)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Websocket compression benchmark.
+
+Measure the bandwidth saved by permessage-deflate against the CPU spent to
+compress the messages sent by the broker to a client, for several
+compression levels, window sizes and size thresholds. Messages are
+compressed with the tornado compressor of a single connection, like on a
+real connection: the compressor keeps its context between messages.
+
+Usage:
+    PYTHONPATH=. python3 benchmarks/bench_compression.py --levels 1,6,9
+"""
+
+import argparse
+import json
+import random
+import time
+
+from tornado.websocket import _PerMessageDeflateCompressor
+
+from pyaiot.common.messaging import Message
+
+
+def updates(count, payload_size):
+    """Return node update messages like the ones sent by gateways."""
+    rand = random.Random(0)
+    return [Message.update_node('node-{}'.format(rand.randrange(50)),
+                                rand.choice(['temperature', 'pressure',
+                                             'led', 'name']),
+                                '{:.{}f}'.format(rand.uniform(0, 100),
+                                                 payload_size))
+            for _ in range(count)]
+
+
+def snapshots(count, nodes):
+    """Return snapshot messages of several nodes."""
+    rand = random.Random(0)
+    return [Message.snapshot({
+        'node-{}'.format(uid): {'temperature': rand.uniform(0, 40),
+                                'name': 'Node {}'.format(uid),
+                                'board': 'iotlab-m3', 'led': '0'}
+        for uid in range(nodes)})
+        for _ in range(count)]
+
+
+def measure(messages, level, window_bits, threshold):
+    """Return the wire size and the CPU time of sending messages."""
+    compressor = _PerMessageDeflateCompressor(
+        persistent=True, max_wbits=window_bits,
+        compression_options={'compression_level': level})
+    data = [message.encode('utf-8') for message in messages]
+    raw = sum(len(message) for message in data)
+    wire = 0
+    start = time.process_time()
+    for message in data:
+        if len(message) < threshold:
+            wire += len(message)
+        else:
+            wire += len(compressor.compress(message))
+    cpu = time.process_time() - start
+    return {'raw_bytes': raw,
+            'wire_bytes': wire,
+            'saved_percent': round(100 * (raw - wire) / raw, 1),
+            'cpu_us_per_message': round(cpu * 1e6 / len(data), 2)}
+
+
+def run(args):
+    workloads = {
+        'update': updates(args.messages, 2),
+        'snapshot': snapshots(max(1, args.messages // 100), args.nodes)}
+    results = []
+    for name, messages in workloads.items():
+        for threshold in args.thresholds:
+            for level in args.levels:
+                for window_bits in args.window_bits:
+                    result = {'workload': name, 'threshold': threshold,
+                              'level': level, 'window_bits': window_bits}
+                    result.update(measure(messages, level, window_bits,
+                                          threshold))
+                    results.append(result)
+    return results
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--messages', type=int, default=10000,
+                        help="Number of update messages")
+    parser.add_argument('--nodes', type=int, default=200,
+                        help="Number of nodes in snapshot messages")
+    parser.add_argument('--levels', type=int_list, default=[1, 6, 9],
+                        help="Compression levels")
+    parser.add_argument('--window-bits', type=int_list, default=[9, 12, 15],
+                        help="Compression window sizes")
+    parser.add_argument('--thresholds', type=int_list, default=[0, 64, 256],
+                        help="Minimum size of compressed messages")
+    parser.add_argument('--json', action='store_true',
+                        help="Output results as JSON")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    print("{:>9} {:>9} {:>5} {:>5} {:>12} {:>12} {:>8} {:>10}".format(
+        "workload", "threshold", "level", "wbits", "raw (B)", "wire (B)",
+        "saved %", "cpu (us)"))
+    for result in results:
+        print("{workload:>9} {threshold:>9} {level:>5} {window_bits:>5} "
+              "{raw_bytes:>12} {wire_bytes:>12} {saved_percent:>8} "
+              "{cpu_us_per_message:>10}".format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,353 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Broker load benchmark.
+
+Run brokers in child processes and load them with N authenticated gateways
+sending node updates at a fixed rate and M websocket clients. The updates
+carry their send time, like with latency tracing: the clients measure the
+delivery latency of each update.
+
+The report gives the update and delivery throughputs, the p50/p99 delivery
+latencies, the CPU used by the brokers and their resident memory, read
+from /proc (Linux only). The gateways and clients run in this process: when
+the load generator CPU gets close to 100%, the results are limited by the
+generator, not by the broker.
+
+Usage:
+    PYTHONPATH=. python3 benchmarks/bench_load.py --gateways 10 \\
+        --rate 100 --clients 50 --json --output results.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from types import SimpleNamespace
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.httpserver import HTTPServer
+from tornado.testing import bind_unused_port
+from tornado.websocket import websocket_connect
+
+from pyaiot.broker.broker import Broker
+from pyaiot.broker.bus import UnixSocketBus
+from pyaiot.common.auth import (Keys, auth_token, generate_private_key,
+                                generate_secret_key)
+from pyaiot.common.messaging import Message, NewMessage, UpdateMessage, codec
+
+# Number of latencies kept to compute the percentiles
+LATENCY_SAMPLES = 100000
+
+# Delay between two sends of a gateway, in seconds
+TICK = 0.01
+
+
+def broker_options(args, port):
+    """Return the options of the benchmarked brokers."""
+    return SimpleNamespace(
+        debug=False, broker_port=port, client_queue_size=1000,
+        client_queue_policy='drop-oldest', client_replay_size=1000,
+        client_session_timeout=60, batch_messages=args.batch,
+        batch_delay=5, batch_max_size=65536, broker_id='bench',
+        broker_peers=[], peer_timeout=30, peer_replay_size=1000,
+        auth_timeout=5, auth_token_ttl=60, auth_max_pending=10000,
+        compression=args.compression, compression_level=6,
+        compression_threshold=64, compression_window_bits=15,
+        latency_trace_file=None, latency_trace_sample=100,
+        history_depth=args.history_depth,
+        telemetry_log_dir=args.telemetry_log_dir,
+        telemetry_log_segment_size=16, telemetry_log_retention_size=1024,
+        telemetry_log_retention_age=3600, telemetry_log_sync_delay=1000)
+
+
+def run_broker(keys, options, sockets, bus_path, worker_id, workers):
+    """Run a broker worker, in a child process."""
+    if sockets is None:
+        sockets = bind_sockets(options.broker_port, address='127.0.0.1',
+                               reuse_port=True)
+    bus = None
+    if workers > 1:
+        bus = UnixSocketBus(bus_path, worker_id, workers)
+    server = HTTPServer(Broker(keys, options=options, bus=bus))
+    server.add_sockets(sockets)
+    IOLoop.current().start()
+
+
+def start_brokers(args, keys):
+    """Start the broker processes, return the processes and the port."""
+    if args.broker_workers > 1:
+        sock, port = bind_unused_port()
+        sock.close()
+        sockets = None
+    else:
+        sock, port = bind_unused_port()
+        sockets = [sock]
+    bus_path = tempfile.mkdtemp(prefix='pyaiot-bench-')
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(
+        target=run_broker, daemon=True,
+        args=(keys, broker_options(args, port), sockets, bus_path,
+              worker_id, args.broker_workers))
+        for worker_id in range(args.broker_workers)]
+    for process in processes:
+        process.start()
+    if sockets is not None:
+        sock.close()
+    return processes, port, bus_path
+
+
+def process_usage(pid):
+    """Return the CPU time in seconds and the RSS in bytes of a process."""
+    with open('/proc/{}/stat'.format(pid)) as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    rss = int(fields[21]) * os.sysconf('SC_PAGE_SIZE')
+    return cpu, rss
+
+
+def percentile(values, rank):
+    """Return the value of a sorted list at a percentile rank."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * rank / 100))]
+
+
+class Stats():
+    """Counters of the load generator."""
+
+    def __init__(self):
+        self.measuring = False
+        self.sent = 0
+        self.delivered = 0
+        self.seen = 0
+        self.latencies = []
+        self._random = random.Random(0)
+
+    def on_delivery(self, latency):
+        if not self.measuring:
+            return
+        self.delivered += 1
+        # Reservoir sampling of the latencies
+        if len(self.latencies) < LATENCY_SAMPLES:
+            self.latencies.append(latency)
+        else:
+            index = self._random.randrange(self.delivered)
+            if index < LATENCY_SAMPLES:
+                self.latencies[index] = latency
+
+
+@gen.coroutine
+def connect(url):
+    """Connect a websocket, retrying while the broker is starting."""
+    for _ in range(100):
+        try:
+            return (yield websocket_connect(url))
+        except (ConnectionRefusedError, OSError):
+            yield gen.sleep(0.05)
+    raise RuntimeError("Cannot connect to {}".format(url))
+
+
+@gen.coroutine
+def run_client(url, stats, ready):
+    """Connect a client and record the delivery latency of the updates."""
+    ws = yield connect(url)
+    ws.write_message(Message.serialize({'type': 'new', 'data': 'client'}))
+    ready.append(ws)
+    while True:
+        raw = yield ws.read_message()
+        if raw is None:
+            return
+        received = time.time()
+        message = codec.loads(raw)
+        messages = (message['messages'] if message['type'] == 'batch'
+                    else [message])
+        for message in messages:
+            if message['type'] == 'update' and 'ts' in message:
+                stats.on_delivery(received - message['ts'])
+
+
+@gen.coroutine
+def run_gateway(url, keys, index, args, stats, ready, stop):
+    """Connect a gateway and send updates of its nodes at a fixed rate."""
+    ws = yield connect(url)
+    ws.write_message(auth_token(keys))
+    uids = ['gw{}-node{}'.format(index, node) for node in range(args.nodes)]
+    ready.append(ws)
+    yield gen.sleep(0.5)
+    for uid in uids:
+        ws.write_message(NewMessage(uid).text)
+    value = 0
+    start = time.monotonic()
+    while not stop:
+        due = int((time.monotonic() - start) * args.rate) - value
+        for _ in range(due):
+            ws.write_message(UpdateMessage(
+                uids[value % args.nodes], 'temperature',
+                '{:.2f}'.format(value % 4000 / 100), ts=time.time()).text)
+            value += 1
+        if stats.measuring:
+            stats.sent += due
+        yield gen.sleep(TICK)
+    ws.close()
+
+
+@gen.coroutine
+def run_load(args, keys, port, pids):
+    """Load the brokers and return the measures."""
+    stats, stop = Stats(), []
+    clients, gateways = [], []
+    for _ in range(args.clients):
+        IOLoop.current().spawn_callback(
+            run_client, "ws://127.0.0.1:{}/ws".format(port), stats, clients)
+    for index in range(args.gateways):
+        IOLoop.current().spawn_callback(
+            run_gateway, "ws://127.0.0.1:{}/gw".format(port), keys, index,
+            args, stats, gateways, stop)
+    while len(clients) < args.clients or len(gateways) < args.gateways:
+        yield gen.sleep(0.05)
+    yield gen.sleep(args.warmup)
+
+    usage = [process_usage(pid) for pid in pids]
+    load_cpu = time.process_time()
+    start = time.monotonic()
+    stats.measuring = True
+    yield gen.sleep(args.duration)
+    stats.measuring = False
+    elapsed = time.monotonic() - start
+    load_cpu = time.process_time() - load_cpu
+    end_usage = [process_usage(pid) for pid in pids]
+
+    stop.append(True)
+    for ws in clients:
+        ws.close()
+    yield gen.sleep(TICK * 2)
+
+    latencies = sorted(stats.latencies)
+    broker_cpu = sum(end[0] - begin[0]
+                     for begin, end in zip(usage, end_usage))
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        'updates_per_second': round(stats.sent / elapsed, 1),
+        'deliveries_per_second': round(stats.delivered / elapsed, 1),
+        'delivery_ratio': (round(stats.delivered /
+                                 (stats.sent * args.clients), 4)
+                           if stats.sent and args.clients else None),
+        'latency_p50_ms': ms(percentile(latencies, 50)),
+        'latency_p99_ms': ms(percentile(latencies, 99)),
+        'latency_max_ms': ms(latencies[-1] if latencies else None),
+        'broker_cpu_percent': round(broker_cpu * 100 / elapsed, 1),
+        'broker_rss_mb': round(sum(rss for _, rss in end_usage) / 2**20, 1),
+        'generator_cpu_percent': round(load_cpu * 100 / elapsed, 1),
+    }
+
+
+def git_revision():
+    """Return the current git commit, if any."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--gateways', type=int, default=10,
+                        help="Number of gateways")
+    parser.add_argument('--nodes', type=int, default=10,
+                        help="Number of nodes per gateway")
+    parser.add_argument('--rate', type=float, default=100,
+                        help="Updates per second sent by each gateway")
+    parser.add_argument('--clients', type=int, default=10,
+                        help="Number of websocket clients")
+    parser.add_argument('--broker-workers', type=int, default=1,
+                        help="Number of broker worker processes")
+    parser.add_argument('--history-depth', type=int, default=100,
+                        help="Number of values kept per node endpoint")
+    parser.add_argument('--telemetry-log-dir',
+                        help="Log the node messages in this directory")
+    parser.add_argument('--batch', action='store_true',
+                        help="Enable the batching of the client messages")
+    parser.add_argument('--compression', action='store_true',
+                        help="Enable websocket compression")
+    parser.add_argument('--warmup', type=float, default=2,
+                        help="Delay in seconds before measuring")
+    parser.add_argument('--duration', type=float, default=10,
+                        help="Duration of the measure in seconds")
+    parser.add_argument('--json', action='store_true',
+                        help="Output results as JSON")
+    parser.add_argument('--output',
+                        help="Also write the JSON results to this file")
+    args = parser.parse_args()
+
+    keys = Keys(private=generate_private_key(), secret=generate_secret_key())
+    processes, port, bus_path = start_brokers(args, keys)
+    try:
+        results = IOLoop.current().run_sync(
+            lambda: run_load(args, keys, port,
+                             [process.pid for process in processes]))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        shutil.rmtree(bus_path, ignore_errors=True)
+
+    report = {
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'json_codec': codec.name,
+        'parameters': {key: value for key, value in vars(args).items()
+                       if key not in ('json', 'output')},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    for key, value in results.items():
+        print("{:>24} {}".format(key, value))
+
+
+if __name__ == '__main__':
+    main()
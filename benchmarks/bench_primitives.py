@@ -0,0 +1,185 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Messaging and authentication primitives benchmark.
+
+Time the primitives run for each message or connection handled by the
+services, with realistic payloads: small node updates, IMU updates, large
+snapshots and invalid input.
+
+The results can be saved as a baseline and later runs compared to it: the
+script exits with an error when a primitive is slower than the baseline by
+more than the threshold. Baselines are only comparable on the same host.
+
+Usage:
+    PYTHONPATH=. python3 benchmarks/bench_primitives.py --save baseline.json
+    PYTHONPATH=. python3 benchmarks/bench_primitives.py \\
+        --compare baseline.json --threshold 1.2
+"""
+
+import argparse
+import json
+import logging
+import random
+import sys
+import timeit
+
+from pyaiot.common.auth import (Keys, auth_token, generate_private_key,
+                                generate_secret_key, verify_auth_token)
+from pyaiot.common.messaging import Message, check_broker_data, codec
+
+# Number of timing repeats, the fastest one is kept
+REPEATS = 5
+
+
+def imu_payload(rand):
+    """Return an IMU value, as sent by the nodes."""
+    return json.dumps([{'type': sensor,
+                        'values': [rand.randrange(-500, 500)
+                                   for _ in range(3)]}
+                       for sensor in ('acc', 'mag', 'gyro')])
+
+
+def snapshot_nodes(rand, count):
+    """Return the resources of count nodes."""
+    return {'node-{}'.format(uid): {
+        'name': 'Node {}'.format(uid), 'board': 'iotlab-m3',
+        'protocol': 'CoAP', 'led': '0',
+        'temperature': '{:.2f}°C'.format(rand.uniform(0, 40)),
+        'imu': imu_payload(rand)} for uid in range(count)}
+
+
+def cases():
+    """Return the benchmarked (name, function) pairs."""
+    rand = random.Random(0)
+    keys = Keys(private=generate_private_key(), secret=generate_secret_key())
+    other_keys = Keys(private=generate_private_key(), secret=keys.secret)
+    token = auth_token(keys)
+
+    update = {'type': 'update', 'uid': 'node-1', 'endpoint': 'temperature',
+              'data': '22.50°C', 'dst': 'all'}
+    imu = dict(update, endpoint='imu', data=imu_payload(rand))
+    snapshot = {'type': 'snapshot', 'nodes': snapshot_nodes(rand, 500),
+                'dst': 'all'}
+    update_text = Message.serialize(update)
+    imu_text = Message.serialize(imu)
+    snapshot_text = Message.serialize(snapshot)
+    batch_text = Message.batch([update_text] * 50)
+    command = {'uid': 'node-1', 'endpoint': 'led', 'payload': '1'}
+
+    return [
+        ('serialize_update', lambda: Message.serialize(update)),
+        ('serialize_imu', lambda: Message.serialize(imu)),
+        ('serialize_snapshot', lambda: Message.serialize(snapshot)),
+        ('check_message_update', lambda: Message.check_message(update_text)),
+        ('check_message_imu', lambda: Message.check_message(imu_text)),
+        ('check_message_snapshot',
+         lambda: Message.check_message(snapshot_text)),
+        ('check_message_batch', lambda: Message.check_message(batch_text)),
+        ('check_message_invalid_json',
+         lambda: Message.check_message(update_text[:-1])),
+        ('check_message_invalid_type',
+         lambda: Message.check_message('{"type": "unknown"}')),
+        ('check_broker_data', lambda: check_broker_data(command)),
+        ('check_broker_data_invalid',
+         lambda: check_broker_data({'uid': 'node-1'})),
+        ('auth_token', lambda: auth_token(keys)),
+        ('verify_auth_token', lambda: verify_auth_token(token, keys, 60)),
+        ('verify_auth_token_invalid',
+         lambda: verify_auth_token(token, other_keys, 60)),
+        ('verify_auth_token_garbage',
+         lambda: verify_auth_token('not a token', keys, 60)),
+    ]
+
+
+def measure(func):
+    """Return the time of a call in microseconds, the fastest of REPEATS."""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(REPEATS, number)) * 1e6 / number
+
+
+def compare(results, baseline, threshold):
+    """Return the (name, baseline, result) of the slowed down primitives."""
+    return [(name, baseline[name], result)
+            for name, result in results.items()
+            if name in baseline and result > baseline[name] * threshold]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--filter', default='',
+                        help="Only run the benchmarks containing this text")
+    parser.add_argument('--save',
+                        help="Save the results as a baseline in this file")
+    parser.add_argument('--compare',
+                        help="Compare the results with this baseline file")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help="Slowdown ratio against the baseline above "
+                        "which the benchmark fails")
+    parser.add_argument('--json', action='store_true',
+                        help="Output results as JSON")
+    args = parser.parse_args()
+    # Invalid input is logged: the records are created but not written
+    logging.getLogger().addHandler(logging.NullHandler())
+
+    results = {name: round(measure(func), 3) for name, func in cases()
+               if args.filter in name}
+    if args.save:
+        with open(args.save, 'w') as output:
+            json.dump({'json_codec': codec.name, 'results_us': results},
+                      output, indent=2)
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results_us']
+
+    if args.json:
+        print(json.dumps({'json_codec': codec.name, 'results_us': results},
+                         indent=2))
+    else:
+        print("{:>28} {:>12} {:>12} {:>8}".format(
+            "primitive", "time (us)", "baseline", "ratio"))
+        for name, result in results.items():
+            print("{:>28} {:>12} {:>12} {:>8}".format(
+                name, result, baseline.get(name, '-'),
+                round(result / baseline[name], 2) if name in baseline
+                else '-'))
+
+    slower = compare(results, baseline, args.threshold)
+    for name, reference, result in slower:
+        print("{} is slower than the baseline: {} us instead of {} us"
+              .format(name, result, reference), file=sys.stderr)
+    if slower:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
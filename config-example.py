@@ -7,6 +7,20 @@
 # Enable debug logging for all components.
 #debug = False
 
+# Log levels
+# Level of some loggers, separated by commas. The logs written for each
+# message relayed by a component go to its '.messages' logger, e.g
+# 'pyaiot.broker.messages' or 'pyaiot.gw.common.gateway.messages'.
+#log_levels = 'pyaiot.broker=debug,pyaiot.broker.messages=info'
+
+# Log format
+# Format of the logs: 'text' or 'json', one JSON object per record.
+#log_format = 'text'
+
+# Log sample rate
+# Only write one per-message log out of this many.
+#log_sample_rate = 1
+
 # Broker host:
 # Other component connect to this host for their broker connection. The
 # dashboard passes this hostname to the clients for their broker connection.
@@ -24,6 +38,171 @@
 # key file for authentication.
 #key_file = '~/.pyaiot/keys'
 
+# Authentication timeout
+# Delay (in s) for a gateway to send its authentication token to the broker.
+#auth_timeout = 2
+
+# Authentication token TTL
+# Maximum age (in s) of a gateway authentication token, a token can only be
+# used once during this time. 0 (the default) disables both checks. The
+# clocks of the gateway and broker hosts must differ by less than the TTL:
+# tokens too old or too far in the future are rejected.
+#auth_token_ttl = 0
+
+# Authentication max pending
+# Maximum number of connections waiting for their authentication token, the
+# other connections are closed and the gateways retry later.
+#auth_max_pending = 1000
+
+# Batch messages
+# Group the messages sent in a short time window in a single batch message:
+# applies to messages sent by gateways to the broker and by the broker to web
+# clients. All components of a deployment should be recent enough to
+# understand batch messages before enabling this.
+#batch_messages = False
+
+# Batch delay
+# Maximum time (in ms) a message waits before its batch is sent.
+#batch_delay = 5
+
+# Batch max size
+# A batch is sent as soon as the size of its messages reaches this many bytes.
+#batch_max_size = 65536
+
+# Snapshot messages
+# Gateways send the state of their nodes in snapshot messages, grouping many
+# nodes, instead of one new message per node and one update message per
+# resource. Older brokers close the connection of a gateway sending snapshot
+# messages: upgrade the brokers before enabling this on the gateways.
+#snapshot_messages = False
+
+# Compression
+# Compress the websocket messages between the broker, the gateways and the
+# web clients (permessage-deflate), when both ends support it.
+#compression = False
+
+# Compression threshold
+# Messages smaller than this many bytes are sent uncompressed.
+#compression_threshold = 64
+
+# Compression level
+# From 1 (fastest) to 9 (smallest messages).
+#compression_level = 6
+
+# Compression window bits
+# Size of the compression window, from 9 to 15 bits. Smaller windows use
+# less memory per connection and compress less.
+#compression_window_bits = 15
+
+# Wire format
+# Format of the messages sent by the gateways to the broker: json or msgpack.
+# msgpack requires the msgpack package ('pip install pyaiot[msgpack]') and is
+# only used when the broker supports it, otherwise the gateway keeps JSON.
+# The broker always sends JSON to its clients.
+#wire_format = "json"
+
+# JSON codec
+# JSON library used to encode and decode the messages: auto, orjson, ujson or
+# json. 'auto' decodes with orjson or ujson when installed and always encodes
+# with the standard library, so the messages are the same on all hosts.
+# 'orjson' is the fastest and writes compact JSON.
+#json_codec = "auto"
+
+# Profile directory
+# Directory of the profiles of a running service: SIGUSR1 starts CPU profiling
+# and the next SIGUSR1 writes a cProfile '.prof' file, SIGUSR2 starts memory
+# tracing and the next SIGUSR2 writes the allocations that grew meanwhile.
+#profile_dir = '/tmp'
+
+# Loop monitor
+# Measure the lag of the event loop and log the callbacks that blocked it for
+# more than loop_slow_threshold ms, with the function or coroutine they ran.
+# The broker exposes the lag histograms on its /metrics endpoint. The callbacks
+# are timed by the asyncio debug mode, which slows the service down a bit.
+#loop_monitor = False
+#loop_slow_threshold = 100
+
+# Latency tracing
+# When enabled on the gateways, the update messages carry the time the gateway
+# received the value from the node. The broker then exposes the latency of
+# each stage on its /metrics endpoint and the dashboard reports the latency
+# of the updates it receives. The hosts clocks should be synchronized.
+#latency_tracing = False
+
+# Latency trace file
+# File the broker appends sampled latency traces to, one JSON object per line.
+#latency_trace_file = None
+
+# Latency trace sample
+# The broker only writes one latency trace out of this many.
+#latency_trace_sample = 100
+
+# Broker workers
+# Number of broker worker processes. With more than one worker, each worker
+# accepts gateway and client connections and the workers relay node messages
+# to each other over Unix sockets. The metrics endpoint then answers with the
+# metrics of the worker handling the request only.
+#broker_workers = 1
+
+# Broker bus path
+# Directory containing the Unix sockets used by the broker workers.
+#broker_bus_path = '/tmp/pyaiot-broker'
+
+# Broker id
+# Id of the broker among its peers, defaults to '<hostname>:<broker_port>'.
+#broker_id = 'site1'
+
+# Broker peers
+# Websocket urls of the brokers running on other hosts. Peered brokers
+# relay the messages of their nodes to each other.
+#broker_peers = ['ws://site2:8000/peer']
+
+# Peer timeout
+# Delay (in s) before the nodes behind a lost peer are removed. If the peer
+# comes back in time, only the messages it missed are sent again.
+#peer_timeout = 30
+
+# Peer replay size
+# Number of messages kept for the peers whose connection was lost.
+#peer_replay_size = 10000
+
+# History depth
+# The broker keeps this many values of each node endpoint, served by its
+# /history endpoint to draw the dashboard charts. 0 disables the history.
+#history_depth = 100
+
+# Telemetry log
+# Directory where the broker appends the new, update, out and reset messages
+# of the nodes, in segment files of telemetry_log_segment_size MB. The oldest
+# segments are removed beyond telemetry_log_retention_size MB or
+# telemetry_log_retention_age seconds. The log is synced to the disk every
+# telemetry_log_sync_delay ms. At start, the broker history is filled with
+# the last 10 minutes of the log.
+#telemetry_log_dir = None
+#telemetry_log_segment_size = 16
+#telemetry_log_retention_size = 1024
+#telemetry_log_retention_age = 604800
+#telemetry_log_sync_delay = 1000
+
+# Client queue size
+# The broker queues at most this many messages for a slow web client.
+#client_queue_size = 1000
+
+# Client queue policy
+# What the broker does when the queue of a web client is full: 'drop-oldest'
+# drops the oldest queued message, 'conflate' replaces a queued update of the
+# same node endpoint (and drops the oldest message otherwise), 'disconnect'
+# closes the client connection.
+#client_queue_policy = 'drop-oldest'
+
+# Client sessions
+# A web client reconnecting within client_session_timeout seconds only
+# receives the messages it missed, if they are among the last
+# client_replay_size messages broadcast by the broker. Otherwise it receives
+# the state of all nodes again.
+#client_replay_size = 1000
+#client_session_timeout = 60
+
 # coap port
 # The coap component listens on this port for CoAP messages from nodes
 #coap_port = 5683
@@ -29,13 +29,135 @@
 
 """Broker application module."""
 
+import os
 import sys
-from tornado.options import options
+import socket
+import tempfile
+from tornado.netutil import bind_sockets
+from tornado.options import define, options
+from tornado.process import fork_processes
 
-from pyaiot.common.auth import check_key_file
+from pyaiot.common.auth import (check_key_file, AUTH_TIMEOUT, TOKEN_TTL,
+                                MAX_PENDING)
 from pyaiot.common.helpers import start_application, parse_command_line
 
 from .broker import Broker, logger
+from .bus import UnixSocketBus
+from .federation import PEER_TIMEOUT, REPLAY_SIZE
+from .history import HISTORY_DEPTH
+from .telemetry import (SEGMENT_SIZE, RETENTION_SIZE, RETENTION_AGE,
+                        SYNC_DELAY)
+from .outbound import QUEUE_SIZE, QUEUE_POLICIES
+from .sessions import WINDOW_SIZE, SESSION_TIMEOUT
+from .tracing import TRACE_SAMPLE_RATE
+
+
+def extra_args():
+    """Parse command line arguments for broker application."""
+    if not hasattr(options, "client_queue_size"):
+        define("client_queue_size", default=QUEUE_SIZE,
+               help="Maximum number of messages queued for a client")
+    if not hasattr(options, "client_queue_policy"):
+        define("client_queue_policy", default=QUEUE_POLICIES[0],
+               help="Policy applied when a client queue is full: {}"
+               .format(", ".join(QUEUE_POLICIES)))
+    if not hasattr(options, "client_replay_size"):
+        define("client_replay_size", default=WINDOW_SIZE,
+               help="Number of messages kept for the clients resuming their "
+               "session")
+    if not hasattr(options, "client_session_timeout"):
+        define("client_session_timeout", default=SESSION_TIMEOUT,
+               help="Delay in seconds before the session of a disconnected "
+               "client is forgotten")
+    if not hasattr(options, "auth_timeout"):
+        define("auth_timeout", default=AUTH_TIMEOUT,
+               help="Delay in seconds for a gateway to authenticate")
+    if not hasattr(options, "auth_token_ttl"):
+        define("auth_token_ttl", default=TOKEN_TTL,
+               help="Maximum age in seconds of an authentication token, "
+               "0 to disable the token age and replay checks. The gateway "
+               "and broker clocks must differ by less than this delay")
+    if not hasattr(options, "auth_max_pending"):
+        define("auth_max_pending", default=MAX_PENDING,
+               help="Maximum number of connections waiting for "
+               "authentication")
+    if not hasattr(options, "broker_workers"):
+        define("broker_workers", default=1,
+               help="Number of broker worker processes")
+    if not hasattr(options, "broker_bus_path"):
+        define("broker_bus_path",
+               default=os.path.join(tempfile.gettempdir(), "pyaiot-broker"),
+               help="Directory of the broker workers bus Unix sockets")
+    if not hasattr(options, "broker_id"):
+        define("broker_id", default=None,
+               help="Id of the broker in a federation, defaults to "
+               "'<hostname>:<broker_port>'")
+    if not hasattr(options, "broker_peers"):
+        define("broker_peers", default=[], multiple=True,
+               help="Websocket urls of the peer brokers, e.g "
+               "ws://host:8000/peer")
+    if not hasattr(options, "peer_timeout"):
+        define("peer_timeout", default=PEER_TIMEOUT,
+               help="Delay in seconds before the nodes of a lost peer are "
+               "removed")
+    if not hasattr(options, "peer_replay_size"):
+        define("peer_replay_size", default=REPLAY_SIZE,
+               help="Number of messages kept for the peers whose link was "
+               "lost")
+    if not hasattr(options, "history_depth"):
+        define("history_depth", default=HISTORY_DEPTH,
+               help="Number of values kept for each node endpoint, 0 to "
+               "disable the history")
+    if not hasattr(options, "telemetry_log_dir"):
+        define("telemetry_log_dir", default=None,
+               help="Directory of the log of the node messages, None to "
+               "disable the log")
+    if not hasattr(options, "telemetry_log_segment_size"):
+        define("telemetry_log_segment_size", default=SEGMENT_SIZE // 2**20,
+               help="Size in MB of the telemetry log segment files")
+    if not hasattr(options, "telemetry_log_retention_size"):
+        define("telemetry_log_retention_size",
+               default=RETENTION_SIZE // 2**20,
+               help="Total size in MB of the telemetry log kept on disk")
+    if not hasattr(options, "telemetry_log_retention_age"):
+        define("telemetry_log_retention_age", default=RETENTION_AGE,
+               help="Age in seconds of the oldest telemetry log segment "
+               "kept on disk")
+    if not hasattr(options, "telemetry_log_sync_delay"):
+        define("telemetry_log_sync_delay", default=SYNC_DELAY,
+               help="Maximum delay in ms before the telemetry log is synced "
+               "to the disk")
+    if not hasattr(options, "latency_trace_file"):
+        define("latency_trace_file", default=None,
+               help="File the sampled latency traces are appended to")
+    if not hasattr(options, "latency_trace_sample"):
+        define("latency_trace_sample", default=TRACE_SAMPLE_RATE,
+               help="Only write one latency trace out of this many")
+
+
+def start_workers(keys):
+    """Fork the broker worker processes and start a broker in each one.
+
+    All workers accept connections on the broker port: with SO_REUSEPORT,
+    each worker binds its own socket and the kernel balances the
+    connections, otherwise the socket is bound before forking and shared.
+    """
+    reuse_port = hasattr(socket, "SO_REUSEPORT")
+    sockets = None
+    if not reuse_port:
+        sockets = bind_sockets(options.broker_port)
+    bus_path = os.path.join(options.broker_bus_path,
+                            str(options.broker_port))
+    os.makedirs(bus_path, mode=0o700, exist_ok=True)
+
+    worker_id = fork_processes(options.broker_workers)
+
+    if reuse_port:
+        sockets = bind_sockets(options.broker_port, reuse_port=True)
+    bus = UnixSocketBus(bus_path, worker_id, options.broker_workers)
+    logger.info("Starting broker worker %s", worker_id)
+    start_application(Broker(keys, options=options, bus=bus),
+                      sockets=sockets, close_client=True)
 
 
 def run(arguments=[]):
@@ -44,12 +166,20 @@ def run(arguments=[]):
         sys.argv[1:] = arguments
 
     try:
-        parse_command_line()
+        parse_command_line(extra_args_func=extra_args)
     except SyntaxError as exc:
-        logger.error("Invalid config file: {}".format(exc))
+        logger.error("Invalid config file: %s", exc)
         return
     except FileNotFoundError as exc:
-        logger.error("Config file not found: {}".format(exc))
+        logger.error("Config file not found: %s", exc)
+        return
+    except ValueError as exc:
+        logger.error("Invalid options: %s", exc)
+        return
+
+    if options.client_queue_policy not in QUEUE_POLICIES:
+        logger.error("Invalid client queue policy: '%s'",
+                     options.client_queue_policy)
         return
 
     try:
@@ -58,8 +188,12 @@ def run(arguments=[]):
         logger.error(exc)
         return
 
+    if options.broker_workers > 1:
+        start_workers(keys)
+        return
+
     start_application(Broker(keys, options=options),
-                      port=options.broker_port)
+                      port=options.broker_port, close_client=True)
 
 
 if __name__ == '__main__':
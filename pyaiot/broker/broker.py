@@ -29,51 +29,90 @@
 
 """Broker tornado application module."""
 
+import time
 import uuid
+import socket
 import logging
 from tornado import gen, web, websocket
 
-from pyaiot.common.auth import verify_auth_token
-from pyaiot.common.messaging import Message
+from pyaiot.common.auth import Authenticator
+from pyaiot.common.compression import compression_options, limit_window_bits
+from pyaiot.common.messaging import (Message, NodeMessage, NewMessage,
+                                     OutMessage)
+from pyaiot.common.wire import select_subprotocol, negotiated_format
+
+from .cache import NodeCache
+from .fanout import encode_frame, can_share_frame
+from .federation import Federation, PeerLink
+from .history import History, BrokerHistoryHandler
+from .metrics import BrokerMetrics, BrokerMetricsHandler
+from .outbound import OutboundQueue
+from .registry import GatewayRegistry
+from .sessions import Sessions, stamp
+from .subscriptions import Subscriptions, parse_filters
+from .telemetry import TelemetryLog, replay
+from .tracing import LatencyTracer, gateway_name
 
 logger = logging.getLogger("pyaiot.broker")
+messages_logger = logging.getLogger("pyaiot.broker.messages")
+
+# Duration in seconds of the telemetry log replayed in the history at start
+HISTORY_REPLAY = 600
 
 
 class BrokerWebsocketGatewayHandler(websocket.WebSocketHandler):
 
     authentified = False
+    wire_format = 'json'
+    name = None
 
     def check_origin(self, origin):
         """Allow connections from anywhere."""
         return True
 
-    @gen.coroutine
+    def get_compression_options(self):
+        """Enable permessage-deflate when compression is enabled."""
+        return compression_options(self.application.options)
+
+    def select_subprotocol(self, subprotocols):
+        """Accept the binary wire format offered by the gateway, if known."""
+        return select_subprotocol(subprotocols)
+
     def open(self):
         """Discover nodes on each opened connection."""
         self.set_nodelay(True)
-        logger.info("New gateway websocket opened")
+        limit_window_bits(self, self.get_compression_options())
+        self.wire_format = negotiated_format(self.selected_subprotocol)
+        self.name = self.request.remote_ip
+        logger.info("New gateway websocket opened (%s)", self.wire_format)
 
-        # Wait 2 seconds to get the gateway authentication token.
-        yield gen.sleep(2)
-        if not self.authentified:
-            self.close()
+        # The connection is closed if the gateway doesn't send its
+        # authentication token in time.
+        if not self.application.authenticator.admit(self):
+            self.close(code=1013, reason="Try again later.")
 
     @gen.coroutine
     def on_message(self, raw):
         """Triggered when a message is received from the broker child."""
         if not self.authentified:
-            if verify_auth_token(raw, self.application.keys):
+            if self.application.authenticator.verify(self, raw):
                 logger.info("Gateway websocket authentication verified")
                 self.authentified = True
-                self.application.gateways.update({self: []})
+                self.application.gateways.add(self)
             else:
                 logger.info("Gateway websocket authentication failed, "
                             "closing.")
                 self.close()
         else:
-            message, reason = Message.check_message(raw)
-            if message is not None:
-                self.application.on_gateway_message(self, message)
+            messages, reason = Message.node_messages(raw, self.wire_format)
+            if messages is not None:
+                # Binary messages are relayed as JSON
+                self.application.relay(
+                    "gateway", raw if isinstance(raw, str) else
+                    {'type': "batch",
+                     'messages': [message.to_dict() for message in messages]})
+                for message in messages:
+                    self.application.on_gateway_message(self, message)
             else:
                 logger.debug("Invalid message, closing websocket")
                 self.close(code=1003, reason="{}.".format(reason))
@@ -81,47 +120,184 @@ class BrokerWebsocketGatewayHandler(websocket.WebSocketHandler):
     def on_close(self):
         """Remove websocket from internal list."""
         logger.info("Gateway websocket closed")
+        self.application.authenticator.discard(self)
         self.application.remove_ws(self)
 
 
 class BrokerWebsocketClientHandler(websocket.WebSocketHandler):
 
     uid = None
+    queue = None
 
     def check_origin(self, origin):
         """Allow connections from anywhere."""
         return True
 
+    def get_compression_options(self):
+        """Enable permessage-deflate when compression is enabled."""
+        return compression_options(self.application.options)
+
     def open(self):
         """Discover nodes on each opened connection."""
         self.uid = str(uuid.uuid4())
+        options = self.application.options
+        self.queue = OutboundQueue(
+            self, maxsize=options.client_queue_size,
+            policy=options.client_queue_policy,
+            batch_delay=(options.batch_delay / 1000
+                         if options.batch_messages else None),
+            batch_max_size=options.batch_max_size,
+            compression_threshold=options.compression_threshold,
+            bytes_counter=self.application.metrics.written,
+            dropped_counter=self.application.metrics.dropped)
         self.set_nodelay(True)
-        logger.info("New client connection opened '{}'".format(self.uid))
+        limit_window_bits(self, self.get_compression_options())
+        logger.info("New client connection opened '%s'", self.uid)
 
     @gen.coroutine
     def on_message(self, raw):
         """Triggered when a message is received from the web client."""
         message, reason = Message.check_message(raw)
         if message is not None:
-            message.update({'src': self.uid})
-            self.application.on_client_message(self, message)
+            messages = (message['messages'] if message['type'] == "batch"
+                        else [message])
+            for message in messages:
+                message.update({'src': self.uid})
+                self.application.on_client_message(self, message)
         else:
             logger.debug("Invalid message, closing websocket")
             self.close(code=1003, reason="{}.".format(reason))
 
     def on_close(self):
         """Remove websocket from internal list."""
-        logger.info("Client connection closed '{}'".format(self.uid))
+        logger.info("Client connection closed '%s'", self.uid)
+        if self.queue is not None:
+            self.queue.close()
         self.application.remove_ws(self.uid)
 
 
+class BrokerWebsocketPeerHandler(websocket.WebSocketHandler):
+
+    authentified = False
+
+    def check_origin(self, origin):
+        """Allow connections from anywhere."""
+        return True
+
+    def open(self):
+        """Wait for the authentication of the peer broker."""
+        if self.application.federation is None:
+            logger.info("Peer connection refused by broker worker")
+            self.close(code=1013, reason="Federation not handled by worker")
+            return
+        self.set_nodelay(True)
+        logger.info("New peer websocket opened")
+
+        if not self.application.authenticator.admit(self):
+            self.close(code=1013, reason="Try again later.")
+
+    def on_message(self, raw):
+        """Triggered when a message is received from a peer broker."""
+        federation = self.application.federation
+        if not self.authentified:
+            if self.application.authenticator.verify(self, raw):
+                logger.info("Peer websocket authentication verified")
+                self.authentified = True
+                federation.open(self)
+            else:
+                logger.info("Peer websocket authentication failed, "
+                            "closing.")
+                self.close()
+        else:
+            federation.on_connection_message(self, raw)
+
+    def on_close(self):
+        """Detach the websocket from its peer link."""
+        logger.info("Peer websocket closed")
+        self.application.authenticator.discard(self)
+        if self.application.federation is not None:
+            self.application.federation.close(self)
+
+
+class BrokerWorkerProxy():
+    """Stand-in for the gateways connected to another broker worker.
+
+    The proxy is registered as a gateway owning the nodes of the gateways
+    connected to the worker.
+    """
+
+    def __init__(self, bus, worker_id):
+        self.bus = bus
+        self.worker_id = worker_id
+        self.name = "worker:{}".format(worker_id)
+
+    def write_message(self, message):
+        """Forward a client message to the gateways of the worker."""
+        self.bus.send(self.worker_id, "client", message)
+
+
 class Broker(web.Application):
-    """Pyaiot broker."""
+    """Pyaiot broker.
+
+    When a bus is given, the broker is one of several workers: the messages
+    of the gateways are relayed to the other workers and the other workers
+    are seen as gateways owning the nodes of their own gateways.
+
+    The broker can also be peered with brokers running on other hosts, see
+    the federation module. With several workers, only the first one
+    handles the peer connections.
+
+    With a telemetry log, the node messages are appended to the log by the
+    first worker and the history of all workers starts with the last
+    messages of the log.
 
-    def __init__(self, keys, options):
+    Client sessions are local to a worker: a client reconnecting to another
+    worker gets a snapshot of the nodes, see the sessions module.
+    """
+
+    def __init__(self, keys, options, bus=None):
         self.keys = keys
-        self.gateways = {}
+        self.options = options
+        self.authenticator = Authenticator(
+            keys, timeout=options.auth_timeout, ttl=options.auth_token_ttl,
+            max_pending=options.auth_max_pending)
+        self.gateways = GatewayRegistry()
         self.clients = {}
+        self.subscriptions = Subscriptions()
+        self.cache = NodeCache()
+        self.sessions = Sessions(window_size=options.client_replay_size,
+                                 timeout=options.client_session_timeout)
+        self.history = History(depth=options.history_depth)
+        self.bus = bus
+        self.workers = {}
+        self.federation = None
+        # Nodes removed with a lost peer link, they can be reached again
+        # through another peer
+        self.lost = set()
+        self.telemetry = None
+        self.metrics = BrokerMetrics(
+            self, labels=({'worker': bus.worker_id} if bus is not None
+                          else None))
+        self.tracer = LatencyTracer(
+            self.metrics.registry, path=options.latency_trace_file,
+            sample_rate=options.latency_trace_sample)
+        if bus is None or bus.worker_id == 0:
+            broker_id = (options.broker_id or "{}:{}".format(
+                socket.gethostname(), options.broker_port))
+            self.federation = Federation(
+                self, broker_id, keys, peers=options.broker_peers,
+                timeout=options.peer_timeout,
+                replay_size=options.peer_replay_size)
+        if options.telemetry_log_dir:
+            self.replay_history(options.telemetry_log_dir)
+            if bus is None or bus.worker_id == 0:
+                self.telemetry = TelemetryLog(
+                    options.telemetry_log_dir,
+                    segment_size=options.telemetry_log_segment_size * 2**20,
+                    retention_size=(options.telemetry_log_retention_size *
+                                    2**20),
+                    retention_age=options.telemetry_log_retention_age,
+                    sync_delay=options.telemetry_log_sync_delay / 1000)
 
         if options.debug:
             logger.setLevel(logging.DEBUG)
@@ -129,92 +305,532 @@ class Broker(web.Application):
         handlers = [
             (r"/ws", BrokerWebsocketClientHandler),
             (r"/gw", BrokerWebsocketGatewayHandler),
+            (r"/peer", BrokerWebsocketPeerHandler),
+            (r"/metrics", BrokerMetricsHandler),
+            (r"/history", BrokerHistoryHandler),
         ]
         settings = {'debug': True}
 
         super().__init__(handlers, **settings)
-        logger.info('Application started, listening on port {}'
-                    .format(options.broker_port))
+        logger.info('Application started, listening on port %s',
+                    options.broker_port)
+
+        if self.bus is not None:
+            self.bus.start(self.on_bus_message, self.on_bus_peer,
+                           self.on_bus_peer_lost)
+        if self.federation is not None:
+            self.federation.start()
 
-    def broadcast(self, message):
-        """Broadcast message to all clients."""
-        logger.debug("Broadcasting message '{}' to web clients."
-                     .format(message))
-        for uid in self.clients.keys():
-            self.send_to_client(uid, message)
+    def log_message(self, message, received):
+        """Append a node message to the telemetry log, if enabled.
 
-    def send_to_client(self, uid, message):
+        Only the messages broadcast to all clients are logged, the ones
+        sent to a single client repeat the state of the nodes.
+        """
+        if self.telemetry is not None:
+            self.telemetry.append(message, received)
+
+    def close_client(self):
+        """Flush and close the telemetry log and trace file on shutdown."""
+        self.tracer.close()
+        if self.telemetry is not None:
+            self.telemetry.close()
+            self.telemetry = None
+
+    def replay_history(self, directory):
+        """Fill the history with the last messages of the telemetry log."""
+        count = 0
+        for timestamp, message in replay(directory,
+                                         since=time.time() - HISTORY_REPLAY):
+            self.history.update(message, timestamp)
+            count += 1
+        logger.info("%s messages of the telemetry log replayed", count)
+
+    def broadcast(self, message, node_uid=None, endpoint=None,
+                  msg_type=None):
+        """Broadcast message to all clients interested in it.
+
+        The websocket frame is only encoded once and the same bytes are
+        queued for all client connections. Clients using a compressed
+        connection fall back to a regular write. Clients having a session
+        share a second frame, with the sequence number of the message.
+
+        :param node_uid: the uid of the node the message is about
+        :param endpoint: the node endpoint, for update messages
+        :param msg_type: the type of the message, for the metrics
+        """
+        messages_logger.debug("Broadcasting message '%s' to web clients.",
+                              message)
+        key = (node_uid, endpoint) if endpoint is not None else None
+        seq = self.sessions.record(message, node_uid, endpoint)
+        texts, frames = [message, None], [None, None]
+        recipients = self._recipients(node_uid, endpoint)
+        for client in recipients:
+            index = int(client.uid in self.sessions)
+            if texts[index] is None:
+                texts[index] = stamp(message, seq)
+            if frames[index] is None and can_share_frame(client):
+                frames[index] = encode_frame(texts[index])
+            client.queue.put(texts[index], frame=frames[index], key=key)
+        self.metrics.fanout.observe(len(recipients))
+        self.metrics.sent.inc(len(recipients), (msg_type,))
+
+    def _recipients(self, node_uid, endpoint):
+        """Return the clients subscribed to a node endpoint."""
+        if node_uid is None:
+            return list(self.clients.values())
+        if endpoint is None:
+            uids = self.subscriptions.match_node(node_uid)
+        else:
+            uids = self.subscriptions.match(node_uid, endpoint)
+        # Clients that never subscribed receive everything
+        uids.update(self.subscriptions.unfiltered)
+        return [self.clients[uid] for uid in uids if uid in self.clients]
+
+    def send_to_client(self, uid, message, node_uid=None, endpoint=None,
+                       msg_type=None):
         """Send message to single client given its uid."""
-        logger.debug("Sending message '{}' to client {}."
-                     .format(message, uid))
-        self.clients[uid].write_message(message)
+        if (node_uid is not None and
+                not self.subscriptions.accepts(uid, node_uid, endpoint)):
+            return
+        messages_logger.debug("Sending message '%s' to client %s.",
+                              message, uid)
+        if uid in self.sessions:
+            message = stamp(message, self.sessions.seq)
+        key = (node_uid, endpoint) if endpoint is not None else None
+        self.clients[uid].queue.put(message, key=key)
+        self.metrics.sent.inc(labels=(msg_type,))
+
+    def gateway_kinds(self):
+        """Yield the kind of each connection owning nodes.
+
+        The kinds are 'gateway', 'worker' for the other broker workers and
+        'peer' for the peer brokers.
+        """
+        for gw in self.gateways:
+            if isinstance(gw, PeerLink):
+                yield "peer"
+            elif isinstance(gw, BrokerWorkerProxy):
+                yield "worker"
+            else:
+                yield "gateway"
+
+    def node_gateway(self, uid):
+        """Return the name of the gateway owning a node."""
+        gw = self.gateways.owner(uid) if isinstance(uid, str) else None
+        return gateway_name(gw) if gw is not None else "unknown"
+
+    def clients_stats(self):
+        """Return the outbound queue counters of each client."""
+        return {uid: client.queue.stats()
+                for uid, client in self.clients.items()}
 
     def on_client_message(self, ws, message):
         """Handle a message received from a client."""
-        logger.debug("Handling message '{}' received from client websocket."
-                     .format(message))
-        if message['type'] == "new":
-            logger.info("New client connected: {}".format(ws.uid))
-            if ws.uid not in self.clients.keys():
-                self.clients.update({ws.uid: ws})
-        elif message['type'] == "update":
-            logger.debug("New message from client: {}".format(ws.uid))
-
-        # Simply forward this message to satellite gateways
-        logger.debug("Forwarding message {} to gateways".format(message))
-        for gw in self.gateways:
-            gw.write_message(Message.serialize(message))
+        messages_logger.debug(
+            "Handling message '%s' received from client websocket.", message)
+        start = time.perf_counter()
+        self.metrics.received.inc(labels=("client", message['type']))
+        try:
+            if message['type'] == "new":
+                logger.info("New client connected: %s", ws.uid)
+                self.add_client(ws, session=message.get('session') is True)
+                self.send_cached_nodes(ws.uid)
+            elif message['type'] == "resume":
+                if self.resume_session(ws, message):
+                    return
+                # The missed messages are lost: start a new session and
+                # discover the nodes like a new client
+                self.add_client(ws, session=True)
+                self.send_cached_nodes(ws.uid)
+                message = {'type': "new", 'data': "client", 'src': ws.uid}
+            elif message['type'] == "update":
+                messages_logger.debug("New message from client: %s", ws.uid)
+            elif message['type'] in ("subscribe", "unsubscribe"):
+                # Subscriptions are handled by the broker only
+                self.on_client_subscription(ws, message)
+                return
+            elif message['type'] == "latency":
+                # Latency reports are handled by the broker only
+                if not self.tracer.on_report(ws.uid, message.get('data'),
+                                             self.node_gateway):
+                    logger.debug("Invalid latency report received from "
+                                 "client %s", ws.uid)
+                return
+
+            self.forward_to_gateways(message)
+        finally:
+            self.metrics.handler_seconds.observe(
+                time.perf_counter() - start, ("on_client_message",))
+
+    def add_client(self, ws, session=False):
+        """Register a client connection.
+
+        :param session: number the messages sent to the client, the client
+                        first receives its session id
+        """
+        if ws.uid in self.clients.keys():
+            return
+        self.clients.update({ws.uid: ws})
+        self.subscriptions.add(ws.uid)
+        if session:
+            self.sessions.open(ws.uid)
+            ws.queue.put(Message.session(ws.uid, self.sessions.seq))
+
+    def resume_session(self, ws, message):
+        """Reattach a client to its previous session.
+
+        The previous subscriptions of the client are restored and the
+        messages it missed are replayed.
+
+        :return False if the session cannot be resumed
+        """
+        session, seq = message.get('session'), message.get('seq')
+        if (not isinstance(session, str) or not isinstance(seq, int) or
+                isinstance(seq, bool) or ws.uid in self.clients):
+            logger.debug("Invalid session resume from client %s", ws.uid)
+            return False
+        previous = self.clients.get(session)
+        if previous is not None:
+            # The previous connection is not seen as closed yet
+            self.remove_ws(session)
+            previous.uid = None
+            previous.close()
+        resumed = self.sessions.resume(session, seq)
+        if resumed is None:
+            logger.info("Client session '%s' cannot be resumed", session)
+            return False
+        filters, missed = resumed
+        logger.info("Client session '%s' resumed, replaying %s messages",
+                    session, len(missed))
+        ws.uid = session
+        self.clients.update({ws.uid: ws})
+        self.subscriptions.add(ws.uid)
+        if filters is not None:
+            self.subscriptions.subscribe(ws.uid, filters)
+        ws.queue.put(Message.session(ws.uid, seq, resumed=True))
+        for seq, text, node_uid, endpoint, nodes in missed:
+            if nodes is not None and ws.uid in self.subscriptions:
+                nodes = self.subscriptions.filter_nodes(ws.uid, nodes)
+                texts = Message.snapshot_chunks(nodes, dst=ws.uid)
+            elif (node_uid is None or
+                  self.subscriptions.accepts(ws.uid, node_uid, endpoint)):
+                texts = [text]
+            else:
+                continue
+            for text in texts:
+                ws.queue.put(stamp(text, seq))
+                self.metrics.sent.inc(labels=("replay",))
+        return True
+
+    def forward_to_gateways(self, message, workers=True, peers=True):
+        """Forward a client message to satellite gateways.
+
+        An 'update' command is only sent to the gateway owning the node.
+        A 'new' message is only forwarded to the gateways that haven't
+        reported any node yet: the other nodes are known from the cache.
+        Peer brokers always receive it once.
+
+        :param workers: also forward to the other broker workers
+        :param peers: also forward to the peer brokers
+        """
+        messages_logger.debug("Forwarding message %s to gateways", message)
+        raw = Message.serialize(message)
+        if message['type'] == "update":
+            data = message.get('data')
+            uid = data.get('uid') if isinstance(data, dict) else None
+            gw = self.gateways.owner(uid) if isinstance(uid, str) else None
+            if gw is None:
+                logger.debug("No gateway owning the node of the command")
+            elif ((workers or not isinstance(gw, BrokerWorkerProxy)) and
+                  (peers or not isinstance(gw, PeerLink))):
+                gw.write_message(raw)
+            return
+        for gw, nodes in self.gateways.items():
+            if isinstance(gw, PeerLink):
+                continue
+            if not workers and isinstance(gw, BrokerWorkerProxy):
+                continue
+            if message['type'] == "new" and nodes:
+                continue
+            gw.write_message(raw)
+        if peers and self.federation is not None:
+            self.federation.publish("client", raw)
+
+    def send_cached_nodes(self, uid):
+        """Send the cached state of all known nodes to a single client."""
+        if len(self.cache):
+            self.send_snapshot(uid, self.cache.nodes())
+
+    def send_snapshot(self, uid, nodes):
+        """Send the state of several nodes to a single client."""
+        nodes = self.subscriptions.filter_nodes(uid, nodes)
+        for message in Message.snapshot_chunks(nodes, dst=uid):
+            self.send_to_client(uid, message, msg_type="snapshot")
+
+    def broadcast_snapshot(self, message, nodes):
+        """Broadcast a snapshot message to all clients.
+
+        Clients that subscribed to some nodes only receive a snapshot of
+        these nodes.
+        """
+        seq = self.sessions.record(message, nodes=nodes)
+        texts, frames = [message, None], [None, None]
+        for uid, client in list(self.clients.items()):
+            if uid in self.subscriptions:
+                self.send_snapshot(uid, nodes)
+                continue
+            index = int(uid in self.sessions)
+            if texts[index] is None:
+                texts[index] = stamp(message, seq)
+            if frames[index] is None and can_share_frame(client):
+                frames[index] = encode_frame(texts[index])
+            client.queue.put(texts[index], frame=frames[index])
+            self.metrics.sent.inc(labels=("snapshot",))
+
+    def on_client_subscription(self, ws, message):
+        """Update the subscriptions of a client."""
+        filters = parse_filters(message.get('data'))
+        if filters is None:
+            logger.debug("Invalid subscription received from client %s",
+                         ws.uid)
+            return
+        if message['type'] == "subscribe":
+            self.subscriptions.subscribe(ws.uid, filters)
+        else:
+            self.subscriptions.unsubscribe(ws.uid, filters)
 
     @gen.coroutine
     def on_gateway_message(self, ws, message):
-        """Handle a message received from a gateway.
+        """Handle a node message received from a gateway.
 
         This method redirect messages from gateways to the right destinations:
         - for freshly new information initiated by nodes => broadcast
         - for replies to new client connection => only send to this client
+
+        Messages are routed on their type, uid and dst only: the text of a
+        message received from a gateway is forwarded as is to the clients.
         """
-        logger.debug("Handling message '{}' received from gateway."
-                     .format(message))
-        if message['type'] == "new":
-            # Received when notifying clients of a new node available
-            if not message['uid'] in self.gateways[ws]:
-                self.gateways[ws].append(message['uid'])
-
-            if message['dst'] == "all":
-                # Occurs when an unknown new node arrived
-                self.broadcast(Message.serialize(message))
-            elif message['dst'] in self.clients.keys():
-                # Occurs when a single client has just connected
-                self.send_to_client(
-                    message['dst'], Message.serialize(message))
-        elif (message['type'] == "out" and
-              message['uid'] in self.gateways[ws]):
-            # Node disparition are always broadcasted to clients
-            self.gateways[ws].remove(message['uid'])
-            self.broadcast(Message.serialize(message))
-        elif message['type'] == "reset":
-            # Occurs when a node has reset (reboot, firmware update):
-            # require broadcast
-            self.broadcast(Message.serialize(message))
-        elif (message['type'] in "update" and
-              message['uid'] in self.gateways[ws]):
-            if message['dst'] == "all":
-                # Occurs when a new update was pushed by a node:
+        messages_logger.debug("Handling message '%s' received from gateway.",
+                              message)
+        msg_type = message.type
+        received = time.time()
+        start = time.perf_counter()
+        self.metrics.received.inc(labels=("gateway", msg_type))
+        try:
+            if msg_type == "new":
+                # Received when notifying clients of a new node available
+                self.gateways.add_node(ws, message.uid)
+                self.cache.update(message)
+
+                if message.dst == "all":
+                    # Occurs when an unknown new node arrived
+                    self.log_message(message, received)
+                    self.broadcast(message.text, node_uid=message.uid,
+                                   msg_type=msg_type)
+                elif message.dst in self.clients.keys():
+                    # Occurs when a single client has just connected
+                    self.send_to_client(message.dst, message.text,
+                                        node_uid=message.uid,
+                                        msg_type=msg_type)
+            elif msg_type == "snapshot":
+                # Received when a gateway sends the state of its nodes at once
+                for uid in message.nodes:
+                    self.gateways.add_node(ws, uid)
+                self.cache.update(message)
+                if message.dst == "all":
+                    self.broadcast_snapshot(message.text, message.nodes)
+                elif message.dst in self.clients.keys():
+                    self.send_snapshot(message.dst, message.nodes)
+            elif msg_type == "out" and self.gateways.owns(ws, message.uid):
+                # Node disparition are always broadcasted to clients
+                self.gateways.remove_node(ws, message.uid)
+                self.cache.update(message)
+                self.history.update(message, received)
+                self.log_message(message, received)
+                self.broadcast(message.text, node_uid=message.uid,
+                               msg_type=msg_type)
+            elif msg_type == "reset":
+                # Occurs when a node has reset (reboot, firmware update):
                 # require broadcast
-                self.broadcast(Message.serialize(message))
-            elif message['dst'] in self.clients.keys():
-                # Occurs when a new client has just connected:
-                # Only the cached information of a node are pushed to this
-                # specific client
-                self.send_to_client(
-                    message['dst'], Message.serialize(message))
+                self.cache.update(message)
+                self.log_message(message, received)
+                self.broadcast(message.text, node_uid=message.uid,
+                               msg_type=msg_type)
+            elif msg_type == "update" and self.gateways.owns(ws, message.uid):
+                self.cache.update(message)
+                self.history.update(message, received)
+                if message.dst == "all":
+                    # Occurs when a new update was pushed by a node:
+                    # require broadcast
+                    self.log_message(message, received)
+                    self.broadcast(message.text, node_uid=message.uid,
+                                   endpoint=message.endpoint,
+                                   msg_type=msg_type)
+                elif message.dst in self.clients.keys():
+                    # Occurs when a new client has just connected:
+                    # Only the cached information of a node are pushed to this
+                    # specific client
+                    self.send_to_client(message.dst, message.text,
+                                        node_uid=message.uid,
+                                        endpoint=message.endpoint,
+                                        msg_type=msg_type)
+                if message.ts is not None:
+                    self.tracer.on_update(gateway_name(ws), message,
+                                          received, time.time())
+        finally:
+            self.metrics.handler_seconds.observe(
+                time.perf_counter() - start, ("on_gateway_message",))
 
     def remove_ws(self, ws):
         """Remove websocket that has been closed."""
         if ws in self.clients:
             self.clients.pop(ws)
-        elif ws in self.gateways.keys():
+            if ws in self.sessions:
+                self.sessions.detach(ws, self.subscriptions.filters(ws))
+            self.subscriptions.remove(ws)
+        elif ws not in self.gateways:
+            # A client can subscribe before its 'new' message
+            self.subscriptions.remove(ws)
+        else:
             # Notify clients that the nodes behind the closed gateway are out.
-            for node_uid in self.gateways[ws]:
-                self.broadcast(Message.out_node(node_uid))
-            self.gateways.pop(ws)
+            self.remove_nodes(ws, self.gateways.remove(ws))
+
+    def remove_nodes(self, gw, uids):
+        """Notify clients that the nodes owned by a gateway are out.
+
+        The nodes behind a peer link are only lost for this broker: the
+        other peers are told the nodes are lost, they only remove the ones
+        they reach through this broker.
+        """
+        messages = []
+        for node_uid in uids:
+            self.gateways.remove_node(gw, node_uid)
+            self.cache.remove(node_uid)
+            self.history.remove(node_uid)
+            message = OutMessage(node_uid)
+            self.log_message(message, time.time())
+            messages.append(message.text)
+            self.broadcast(messages[-1], node_uid=node_uid, msg_type="out")
+        if not messages or isinstance(gw, BrokerWorkerProxy):
+            return
+        raw = Message.batch(messages)
+        if isinstance(gw, PeerLink):
+            self.lost.update(uids)
+            if self.bus is not None:
+                self.bus.publish("gateway", raw)
+            if self.federation is not None:
+                self.federation.publish("lost", raw, exclude=gw)
+        else:
+            self.relay("gateway", raw)
+
+    def relay(self, kind, raw, exclude=None):
+        """Relay a message to the other broker workers and to the peers.
+
+        A decoded message is only serialized when it has to be relayed.
+
+        :param exclude: a peer link the message must not be relayed to
+        """
+        if not isinstance(raw, str):
+            if self.bus is None and (self.federation is None or
+                                     not self.federation.links):
+                return
+            raw = Message.serialize(raw)
+        if self.bus is not None:
+            self.bus.publish(kind, raw)
+        if self.federation is not None:
+            self.federation.publish(kind, raw, exclude=exclude)
+
+    def on_bus_message(self, worker_id, kind, raw):
+        """Handle a message relayed by another broker worker."""
+        if kind == "gateway":
+            messages, reason = Message.node_messages(raw)
+            if messages is None:
+                return
+            if self.federation is not None:
+                self.federation.publish(kind, raw)
+            for message in messages:
+                self.on_gateway_message(self._worker(worker_id), message)
+        elif kind == "client":
+            items, reason = Message.split(raw)
+            for message, _ in items or []:
+                self.forward_to_gateways(message, workers=False)
+
+    def _worker(self, worker_id):
+        """Return the proxy of a broker worker, registering it if needed."""
+        if worker_id not in self.workers:
+            proxy = BrokerWorkerProxy(self.bus, worker_id)
+            self.workers.update({worker_id: proxy})
+            self.gateways.add(proxy)
+        return self.workers[worker_id]
+
+    def on_bus_peer(self, worker_id):
+        """Register a broker worker and send it the state of local nodes."""
+        self._worker(worker_id)
+        nodes = {uid: self.cache.resources(uid)
+                 for gw, uids in self.gateways.items()
+                 if not isinstance(gw, BrokerWorkerProxy)
+                 for uid in uids if uid in self.cache}
+        for message in Message.snapshot_chunks(nodes):
+            self.bus.send(worker_id, "gateway", message)
+
+    def on_bus_peer_lost(self, worker_id):
+        """Remove the nodes owned by a broker worker that is gone."""
+        proxy = self.workers.pop(worker_id, None)
+        if proxy is not None:
+            self.remove_ws(proxy)
+
+    def on_peer_message(self, link, kind, raw):
+        """Handle a message relayed by a peer broker.
+
+        A node can be reachable through several peers: its messages are
+        received from the first peer that relayed them. A node lost by a
+        peer is only removed if it was reached through this peer, a lost
+        node is added back when another peer relays an update about it.
+        """
+        if kind in ("gateway", "lost"):
+            messages, reason = Message.node_messages(raw)
+            if messages is None:
+                return
+        if kind == "gateway":
+            found = self.found_nodes(messages)
+            if self.bus is not None:
+                for message in found:
+                    self.bus.publish(kind, message.text)
+                self.bus.publish(kind, raw)
+            for message in found + messages:
+                if (message.type in ("update", "out") and
+                        isinstance(self.gateways.owner(message.uid),
+                                   PeerLink)):
+                    self.gateways.add_node(link, message.uid)
+                self.on_gateway_message(link, message)
+        elif kind == "lost":
+            self.remove_nodes(link, [
+                message.uid for message in messages
+                if message.type == "out" and
+                self.gateways.owns(link, message.uid)])
+        elif kind == "client":
+            items, reason = Message.split(raw)
+            for message, _ in items or []:
+                self.forward_to_gateways(message, peers=False)
+
+    def found_nodes(self, messages):
+        """Return a new message for each lost node that is updated again."""
+        found = []
+        for message in messages:
+            if message.type == "snapshot" or message.uid not in self.lost:
+                continue
+            self.lost.discard(message.uid)
+            if (message.type == "update" and
+                    self.gateways.owner(message.uid) is None):
+                found.append(NewMessage(message.uid))
+        return found
+
+    def on_peer_sync(self, link, nodes):
+        """Replace the nodes owned by a peer with the state it sent."""
+        messages = [Message.out_node(uid)
+                    for uid in self.gateways.nodes(link) if uid not in nodes]
+        messages.extend(Message.snapshot_chunks(nodes))
+        for raw in messages:
+            self.relay("gateway", raw, exclude=link)
+            self.on_gateway_message(link, NodeMessage.from_text(raw))
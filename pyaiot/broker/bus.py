@@ -0,0 +1,238 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Broker workers message bus module.
+
+When the broker runs several worker processes, each worker relays the
+messages of its gateways to the other workers and forwards the client
+commands to the workers owning the gateways. Messages are relayed as is,
+prefixed by their kind:
+
+- 'gateway': a message received from a gateway,
+- 'client': a command sent by a client to the gateways.
+"""
+
+import os
+import socket
+import logging
+
+from tornado import gen
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import bind_unix_socket
+from tornado.tcpserver import TCPServer
+
+logger = logging.getLogger("pyaiot.broker.bus")
+
+RECONNECT_DELAY = 0.5
+
+
+class Bus():
+    """Base class of the message buses between broker workers.
+
+    Subclasses call the handler callbacks given to `start`:
+
+    - on_message(worker_id, kind, raw) when a message is received,
+    - on_peer(worker_id) when the connection to a worker is established,
+    - on_peer_lost(worker_id) when a worker is gone.
+    """
+
+    def __init__(self, worker_id):
+        self.worker_id = worker_id
+        self.on_message = None
+        self.on_peer = None
+        self.on_peer_lost = None
+
+    def start(self, on_message, on_peer, on_peer_lost):
+        """Start relaying messages between workers."""
+        self.on_message = on_message
+        self.on_peer = on_peer
+        self.on_peer_lost = on_peer_lost
+
+    def publish(self, kind, raw):
+        """Send a text message to all other workers."""
+        raise NotImplementedError()
+
+    def send(self, worker_id, kind, raw):
+        """Send a text message to a single worker."""
+        raise NotImplementedError()
+
+    def close(self):
+        """Stop the bus."""
+
+
+class LocalBus(Bus):
+    """In-process bus connecting broker instances of the same process.
+
+    All buses created with the same hub dict are connected together, this is
+    mostly useful for testing.
+    """
+
+    def __init__(self, hub, worker_id):
+        super().__init__(worker_id)
+        self.hub = hub
+
+    def start(self, on_message, on_peer, on_peer_lost):
+        super().start(on_message, on_peer, on_peer_lost)
+        peers = list(self.hub.values())
+        self.hub[self.worker_id] = self
+        for bus in peers:
+            bus.on_peer(self.worker_id)
+            self.on_peer(bus.worker_id)
+
+    def publish(self, kind, raw):
+        for worker_id in list(self.hub):
+            if worker_id != self.worker_id:
+                self.send(worker_id, kind, raw)
+
+    def send(self, worker_id, kind, raw):
+        if worker_id in self.hub:
+            self.hub[worker_id].on_message(self.worker_id, kind, raw)
+
+    def close(self):
+        self.hub.pop(self.worker_id, None)
+        for bus in list(self.hub.values()):
+            bus.on_peer_lost(self.worker_id)
+
+
+class _BusServer(TCPServer):
+    """Accept the connections of the other workers."""
+
+    def __init__(self, bus):
+        super().__init__()
+        self.bus = bus
+
+    @gen.coroutine
+    def handle_stream(self, stream, address):
+        worker_id = None
+        try:
+            hello = yield stream.read_until(b'\n')
+            worker_id = int(hello.split()[1])
+            while True:
+                header = yield stream.read_until(b'\n')
+                kind, length = header.decode('utf-8').split()
+                raw = yield stream.read_bytes(int(length))
+                self.bus.on_message(worker_id, kind, raw.decode('utf-8'))
+        except StreamClosedError:
+            if worker_id is not None:
+                logger.info("Broker worker %s connection lost", worker_id)
+        except (IndexError, ValueError):
+            logger.warning("Invalid data received on broker bus, closing.")
+        finally:
+            stream.close()
+            if worker_id is not None:
+                self.bus.on_peer_lost(worker_id)
+
+
+class UnixSocketBus(Bus):
+    """Bus between the worker processes of a host, over Unix sockets.
+
+    Each worker listens on '<path>/worker-<id>.sock' and connects to the
+    socket of all other workers. Each message is written as a
+    '<kind> <length>\\n' header line followed by its UTF-8 text: the text
+    of a gateway message is relayed as is and can contain newlines.
+    """
+
+    def __init__(self, path, worker_id, workers):
+        super().__init__(worker_id)
+        self.path = path
+        self.workers = workers
+        self._server = None
+        self._streams = {}
+        self._closed = False
+
+    def socket_path(self, worker_id):
+        return os.path.join(self.path, 'worker-{}.sock'.format(worker_id))
+
+    def start(self, on_message, on_peer, on_peer_lost):
+        super().start(on_message, on_peer, on_peer_lost)
+        self._server = _BusServer(self)
+        self._server.add_socket(
+            bind_unix_socket(self.socket_path(self.worker_id)))
+        for worker_id in range(self.workers):
+            if worker_id != self.worker_id:
+                IOLoop.current().spawn_callback(self._connect, worker_id)
+
+    @gen.coroutine
+    def _connect(self, worker_id):
+        """Maintain the connection to another worker."""
+        while not self._closed:
+            stream = IOStream(socket.socket(socket.AF_UNIX,
+                                            socket.SOCK_STREAM))
+            try:
+                yield stream.connect(self.socket_path(worker_id))
+                yield stream.write('hello {}\n'.format(self.worker_id)
+                                   .encode())
+            except (StreamClosedError, OSError):
+                stream.close()
+                yield gen.sleep(RECONNECT_DELAY)
+                continue
+
+            logger.info("Connected to broker worker %s", worker_id)
+            closed = Future()
+            stream.set_close_callback(lambda: closed.set_result(None))
+            self._streams[worker_id] = stream
+            self.on_peer(worker_id)
+            yield closed
+            self._streams.pop(worker_id, None)
+            yield gen.sleep(RECONNECT_DELAY)
+
+    @staticmethod
+    def _frame(kind, raw):
+        """Encode a message as a length prefixed frame.
+
+        >>> UnixSocketBus._frame('gateway', '{"uid": "n"}')
+        b'gateway 12\\n{"uid": "n"}'
+        """
+        payload = raw.encode('utf-8')
+        return '{} {}\n'.format(kind, len(payload)).encode() + payload
+
+    def publish(self, kind, raw):
+        frame = self._frame(kind, raw)
+        for worker_id in list(self._streams):
+            self._write(worker_id, frame)
+
+    def send(self, worker_id, kind, raw):
+        if worker_id in self._streams:
+            self._write(worker_id, self._frame(kind, raw))
+
+    def _write(self, worker_id, frame):
+        try:
+            self._streams[worker_id].write(frame)
+        except StreamClosedError:
+            self._streams.pop(worker_id, None)
+
+    def close(self):
+        self._closed = True
+        if self._server is not None:
+            self._server.stop()
+        for stream in self._streams.values():
+            stream.close()
+        self._streams.clear()
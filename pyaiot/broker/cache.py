@@ -0,0 +1,101 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Broker nodes last-value cache module."""
+
+import logging
+
+logger = logging.getLogger("pyaiot.broker.cache")
+
+
+class NodeCache():
+    """Last known resources values of the nodes behind the gateways.
+
+    The cache is built from the new, update, reset, out and snapshot
+    messages sent by the gateways, it is used to send the current state of
+    the nodes to a new client without querying the gateways.
+
+    >>> from pyaiot.common.messaging import (NewMessage, OutMessage,
+    ...                                      ResetMessage, UpdateMessage)
+    >>> cache = NodeCache()
+    >>> cache.update(NewMessage('1234'))
+    >>> cache.update(UpdateMessage('1234', 'led', '0'))
+    >>> cache.resources('1234')
+    {'led': '0'}
+    >>> cache.update(ResetMessage('1234'))
+    >>> cache.resources('1234')
+    {}
+    >>> cache.update(OutMessage('1234'))
+    >>> '1234' in cache
+    False
+    """
+
+    def __init__(self):
+        self._nodes = {}
+
+    def __contains__(self, uid):
+        return uid in self._nodes
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __iter__(self):
+        return iter(self._nodes.items())
+
+    def resources(self, uid):
+        """Return the cached resources of a node."""
+        return self._nodes[uid]
+
+    def nodes(self):
+        """Return a dict with the cached resources of all nodes."""
+        return {uid: dict(resources) for uid, resources in self}
+
+    def update(self, message):
+        """Update the cache with a node message received from a gateway."""
+        msg_type = message.type
+        if msg_type == 'snapshot':
+            for uid, resources in message.nodes.items():
+                self._nodes[uid] = dict(resources)
+            return
+
+        uid = message.uid
+        if msg_type == 'new':
+            self._nodes.setdefault(uid, {})
+        elif msg_type == 'update':
+            resources = self._nodes.setdefault(uid, {})
+            resources[message.endpoint] = message.data
+        elif msg_type == 'reset':
+            if uid in self._nodes:
+                self._nodes[uid] = {}
+        elif msg_type == 'out':
+            self.remove(uid)
+
+    def remove(self, uid):
+        """Remove a node from the cache."""
+        self._nodes.pop(uid, None)
@@ -0,0 +1,106 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Broker websocket fan-out helpers module."""
+
+import struct
+
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketClosedError
+
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+FIN = 0x80
+
+
+def encode_frame(message, binary=False):
+    """Encode a message as a single, unmasked websocket frame.
+
+    Frames sent by a server are never masked (RFC 6455, section 5.1), so the
+    returned bytes can be written as is on any client connection that doesn't
+    use per-connection compression.
+
+    >>> encode_frame('test')
+    b'\\x81\\x04test'
+    >>> encode_frame(b'test', binary=True)
+    b'\\x82\\x04test'
+    >>> encode_frame('a' * 200)[:4]
+    b'\\x81~\\x00\\xc8'
+    """
+    if isinstance(message, str):
+        message = message.encode('utf-8')
+    opcode = OPCODE_BINARY if binary else OPCODE_TEXT
+    length = len(message)
+    if length < 126:
+        header = struct.pack("!BB", FIN | opcode, length)
+    elif length <= 0xFFFF:
+        header = struct.pack("!BBH", FIN | opcode, 126, length)
+    else:
+        header = struct.pack("!BBQ", FIN | opcode, 127, length)
+    return header + message
+
+
+def payload_size(message):
+    """Return the size in bytes of the payload of a message frame.
+
+    >>> payload_size('22.5°C'), payload_size(b'test')
+    (7, 4)
+    """
+    if isinstance(message, bytes) or message.isascii():
+        return len(message)
+    return len(message.encode('utf-8'))
+
+
+def can_share_frame(handler):
+    """Check if a pre-encoded frame can be written to the handler.
+
+    This is not the case when the connection masks its outgoing frames or
+    when permessage-deflate was negotiated: the compressor state is specific
+    to each connection.
+    """
+    connection = handler.ws_connection
+    return (connection is not None and
+            not getattr(connection, 'mask_outgoing', False) and
+            getattr(connection, '_compressor', None) is None)
+
+
+def write_frame(handler, frame):
+    """Write a pre-encoded frame on the handler websocket connection.
+
+    Raise a WebSocketClosedError if the connection is closed or closing,
+    like WebSocketHandler.write_message does: no data frame can follow a
+    close frame (RFC 6455, section 5.5.1).
+    """
+    connection = handler.ws_connection
+    if connection is None or connection.is_closing():
+        raise WebSocketClosedError()
+    try:
+        return connection.stream.write(frame)
+    except StreamClosedError:
+        raise WebSocketClosedError()
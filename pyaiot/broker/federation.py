@@ -0,0 +1,353 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Broker federation module.
+
+Brokers running on different hosts can be peered: each broker relays the
+messages about the nodes it knows to its peers and forwards the client
+commands to them. A peer broker is seen as a gateway owning the nodes
+reachable through it.
+
+Peers exchange JSON text messages with a 'type' field:
+
+- 'hello': sent by both ends when a link is established, with the id of the
+  broker and the last sequence number seen from each origin broker,
+- 'relay': a 'gateway', 'client' or 'lost' message, with the broker it
+  originates from, its sequence number at this origin and the number of
+  hops it already went through,
+- 'sync': the state of all the nodes known by a broker, sent when a link is
+  established for the first time or when the missed messages are not
+  available anymore.
+
+A relayed message is identified by its (origin, seq) pair: a message
+already seen is dropped, which prevents loops and duplicates when brokers
+are peered in a mesh. When a link is lost, the nodes behind it are kept for
+a while: if the link comes back in time, only the missed messages are
+replayed.
+
+When a link expires, the nodes behind it are lost for the broker but may
+still be reachable through other peers: the broker relays a 'lost' message,
+that is not relayed further. A peer only removes the lost nodes it reaches
+through this broker and relays its own 'lost' message for them.
+"""
+
+import uuid
+import logging
+from collections import deque
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+from tornado.websocket import websocket_connect, WebSocketClosedError
+
+from pyaiot.common.auth import auth_token
+from pyaiot.common.messaging import Message, codec
+
+logger = logging.getLogger("pyaiot.broker.federation")
+
+PEER_TIMEOUT = 30
+REPLAY_SIZE = 10000
+DEDUP_WINDOW = 1024
+MAX_HOPS = 8
+RECONNECT_DELAY = 3
+
+
+def relay_message(origin, seq, hops, kind, raw):
+    """Generate a relay text message embedding a raw message.
+
+    >>> relay_message("a", 1, 0, "gateway", '{"type": "out", "uid": "n"}')
+    '{"type": "relay", "origin": "a", "seq": 1, "hops": 0, \
+"kind": "gateway", "message": {"type": "out", "uid": "n"}}'
+    """
+    comma, colon = codec.separators
+    return ('{{"type"{1}"relay"{0}"origin"{1}{2}{0}"seq"{1}{3}{0}'
+            '"hops"{1}{4}{0}"kind"{1}{5}{0}"message"{1}{6}}}'
+            .format(comma, colon, codec.dumps(origin), seq, hops,
+                    codec.dumps(kind), raw))
+
+
+class SequenceFilter():
+    """Keep track of the sequence numbers seen from each origin.
+
+    Messages can arrive out of order when they follow different paths, the
+    sequence numbers seen are remembered in a window below the highest one.
+
+    >>> seen = SequenceFilter(window=4)
+    >>> [seen.check("a", seq) for seq in (1, 3, 2, 3)]
+    [True, True, True, False]
+    >>> seen.check("a", 8), seen.check("a", 4), seen.check("a", 7)
+    (True, False, True)
+    >>> seen.highs()
+    {'a': 8}
+    """
+
+    def __init__(self, window=DEDUP_WINDOW):
+        self.window = window
+        self._highs = {}
+        self._seen = {}
+
+    def check(self, origin, seq):
+        """Return True if the sequence number is new and remember it."""
+        high = self._highs.get(origin, 0)
+        seen = self._seen.setdefault(origin, set())
+        if seq <= high - self.window or seq in seen:
+            return False
+        seen.add(seq)
+        if seq > high:
+            self._highs[origin] = seq
+            if len(seen) > 2 * self.window:
+                self._seen[origin] = {s for s in seen
+                                      if s > seq - self.window}
+        return True
+
+    def highs(self):
+        """Return the highest sequence number seen from each origin."""
+        return dict(self._highs)
+
+
+class PeerLink():
+    """Stand-in for the nodes reachable through a peer broker.
+
+    The link survives the connection: when the connection is lost, the
+    link is kept until the federation timeout expires.
+    """
+
+    def __init__(self, federation, peer_id):
+        self.federation = federation
+        self.peer_id = peer_id
+        self.connection = None
+        self.expiry = None
+
+    def send(self, text):
+        """Send a text message to the peer broker, if connected."""
+        if self.connection is None:
+            return
+        try:
+            self.connection.write_message(text)
+        except WebSocketClosedError:
+            logger.debug("Connection with peer '%s' closed", self.peer_id)
+
+    def write_message(self, message):
+        """Forward a client message to the peers.
+
+        Client messages are published to all peers: the one owning the
+        node applies it, the others relay it.
+        """
+        self.federation.publish("client", message)
+
+
+class Federation():
+    """Relay node messages between peered brokers.
+
+    :param broker: the broker application
+    :param broker_id: the stable id of the broker, used to recognize a
+                      peer when its link comes back
+    :param peers: websocket urls of the peer brokers to connect to
+    :param timeout: delay in seconds before the nodes behind a lost link
+                    are removed
+    :param replay_size: number of messages kept to be replayed to a peer
+                        whose link was lost
+    """
+
+    def __init__(self, broker, broker_id, keys, peers=(),
+                 timeout=PEER_TIMEOUT, replay_size=REPLAY_SIZE):
+        self.broker = broker
+        self.id = broker_id
+        # Sequence numbers restart with the process: identify them by an
+        # origin unique to this instance.
+        self.origin = uuid.uuid4().hex
+        self.keys = keys
+        self.peers = peers
+        self.timeout = timeout
+        self.links = {}
+        self.connections = {}
+        self.filter = SequenceFilter()
+        self.log = deque(maxlen=replay_size)
+        self._seq = 0
+
+    def start(self):
+        """Connect to the configured peer brokers."""
+        for url in self.peers:
+            self.connect(url)
+
+    @gen.coroutine
+    def connect(self, url):
+        """Keep a connection opened with a peer broker."""
+        while True:
+            try:
+                connection = yield websocket_connect(url)
+            except Exception as error:
+                # Handshake errors are retried like network errors
+                logger.warning("Cannot connect to peer '%s' (%s), retrying "
+                               "in %ss", url, error, RECONNECT_DELAY)
+            else:
+                logger.info("Connected to peer '%s'", url)
+                connection.write_message(auth_token(self.keys))
+                self.open(connection)
+                while True:
+                    text = yield connection.read_message()
+                    if text is None:
+                        logger.warning("Connection with peer '%s' lost", url)
+                        break
+                    self.on_connection_message(connection, text)
+                self.close(connection)
+            yield gen.sleep(RECONNECT_DELAY)
+
+    def open(self, connection):
+        """Start the exchange on an authenticated peer connection."""
+        connection.write_message(codec.dumps(
+            {'type': "hello", 'id': self.id, 'seen': self.filter.highs()}))
+
+    def close(self, connection):
+        """Detach a lost connection from its link and start the timeout."""
+        link = self.connections.pop(connection, None)
+        if link is None or link.connection is not connection:
+            return
+        link.connection = None
+        link.expiry = IOLoop.current().call_later(
+            self.timeout, self.expire, link)
+
+    def expire(self, link):
+        """Remove a link that didn't come back in time."""
+        logger.info("Peer '%s' is gone", link.peer_id)
+        if self.links.get(link.peer_id) is link:
+            self.links.pop(link.peer_id)
+        self.broker.remove_ws(link)
+
+    def on_connection_message(self, connection, text):
+        """Handle a text message received on a peer connection."""
+        try:
+            message = codec.loads(text)
+        except ValueError:
+            message = None
+        if not isinstance(message, dict):
+            logger.debug("Invalid message received from peer")
+            return
+        link = self.connections.get(connection)
+        if message.get('type') == "hello":
+            self.on_hello(connection, message)
+        elif link is None:
+            logger.debug("Peer message received before hello")
+        elif message.get('type') == "relay":
+            self.on_relay(link, message)
+        elif message.get('type') == "sync":
+            nodes = message.get('nodes')
+            if isinstance(nodes, dict):
+                self.broker.on_peer_sync(link, nodes)
+
+    def on_hello(self, connection, message):
+        """Attach a connection to the link of a peer and bring it up to date.
+
+        The first time a peer is seen, it receives the state of all known
+        nodes. A known peer only receives the messages it missed.
+        """
+        peer_id, seen = message.get('id'), message.get('seen')
+        if (not isinstance(peer_id, str) or peer_id == self.id or
+                not isinstance(seen, dict)):
+            logger.debug("Invalid peer hello, closing connection")
+            connection.close()
+            return
+        link = self.links.get(peer_id)
+        missed = None
+        if link is None:
+            logger.info("New peer '%s'", peer_id)
+            link = PeerLink(self, peer_id)
+            self.links.update({peer_id: link})
+            self.broker.gateways.add(link)
+        else:
+            logger.info("Peer '%s' is back", peer_id)
+            if link.expiry is not None:
+                IOLoop.current().remove_timeout(link.expiry)
+                link.expiry = None
+            missed = self.missed(link, seen)
+        link.connection = connection
+        self.connections.update({connection: link})
+
+        if missed is None:
+            nodes = {uid: self.broker.cache.resources(uid)
+                     for gw, uids in self.broker.gateways.items()
+                     if gw is not link
+                     for uid in uids if uid in self.broker.cache}
+            link.send(codec.dumps({'type': "sync", 'nodes': nodes}))
+        else:
+            for text in missed:
+                link.send(text)
+
+    def missed(self, link, seen):
+        """Return the messages a peer missed, None if some were dropped.
+
+        :param seen: the highest sequence number the peer saw from each
+                     origin
+        """
+        first = {}
+        for origin, seq, kind, text in self.log:
+            first.setdefault(origin, seq)
+        highs = self.filter.highs()
+        highs.update({self.origin: self._seq})
+        for origin, high in highs.items():
+            last = seen.get(origin, 0)
+            if not isinstance(last, int):
+                return None
+            if high > last and first.get(origin, high + 1) > last + 1:
+                return None
+        # Commands are not replayed: they would be applied late.
+        return [text for origin, seq, kind, text in self.log
+                if kind != "client" and seq > seen.get(origin, 0)]
+
+    def on_relay(self, link, message):
+        """Handle a message relayed by a peer and relay it further."""
+        origin, seq = message.get('origin'), message.get('seq')
+        hops, kind = message.get('hops'), message.get('kind')
+        if (not isinstance(seq, int) or not isinstance(hops, int) or
+                kind not in ("gateway", "client", "lost") or
+                not isinstance(message.get('message'), dict)):
+            logger.debug("Invalid relay message received from peer")
+            return
+        if origin == self.origin or not self.filter.check(origin, seq):
+            return
+        raw = Message.serialize(message['message'])
+        if kind != "lost" and hops + 1 < MAX_HOPS:
+            text = relay_message(origin, seq, hops + 1, kind, raw)
+            self.log.append((origin, seq, kind, text))
+            self.send(text, exclude=link)
+        self.broker.on_peer_message(link, kind, raw)
+
+    def publish(self, kind, raw, exclude=None):
+        """Relay a message originating from this broker to the peers."""
+        if not self.links:
+            return
+        self._seq += 1
+        text = relay_message(self.origin, self._seq, 0, kind, raw)
+        self.log.append((self.origin, self._seq, kind, text))
+        self.send(text, exclude=exclude)
+
+    def send(self, text, exclude=None):
+        """Send a text message to all the peers except one."""
+        for link in self.links.values():
+            if link is not exclude:
+                link.send(text)
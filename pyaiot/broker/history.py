@@ -0,0 +1,219 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Broker node history module."""
+
+import re
+import logging
+import numbers
+from array import array
+from bisect import bisect_left, bisect_right
+from tornado import web
+
+from pyaiot.common.messaging import codec
+
+logger = logging.getLogger("pyaiot.broker.history")
+
+HISTORY_DEPTH = 100
+
+# A number followed by an optional unit, e.g '22.5°C' or '1013hPa'
+_NUMBER = re.compile(
+    r'\s*([-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?)\s*(\D*)$')
+
+
+def parse_number(value):
+    """Return the number and the unit of a value, or None.
+
+    >>> parse_number('22.5°C'), parse_number(3), parse_number('on')
+    ((22.5, '°C'), (3.0, ''), None)
+    """
+    if isinstance(value, numbers.Real) and not isinstance(value, bool):
+        return float(value), ''
+    if isinstance(value, str):
+        match = _NUMBER.match(value)
+        if match is not None:
+            return float(match.group(1)), match.group(2).strip()
+    return None
+
+
+class Series():
+    """Ring buffer of the last values of a node endpoint.
+
+    The values are stored as doubles while they are numbers with the same
+    unit, as the received values otherwise.
+    """
+
+    __slots__ = ('depth', 'times', 'values', 'unit', '_next')
+
+    def __init__(self, depth):
+        self.depth = depth
+        self.times = array('d')
+        self.values = array('d')
+        self.unit = None
+        self._next = 0
+
+    @property
+    def numeric(self):
+        return isinstance(self.values, array)
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, time, value):
+        """Add a value received at time, replacing the oldest one if full."""
+        if self.numeric:
+            number = parse_number(value)
+            if (number is not None and
+                    (self.unit is None or number[1] == self.unit)):
+                self.unit = number[1]
+                value = number[0]
+            else:
+                # Keep the values as received from now on
+                self.values = [self._format(number) for number
+                               in self.values]
+                self.unit = None
+        if len(self.times) < self.depth:
+            self.times.append(time)
+            self.values.append(value)
+            return
+        self.times[self._next] = time
+        self.values[self._next] = value
+        self._next = (self._next + 1) % self.depth
+
+    def _format(self, number):
+        if number.is_integer():
+            number = int(number)
+        return "{}{}".format(number, self.unit)
+
+    def items(self, since=None, until=None, limit=None):
+        """Return the [time, value] pairs in a time range, oldest first.
+
+        :param limit: only return the most recent ones
+        """
+        times = self.times[self._next:] + self.times[:self._next]
+        values = self.values[self._next:] + self.values[:self._next]
+        start = 0 if since is None else bisect_left(times, since)
+        end = len(times) if until is None else bisect_right(times, until)
+        if limit is not None:
+            start = max(start, end - limit)
+        return [[times[index], values[index]]
+                for index in range(start, end)]
+
+
+class History():
+    """Last values of the endpoints of the nodes behind the gateways.
+
+    Like the node cache, the history is built from the messages of the
+    gateways: only the updates pushed by the nodes are recorded.
+
+    >>> from pyaiot.common.messaging import OutMessage, UpdateMessage
+    >>> history = History(depth=2)
+    >>> for time, value in enumerate(['21°C', '22°C', '23°C']):
+    ...     history.update(UpdateMessage('1234', 'temperature', value), time)
+    >>> history.series('1234', 'temperature').items()
+    [[1.0, 22.0], [2.0, 23.0]]
+    >>> history.update(OutMessage('1234'), 3)
+    >>> history.series('1234', 'temperature') is None
+    True
+    """
+
+    def __init__(self, depth=HISTORY_DEPTH):
+        self.depth = depth
+        self._nodes = {}
+
+    def __len__(self):
+        return sum(len(endpoints) for endpoints in self._nodes.values())
+
+    def series(self, uid, endpoint):
+        """Return the series of a node endpoint, None if unknown."""
+        return self._nodes.get(uid, {}).get(endpoint)
+
+    def endpoints(self, uid):
+        """Return a dict with the series of each endpoint of a node."""
+        return dict(self._nodes.get(uid, {}))
+
+    def update(self, message, time):
+        """Update the history with a node message received at time."""
+        if self.depth <= 0:
+            return
+        if message.type == 'update' and message.dst == 'all':
+            endpoints = self._nodes.setdefault(message.uid, {})
+            series = endpoints.get(message.endpoint)
+            if series is None:
+                series = endpoints[message.endpoint] = Series(self.depth)
+            series.append(time, message.data)
+        elif message.type == 'out':
+            self.remove(message.uid)
+
+    def remove(self, uid):
+        """Remove the history of a node."""
+        self._nodes.pop(uid, None)
+
+
+class BrokerHistoryHandler(web.RequestHandler):
+    """Return the history of the endpoints of a node as JSON.
+
+    Query arguments: the node 'uid', an optional 'endpoint', the 'since'
+    and 'until' times in seconds since the epoch and the 'limit' number of
+    values per endpoint.
+    """
+
+    def set_default_headers(self):
+        # The dashboard is served from another origin
+        self.set_header("Access-Control-Allow-Origin", "*")
+
+    def _argument(self, name, kind):
+        value = self.get_query_argument(name, None)
+        if value is None:
+            return None
+        try:
+            return kind(value)
+        except ValueError:
+            raise web.HTTPError(400, "Invalid {}: '{}'".format(name, value))
+
+    def get(self):
+        history = self.application.history
+        uid = self.get_query_argument('uid')
+        endpoint = self.get_query_argument('endpoint', None)
+        since = self._argument('since', float)
+        until = self._argument('until', float)
+        limit = self._argument('limit', int)
+        if endpoint is None:
+            endpoints = history.endpoints(uid)
+        else:
+            series = history.series(uid, endpoint)
+            endpoints = {endpoint: series} if series is not None else {}
+        if not endpoints:
+            raise web.HTTPError(404, "No history for node '{}'".format(uid))
+        self.set_header("Content-Type", "application/json")
+        self.write(codec.dumps({
+            'uid': uid,
+            'endpoints': {name: {'unit': series.unit,
+                                 'values': series.items(since, until, limit)}
+                          for name, series in endpoints.items()}}))
@@ -0,0 +1,118 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Broker metrics module."""
+
+from tornado import web
+
+from pyaiot.common.metrics import CONTENT_TYPE, SIZE_BUCKETS, Registry
+
+
+class BrokerMetrics():
+    """Metrics of a broker, rendered by its /metrics handler.
+
+    The message counters and histograms are updated by the broker, the
+    connections, queues and authentication gauges are read from the broker
+    when the metrics are rendered.
+
+    :param labels: a dict of labels added to all the samples
+    """
+
+    def __init__(self, broker, labels=None):
+        self.broker = broker
+        self.registry = registry = Registry(labels)
+        self.received = registry.counter(
+            "pyaiot_broker_messages_received_total",
+            "Messages received, by source and type.", ("source", "type"))
+        self.sent = registry.counter(
+            "pyaiot_broker_messages_sent_total",
+            "Messages queued for the clients, by type.", ("type",))
+        self.fanout = registry.histogram(
+            "pyaiot_broker_broadcast_fanout",
+            "Number of clients a message is broadcast to.", SIZE_BUCKETS)
+        self.written = registry.counter(
+            "pyaiot_broker_written_bytes_total",
+            "Payload bytes written to the clients, before compression.")
+        self.dropped = registry.counter(
+            "pyaiot_broker_client_queue_dropped_total",
+            "Messages dropped by the outbound queues of the clients.")
+        self.handler_seconds = registry.histogram(
+            "pyaiot_broker_handler_seconds",
+            "Time spent handling a message, by handler.",
+            labels=("handler",))
+        registry.gauge(
+            "pyaiot_broker_connections",
+            "Open connections, by type.", ("type",),
+            collect=self._connections)
+        registry.gauge(
+            "pyaiot_broker_nodes", "Nodes known by the broker.",
+            collect=lambda: {(): len(broker.cache)})
+        registry.gauge(
+            "pyaiot_broker_client_queue_depth",
+            "Messages waiting in the outbound queues of all clients.",
+            collect=lambda: {(): sum(self._queue_depths())})
+        registry.gauge(
+            "pyaiot_broker_client_queue_depth_max",
+            "Messages waiting in the longest client outbound queue.",
+            collect=lambda: {(): max(self._queue_depths(), default=0)})
+        registry.gauge(
+            "pyaiot_broker_auth_pending",
+            "Connections waiting for their authentication token.",
+            collect=lambda: {(): broker.authenticator.pending()})
+        registry.counter(
+            "pyaiot_broker_auth_failures_total",
+            "Failed authentications, by reason.", ("reason",),
+            collect=lambda: {(reason,): count for reason, count
+                             in broker.authenticator.failures.items()})
+
+    def _connections(self):
+        counts = {(kind,): 0 for kind in ("gateway", "peer", "worker")}
+        counts[("client",)] = len(self.broker.clients)
+        for kind in self.broker.gateway_kinds():
+            counts[(kind,)] += 1
+        return counts
+
+    def _queue_depths(self):
+        return [len(client.queue) for client in self.broker.clients.values()]
+
+    def render(self):
+        """Return the text exposition of the metrics."""
+        return self.registry.render()
+
+
+class BrokerMetricsHandler(web.RequestHandler):
+    """Render the metrics of the broker in the Prometheus text format.
+
+    With several workers, only the metrics of the worker handling the
+    request are rendered.
+    """
+
+    def get(self):
+        self.set_header("Content-Type", CONTENT_TYPE)
+        self.write(self.application.metrics.render())
@@ -0,0 +1,258 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Broker per-client outbound queue module."""
+
+import itertools
+import logging
+from collections import OrderedDict
+
+from tornado.ioloop import IOLoop
+from tornado.websocket import WebSocketClosedError
+
+from pyaiot.common.batch import BATCH_MAX_SIZE
+from pyaiot.common.messaging import Message
+
+from .fanout import (encode_frame, can_share_frame, payload_size,
+                     write_frame)
+
+logger = logging.getLogger("pyaiot.broker.outbound")
+
+QUEUE_SIZE = 1000
+QUEUE_POLICIES = ('drop-oldest', 'conflate', 'disconnect')
+
+
+class OutboundQueue():
+    """Bounded queue of the messages waiting to be written to a client.
+
+    Only one write is in flight at a time on the client connection: messages
+    received in the mean time are queued and written together once the
+    previous write is flushed to the socket. When the queue is full, the
+    policy decides what happens:
+
+    - 'drop-oldest': the oldest pending message is dropped,
+    - 'conflate': a pending update of the same node endpoint is replaced by
+      the new one, the oldest pending message is dropped otherwise,
+    - 'disconnect': the client connection is closed.
+
+    When batch_delay (in seconds) is set, messages are kept in the queue
+    until the delay expires or until their total size reaches
+    batch_max_size, then they are written in batch messages.
+
+    On a compressed connection, messages smaller than compression_threshold
+    are written uncompressed, using their pre-encoded frame.
+
+    The bytes written are the payload bytes of the frames, before
+    compression and without the frame headers. They are also added to
+    bytes_counter, a metrics counter shared by the queues, when given. The
+    dropped messages are likewise added to dropped_counter.
+    """
+
+    def __init__(self, handler, maxsize=QUEUE_SIZE, policy='drop-oldest',
+                 batch_delay=None, batch_max_size=BATCH_MAX_SIZE,
+                 compression_threshold=0, bytes_counter=None,
+                 dropped_counter=None):
+        if policy not in QUEUE_POLICIES:
+            raise ValueError("Invalid outbound queue policy '{}'"
+                             .format(policy))
+        self.handler = handler
+        self.maxsize = maxsize
+        self.policy = policy
+        self.closed = False
+        self.dropped = 0
+        self.conflated = 0
+        self.max_depth = 0
+        self.written = 0
+        self.bytes_counter = bytes_counter
+        self.dropped_counter = dropped_counter
+        self.batch_delay = batch_delay
+        self.batch_max_size = batch_max_size
+        self.compression_threshold = compression_threshold
+        self._pending = OrderedDict()
+        self._pending_size = 0
+        self._sequence = itertools.count()
+        self._writing = False
+        self._timeout = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def stats(self):
+        """Return the queue counters."""
+        return {'depth': len(self._pending),
+                'max_depth': self.max_depth,
+                'dropped': self.dropped,
+                'conflated': self.conflated}
+
+    def put(self, message, frame=None, key=None):
+        """Queue a message and its pre-encoded frame for writing.
+
+        :param key: the (uid, endpoint) of a node update, used for conflation
+
+        :return False if the message was not queued, True otherwise
+        """
+        if self.closed:
+            return False
+
+        if (self.batch_delay is None and
+                not self._writing and not self._pending):
+            # Nothing is waiting: write the message right away
+            self._write(((message, frame),))
+            return True
+
+        if key is None or self.policy != 'conflate':
+            key = next(self._sequence)
+        elif key in self._pending:
+            # Remove the previous value: the new one is queued at the end so
+            # it keeps its order relative to other messages of the node.
+            previous, _ = self._pending.pop(key)
+            self._pending_size -= len(previous)
+            self.conflated += 1
+
+        if len(self._pending) >= self.maxsize:
+            if self.policy == 'disconnect':
+                self._overflow()
+                return False
+            _, (previous, _) = self._pending.popitem(last=False)
+            self._pending_size -= len(previous)
+            self._drop(1)
+
+        self._pending[key] = (message, frame)
+        self._pending_size += len(message)
+        self.max_depth = max(self.max_depth, len(self._pending))
+        if self.batch_delay is not None and not self._writing:
+            if self._pending_size >= self.batch_max_size:
+                self.flush()
+            elif self._timeout is None:
+                self._timeout = IOLoop.current().call_later(
+                    self.batch_delay, self._on_timeout)
+        return True
+
+    def flush(self):
+        """Write all pending messages if no write is in flight."""
+        if self._writing or self.closed or not self._pending:
+            return
+
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+        entries = list(self._pending.values())
+        self._pending.clear()
+        self._pending_size = 0
+        self._write(entries)
+
+    def _batches(self, entries):
+        """Group entries in batch messages of bounded size."""
+        batch, size = [], 0
+        for message, frame in entries:
+            if batch and size + len(message) > self.batch_max_size:
+                yield self._batch_entry(batch)
+                batch, size = [], 0
+            batch.append((message, frame))
+            size += len(message)
+        if batch:
+            yield self._batch_entry(batch)
+
+    @staticmethod
+    def _batch_entry(batch):
+        if len(batch) == 1:
+            return batch[0]
+        return Message.batch([message for message, _ in batch]), None
+
+    def _write(self, entries):
+        if self.batch_delay is not None and len(entries) > 1:
+            entries = list(self._batches(entries))
+        try:
+            written = sum(payload_size(message) for message, _ in entries)
+            if can_share_frame(self.handler):
+                frames = [encode_frame(message) if frame is None else frame
+                          for message, frame in entries]
+                data = frames[0] if len(frames) == 1 else b''.join(frames)
+                future = write_frame(self.handler, data)
+            else:
+                for message, frame in entries:
+                    if len(message) < self.compression_threshold:
+                        future = write_frame(
+                            self.handler,
+                            encode_frame(message) if frame is None else frame)
+                    else:
+                        future = self.handler.write_message(message)
+        except WebSocketClosedError:
+            self.close()
+            return
+
+        self.written += written
+        if self.bytes_counter is not None:
+            self.bytes_counter.inc(written)
+
+        if future is None:
+            return
+        if future.done():
+            # The data was directly written to the socket
+            if self._failed(future):
+                self.close()
+            return
+        self._writing = True
+        IOLoop.current().add_future(future, self._on_written)
+
+    def close(self):
+        """Stop queuing messages and drop the pending ones."""
+        self.closed = True
+        self._pending.clear()
+        self._pending_size = 0
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+
+    @staticmethod
+    def _failed(future):
+        return future.cancelled() or future.exception() is not None
+
+    def _on_timeout(self):
+        self._timeout = None
+        self.flush()
+
+    def _on_written(self, future):
+        self._writing = False
+        if self._failed(future):
+            self.close()
+            return
+        self.flush()
+
+    def _drop(self, count):
+        self.dropped += count
+        if self.dropped_counter is not None:
+            self.dropped_counter.inc(count)
+
+    def _overflow(self):
+        logger.warning("Outbound queue of client '%s' is full, closing.",
+                       self.handler.uid)
+        self._drop(len(self._pending) + 1)
+        self.close()
+        self.handler.close(code=1008, reason="Client too slow.")
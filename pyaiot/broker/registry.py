@@ -0,0 +1,113 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Broker gateways registry module."""
+
+import logging
+
+logger = logging.getLogger("pyaiot.broker.registry")
+
+
+class GatewayRegistry():
+    """Index of the gateways and of the nodes they own.
+
+    A node is owned by a single gateway: when another gateway reports it,
+    the node is moved to this gateway.
+
+    >>> registry = GatewayRegistry()
+    >>> registry.add('gw1')
+    >>> registry.add('gw2')
+    >>> registry.add_node('gw1', '1234')
+    >>> registry.owner('1234'), registry.owns('gw2', '1234')
+    ('gw1', False)
+    >>> registry.add_node('gw2', '1234')
+    >>> registry.owner('1234'), registry.nodes('gw1')
+    ('gw2', set())
+    >>> registry.remove('gw2')
+    {'1234'}
+    >>> registry.owner('1234') is None
+    True
+    """
+
+    def __init__(self):
+        self._nodes = {}
+        self._owners = {}
+
+    def add(self, gateway):
+        """Register a gateway, owning no node yet."""
+        self._nodes.setdefault(gateway, set())
+
+    def remove(self, gateway):
+        """Unregister a gateway and return the uids of the nodes it owned."""
+        uids = self._nodes.pop(gateway, set())
+        for uid in uids:
+            self._owners.pop(uid, None)
+        return uids
+
+    def add_node(self, gateway, uid):
+        """Make a gateway the owner of a node."""
+        owner = self._owners.get(uid)
+        if owner is gateway:
+            return
+        if owner is not None:
+            logger.debug("Node '%s' moved to another gateway", uid)
+            self._nodes[owner].discard(uid)
+        self._nodes[gateway].add(uid)
+        self._owners[uid] = gateway
+
+    def remove_node(self, gateway, uid):
+        """Remove a node owned by a gateway."""
+        if self._owners.get(uid) is gateway:
+            self._owners.pop(uid)
+            self._nodes[gateway].discard(uid)
+
+    def owner(self, uid):
+        """Return the gateway owning a node, None if the node is unknown."""
+        return self._owners.get(uid)
+
+    def owns(self, gateway, uid):
+        """Return True if the gateway owns the node."""
+        return self._owners.get(uid) is gateway
+
+    def nodes(self, gateway):
+        """Return the uids of the nodes owned by a gateway."""
+        return self._nodes[gateway]
+
+    def items(self):
+        """Return the list of (gateway, uids) pairs."""
+        return list(self._nodes.items())
+
+    def __iter__(self):
+        return iter(list(self._nodes))
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def __contains__(self, gateway):
+        return gateway in self._nodes
@@ -0,0 +1,156 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Broker client sessions module.
+
+A client asking for a session when it connects receives a session id and
+a sequence number in every message sent to it afterwards. When its
+connection is lost, the session is kept for a while: a client reconnecting
+with its session id and the last sequence number it received only gets the
+messages it missed, replayed from a window of the last broadcast messages.
+When the missed messages are not available anymore, the client gets a
+snapshot of the nodes instead, like a new client.
+
+The sequence numbers are shared by all the clients of the broker: each
+broadcast message gets the next number, so that its websocket frame is
+still encoded once for all the clients. A message sent to a single client
+carries the number of the last broadcast message and is not replayed.
+"""
+
+import logging
+from collections import deque
+
+from tornado.ioloop import IOLoop
+
+from pyaiot.common.messaging import codec
+
+logger = logging.getLogger("pyaiot.broker.sessions")
+
+WINDOW_SIZE = 1000
+SESSION_TIMEOUT = 60
+
+
+def stamp(text, seq):
+    """Insert a sequence number in a JSON text message.
+
+    >>> stamp('{"type": "out", "uid": "n"}', 3)
+    '{"seq": 3, "type": "out", "uid": "n"}'
+    """
+    comma, colon = codec.separators
+    return '{{"seq"{1}{2}{0}'.format(comma, colon, seq) + text.lstrip()[1:]
+
+
+class Sessions():
+    """Sessions of the clients and window of the last broadcast messages.
+
+    >>> sessions = Sessions(window_size=2)
+    >>> [sessions.record(text) for text in ('{"a": 1}', '{"b": 2}')]
+    [1, 2]
+    >>> sessions.missed(0) is None, sessions.missed(2)
+    (False, [])
+    >>> sessions.record('{"c": 3}'), sessions.missed(0) is None
+    (3, True)
+    >>> [entry[1] for entry in sessions.missed(1)]
+    ['{"b": 2}', '{"c": 3}']
+
+    :param window_size: number of broadcast messages kept to be replayed
+    :param timeout: delay in seconds before the session of a disconnected
+                    client is forgotten
+    """
+
+    def __init__(self, window_size=WINDOW_SIZE, timeout=SESSION_TIMEOUT):
+        self.timeout = timeout
+        self.seq = 0
+        self._window = deque(maxlen=window_size)
+        self._active = set()
+        self._detached = {}
+
+    def __contains__(self, uid):
+        return uid in self._active
+
+    def record(self, text, node_uid=None, endpoint=None, nodes=None):
+        """Number a broadcast message and keep it in the window.
+
+        :param node_uid: the uid of the node the message is about
+        :param endpoint: the node endpoint, for update messages
+        :param nodes: the nodes dict, for snapshot messages
+        :return the sequence number of the message
+        """
+        self.seq += 1
+        self._window.append((self.seq, text, node_uid, endpoint, nodes))
+        return self.seq
+
+    def missed(self, seq):
+        """Return the window entries following a sequence number.
+
+        :return a list of (seq, text, node_uid, endpoint, nodes) tuples or
+                None if some of the missed messages are not available
+        """
+        first = self._window[0][0] if self._window else self.seq + 1
+        if seq < first - 1 or seq > self.seq:
+            return None
+        return [entry for entry in self._window if entry[0] > seq]
+
+    def open(self, uid):
+        """Start numbering the messages sent to a client."""
+        self._active.add(uid)
+
+    def detach(self, uid, filters):
+        """Keep the session of a disconnected client until it expires.
+
+        :param filters: the subscriptions of the client, restored when the
+                        session is resumed
+        """
+        self._active.discard(uid)
+        expiry = IOLoop.current().call_later(self.timeout, self._expire, uid)
+        self._detached[uid] = (filters, expiry)
+
+    def resume(self, uid, seq):
+        """Reattach a disconnected client to its session.
+
+        :return the subscriptions of the client and the missed window
+                entries, None if the session is unknown or if some of the
+                missed messages are not available anymore
+        """
+        if uid not in self._detached:
+            logger.debug("Unknown client session '%s'", uid)
+            return None
+        missed = self.missed(seq)
+        filters, expiry = self._detached.pop(uid)
+        IOLoop.current().remove_timeout(expiry)
+        if missed is None:
+            logger.debug("Messages missed by client session '%s' are not "
+                         "available anymore", uid)
+            return None
+        self._active.add(uid)
+        return filters, missed
+
+    def _expire(self, uid):
+        if self._detached.pop(uid, None) is not None:
+            logger.info("Client session '%s' expired", uid)
@@ -0,0 +1,184 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Broker client subscriptions module."""
+
+import logging
+
+logger = logging.getLogger("pyaiot.broker.subscriptions")
+
+WILDCARD = '*'
+
+
+def parse_filters(data):
+    """Return the list of (uid, endpoint) filters contained in data.
+
+    :param data: a filter or a list of filters. A filter is a dict with
+                 optional 'uid' and 'endpoint' keys, a missing key or '*'
+                 matches anything.
+
+    :return the list of filters or None if data is invalid
+
+    >>> parse_filters({'uid': '1234', 'endpoint': 'temperature'})
+    [('1234', 'temperature')]
+    >>> parse_filters([{'uid': '1234'}, {'endpoint': 'led'}])
+    [('1234', '*'), ('*', 'led')]
+    >>> parse_filters('1234') is None
+    True
+    >>> parse_filters([{'uid': 1234}]) is None
+    True
+    """
+    if isinstance(data, dict):
+        data = [data]
+    if not isinstance(data, list):
+        logger.debug("Invalid subscription data: not a list")
+        return None
+
+    filters = []
+    for item in data:
+        if not isinstance(item, dict):
+            logger.debug("Invalid subscription filter: not a dict")
+            return None
+        uid = item.get('uid', WILDCARD)
+        endpoint = item.get('endpoint', WILDCARD)
+        if not isinstance(uid, str) or not isinstance(endpoint, str):
+            logger.debug("Invalid subscription filter: uid and endpoint "
+                         "should be strings")
+            return None
+        filters.append((uid, endpoint))
+    return filters
+
+
+class Subscriptions():
+    """Index of the client subscriptions to node endpoints.
+
+    A client that never subscribed receives everything. Once a client has
+    subscribed, it only receives the node updates matching its filters and
+    the presence messages (new, out, reset) of the nodes its filters refer
+    to.
+
+    Lookups are done on inverted indexes, (uid, endpoint) -> clients and
+    uid -> clients, so their cost only depends on the number of interested
+    clients.
+    """
+
+    def __init__(self):
+        self.unfiltered = set()
+        self._filters = {}
+        self._endpoints = {}
+        self._nodes = {}
+
+    def __contains__(self, client):
+        return client in self._filters
+
+    def add(self, client):
+        """Register a client, receiving everything until it subscribes."""
+        if client not in self._filters:
+            self.unfiltered.add(client)
+
+    def remove(self, client):
+        """Forget a client and all its subscriptions."""
+        self.unfiltered.discard(client)
+        self._update(client, set())
+        self._filters.pop(client, None)
+
+    def filters(self, client):
+        """Return the filters of a client, None if it never subscribed."""
+        return self._filters.get(client)
+
+    def subscribe(self, client, filters):
+        """Add (uid, endpoint) filters to a client subscriptions."""
+        self.unfiltered.discard(client)
+        current = self._filters.get(client, set())
+        self._update(client, current | set(filters))
+
+    def unsubscribe(self, client, filters):
+        """Remove (uid, endpoint) filters from a client subscriptions."""
+        if client not in self._filters:
+            return
+        self._update(client, self._filters[client] - set(filters))
+
+    def match(self, uid, endpoint):
+        """Return the subscribed clients interested in a node endpoint."""
+        result = set()
+        for key in ((uid, endpoint), (uid, WILDCARD),
+                    (WILDCARD, endpoint), (WILDCARD, WILDCARD)):
+            result.update(self._endpoints.get(key, ()))
+        return result
+
+    def match_node(self, uid):
+        """Return the subscribed clients interested in a node."""
+        return (self._nodes.get(uid, set()) |
+                self._nodes.get(WILDCARD, set()))
+
+    def accepts(self, client, uid, endpoint=None):
+        """Check if a client wants to receive a message about a node."""
+        filters = self._filters.get(client)
+        if filters is None:
+            return True
+        return any((f_uid == WILDCARD or f_uid == uid) and
+                   (endpoint is None or f_endpoint == WILDCARD or
+                    f_endpoint == endpoint)
+                   for f_uid, f_endpoint in filters)
+
+    def filter_nodes(self, client, nodes):
+        """Return the part of a nodes dict a client is subscribed to.
+
+        :param nodes: a dict mapping node uids to their resources dict
+        """
+        if client not in self._filters:
+            return nodes
+        return {uid: {endpoint: value
+                      for endpoint, value in resources.items()
+                      if self.accepts(client, uid, endpoint)}
+                for uid, resources in nodes.items()
+                if self.accepts(client, uid)}
+
+    def _update(self, client, filters):
+        previous = self._filters.get(client, set())
+        for key in previous - filters:
+            self._discard(self._endpoints, key, client)
+        for key in filters - previous:
+            self._endpoints.setdefault(key, set()).add(client)
+        previous_uids = set(uid for uid, _ in previous)
+        uids = set(uid for uid, _ in filters)
+        for uid in previous_uids - uids:
+            self._discard(self._nodes, uid, client)
+        for uid in uids - previous_uids:
+            self._nodes.setdefault(uid, set()).add(client)
+        self._filters[client] = filters
+
+    @staticmethod
+    def _discard(index, key, client):
+        clients = index.get(key)
+        if clients is None:
+            return
+        clients.discard(client)
+        if not clients:
+            del index[key]
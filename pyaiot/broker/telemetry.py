@@ -0,0 +1,269 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Broker telemetry log module.
+
+The node messages handled by the broker are appended to a log on disk,
+split in segment files named after the time of their first record. A
+record is a header, with the time the broker received the message, the
+length and the CRC32 of the message, followed by the message text.
+
+Records are buffered and written at most once per sync delay, or when the
+buffer is full, then the segment is synced to the disk in a thread. The
+syncs and closes of the segments are done in order, by a single thread, so
+a file descriptor is never synced after it was closed.
+Segments are read through mmap: a time range scan only reads the headers
+of the records before the range, and the segments outside of it are not
+opened.
+"""
+
+import os
+import mmap
+import time
+import zlib
+import struct
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from tornado.ioloop import IOLoop
+
+from pyaiot.common.messaging import NodeMessage
+
+logger = logging.getLogger("pyaiot.broker.telemetry")
+
+SEGMENT_SIZE = 16 * 1024 * 1024
+RETENTION_SIZE = 1024 * 1024 * 1024
+RETENTION_AGE = 7 * 24 * 3600  # s
+SYNC_DELAY = 1000  # ms
+BUFFER_SIZE = 64 * 1024
+EXPIRE_INTERVAL = 60  # s
+
+# Time (s), length and CRC32 of the message
+_HEADER = struct.Struct('<dII')
+_SUFFIX = '.log'
+
+
+def _segment_name(timestamp):
+    return "{:017d}{}".format(int(timestamp * 1e6), _SUFFIX)
+
+
+def _close_segment(fd):
+    os.fsync(fd)
+    os.close(fd)
+
+
+def segments(directory):
+    """Return the (start time, path) of the log segments, oldest first."""
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+    return [(int(name[:-len(_SUFFIX)]) / 1e6, os.path.join(directory, name))
+            for name in sorted(names)
+            if name.endswith(_SUFFIX) and name[:-len(_SUFFIX)].isdigit()]
+
+
+def read_segment(path, since=None, until=None):
+    """Yield the (time, text) records of a segment in a time range.
+
+    The reading stops at the first truncated or corrupted record, which
+    can be the last one after a crash.
+    """
+    with open(path, 'rb') as segment:
+        try:
+            data = mmap.mmap(segment.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty segment
+            return
+    with data:
+        offset, end = 0, len(data)
+        while offset + _HEADER.size <= end:
+            timestamp, length, crc = _HEADER.unpack_from(data, offset)
+            start = offset + _HEADER.size
+            offset = start + length
+            if length == 0 or offset > end:
+                logger.warning("Truncated record in %s", path)
+                return
+            if until is not None and timestamp > until:
+                return
+            if since is not None and timestamp < since:
+                continue
+            payload = data[start:offset]
+            if zlib.crc32(payload) != crc:
+                logger.warning("Corrupted record in %s", path)
+                return
+            yield timestamp, payload.decode('utf-8')
+
+
+def scan(directory, since=None, until=None):
+    """Yield the (time, text) records of a log in a time range."""
+    paths = segments(directory)
+    for index, (start, path) in enumerate(paths):
+        if until is not None and start > until:
+            return
+        # The records of a segment are older than the next segment
+        if (since is not None and index + 1 < len(paths) and
+                paths[index + 1][0] < since):
+            continue
+        yield from read_segment(path, since, until)
+
+
+def replay(directory, since=None, until=None):
+    """Yield the (time, NodeMessage) of a log in a time range."""
+    for timestamp, text in scan(directory, since, until):
+        message = NodeMessage.from_text(text)
+        if message is not None:
+            yield timestamp, message
+
+
+class TelemetryLog():
+    """Append-only log of the node messages received by the broker.
+
+    :param directory: the directory of the segment files
+    :param segment_size: the size in bytes above which a new segment is
+                         started
+    :param retention_size: the total size in bytes of the segments kept
+    :param retention_age: the age in seconds of the oldest records kept
+    :param sync_delay: the maximum delay in seconds before the records are
+                       synced to the disk
+    """
+
+    def __init__(self, directory, segment_size=SEGMENT_SIZE,
+                 retention_size=RETENTION_SIZE, retention_age=RETENTION_AGE,
+                 sync_delay=SYNC_DELAY / 1000):
+        self.directory = directory
+        self.segment_size = segment_size
+        self.retention_size = retention_size
+        self.retention_age = retention_age
+        self.sync_delay = sync_delay
+        self._fd = None
+        self._size = 0
+        self._buffer = []
+        self._buffered = 0
+        self._timeout = None
+        self._expired = 0
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        os.makedirs(directory, exist_ok=True)
+        self.expire()
+        paths = segments(directory)
+        self._last = paths[-1][0] if paths else 0
+
+    def append(self, message, timestamp):
+        """Append the text of a node message received at timestamp."""
+        payload = message.text.encode('utf-8')
+        record = _HEADER.pack(timestamp, len(payload),
+                              zlib.crc32(payload)) + payload
+        if self._fd is None or self._size + len(record) > self.segment_size:
+            self._rotate(timestamp)
+        self._buffer.append(record)
+        self._buffered += len(record)
+        self._size += len(record)
+        if self._buffered >= BUFFER_SIZE:
+            self.flush()
+        if self._timeout is None:
+            self._timeout = IOLoop.current().call_later(self.sync_delay,
+                                                        self.sync)
+
+    def flush(self):
+        """Write the buffered records to the current segment."""
+        if not self._buffer:
+            return
+        data = b''.join(self._buffer)
+        self._buffer, self._buffered = [], 0
+        try:
+            os.write(self._fd, data)
+        except OSError as exc:
+            logger.error("Cannot write telemetry log: %s", exc)
+
+    def _rotate(self, timestamp):
+        """Start a new segment, the current one is closed in a thread."""
+        if self._fd is not None:
+            self.flush()
+            future = IOLoop.current().run_in_executor(
+                self._executor, _close_segment, self._fd)
+            future.add_done_callback(self._synced)
+            self._fd = None
+        # Segment names must increase even if the clock goes back
+        timestamp = max(timestamp, self._last + 1e-6)
+        self._last = timestamp
+        path = os.path.join(self.directory, _segment_name(timestamp))
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+                           0o644)
+        self._size = 0
+        logger.debug("New telemetry log segment %s", path)
+        self.expire()
+
+    def sync(self):
+        """Sync the current segment to the disk, in a thread."""
+        self._timeout = None
+        if time.time() - self._expired > EXPIRE_INTERVAL:
+            self.expire()
+        if self._fd is None:
+            return
+        self.flush()
+        future = IOLoop.current().run_in_executor(self._executor, os.fsync,
+                                                  self._fd)
+        future.add_done_callback(self._synced)
+
+    def _synced(self, future):
+        if future.exception() is not None:
+            logger.debug("Telemetry log sync failed: %s", future.exception())
+
+    def expire(self):
+        """Remove the oldest segments beyond the retention size and age.
+
+        The age of a segment is the time it was last written. The current
+        segment counts as a full one.
+        """
+        self._expired = time.time()
+        paths = [path for _, path in segments(self.directory)]
+        current = paths.pop() if self._fd is not None and paths else None
+        sizes = [os.path.getsize(path) for path in paths]
+        total = sum(sizes) + (self.segment_size if current else 0)
+        oldest = self._expired - self.retention_age
+        for path, size in zip(paths, sizes):
+            if (total <= self.retention_size and
+                    os.path.getmtime(path) >= oldest):
+                break
+            logger.info("Removing telemetry log segment %s", path)
+            os.remove(path)
+            total -= size
+
+    def close(self):
+        """Sync and close the current segment, before the broker stops."""
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+        if self._fd is not None:
+            self.flush()
+            future = self._executor.submit(_close_segment, self._fd)
+            future.add_done_callback(self._synced)
+            self._fd = None
+        # Wait for the pending syncs and closes
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,159 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Broker latency tracing module.
+
+With latency tracing enabled, the gateways add to the update messages the
+time they received the value from the node. The broker measures:
+
+- uplink: from the gateway to the broker receiving the message,
+- broker: from the broker receiving the message to the message queued for
+  the clients,
+- end_to_end: from the gateway to the web client, reported by the clients.
+
+The uplink and end_to_end stages compare the clocks of different hosts:
+they are only meaningful with synchronized clocks.
+"""
+
+import math
+import logging
+import numbers
+
+from pyaiot.common.messaging import codec
+
+logger = logging.getLogger("pyaiot.broker.tracing")
+
+TRACE_SAMPLE_RATE = 100
+
+# Longest latency report accepted from a client
+MAX_REPORTS = 100
+
+# Buckets in seconds, from a millisecond to the time of a slow client
+TRACE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+                 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def gateway_name(ws):
+    """Return the name of a connection owning nodes, for the metrics."""
+    name = getattr(ws, 'name', None)
+    if name is not None:
+        return name
+    peer_id = getattr(ws, 'peer_id', None)
+    if peer_id is not None:
+        return "peer:{}".format(peer_id)
+    return "unknown"
+
+
+def _is_time(value):
+    # NaN and infinities, decoded by json, would spoil the histogram sums
+    return (isinstance(value, numbers.Real) and
+            not isinstance(value, bool) and math.isfinite(value))
+
+
+class LatencyTracer():
+    """Record the latency of the traced messages.
+
+    :param registry: the metrics registry of the histograms
+    :param path: the file sampled traces are appended to, one JSON object
+                 per line, None to disable the trace file
+    :param sample_rate: only write one trace out of sample_rate
+    """
+
+    def __init__(self, registry, path=None, sample_rate=TRACE_SAMPLE_RATE):
+        self.latency = registry.histogram(
+            "pyaiot_latency_seconds",
+            "Latency of the node updates, by stage and gateway.",
+            TRACE_BUCKETS, labels=("stage", "gateway"))
+        self.sample_rate = max(1, sample_rate)
+        self._count = 0
+        self._file = None
+        if path is not None:
+            self._file = open(path, "a", buffering=1)
+
+    def _sampled(self):
+        if self._file is None:
+            return False
+        self._count += 1
+        return (self._count - 1) % self.sample_rate == 0
+
+    def _write(self, trace):
+        try:
+            self._file.write(codec.dumps(trace) + "\n")
+        except OSError as exc:
+            logger.warning("Cannot write latency trace: %s", exc)
+
+    def on_update(self, gateway, message, received, sent):
+        """Record the latency of an update message handled by the broker.
+
+        :param received: the time the broker received the message
+        :param sent: the time the message was queued for the clients
+        """
+        if not _is_time(message.ts):
+            return
+        self.latency.observe(received - message.ts, ("uplink", gateway))
+        self.latency.observe(sent - received, ("broker", gateway))
+        if self._sampled():
+            self._write({'stage': "broker", 'gateway': gateway,
+                         'uid': message.uid, 'endpoint': message.endpoint,
+                         'ingress': message.ts, 'received': received,
+                         'sent': sent})
+
+    def on_report(self, client, reports, gateway_of):
+        """Record the latencies reported by a web client.
+
+        :param reports: a list of dicts with the 'uid' and 'endpoint' of a
+                        traced update, its ingress time 'ts' and the time
+                        the client 'received' it
+        :param gateway_of: a function returning the gateway name of a node
+        :return False if the report is invalid
+        """
+        if not isinstance(reports, list) or len(reports) > MAX_REPORTS:
+            return False
+        for report in reports:
+            if (not isinstance(report, dict) or
+                    not _is_time(report.get('ts')) or
+                    not _is_time(report.get('received'))):
+                return False
+        for report in reports:
+            gateway = gateway_of(report.get('uid'))
+            self.latency.observe(report['received'] - report['ts'],
+                                 ("end_to_end", gateway))
+            if self._sampled():
+                self._write({'stage': "client", 'gateway': gateway,
+                             'client': client, 'uid': report.get('uid'),
+                             'endpoint': report.get('endpoint'),
+                             'ingress': report['ts'],
+                             'delivered': report['received']})
+        return True
+
+    def close(self):
+        """Close the trace file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -29,15 +29,26 @@
 
 """Pyaiot messaging utility module."""
 
+import time
 import os.path
 import string
+import logging
 import configparser
-from collections import namedtuple
+from collections import namedtuple, Counter, OrderedDict
+from functools import lru_cache
 from random import choice
-from cryptography.fernet import Fernet
+from cryptography.fernet import Fernet, InvalidToken
+from tornado.ioloop import IOLoop
+
+logger = logging.getLogger("pyaiot.auth")
 
 DEFAULT_KEY_FILENAME = "{}/.pyaiot/keys".format(os.path.expanduser("~"))
 
+AUTH_TIMEOUT = 2
+# Token age and replay checks are disabled by default
+TOKEN_TTL = 0
+MAX_PENDING = 1000
+
 Keys = namedtuple('Keys', ['private', 'secret'])
 
 
@@ -81,12 +92,106 @@ def check_key_file(filename=DEFAULT_KEY_FILENAME):
                 secret=config['keys']['secret'])
 
 
-def verify_auth_token(token, keys):
-    """Verify the token is valid."""
-    return (Fernet(keys.private.encode()).decrypt(token.encode()) ==
-            keys.secret.encode())
+@lru_cache(maxsize=16)
+def _fernet(private):
+    """Return the Fernet instance of a private key, built only once."""
+    return Fernet(private.encode())
+
+
+def verify_auth_token(token, keys, ttl=None):
+    """Verify the token is valid.
+
+    :param ttl: maximum age of the token in seconds, None for no limit
+    """
+    if isinstance(token, str):
+        token = token.encode()
+    try:
+        return (_fernet(keys.private).decrypt(token, ttl=ttl) ==
+                keys.secret.encode())
+    except (InvalidToken, TypeError, ValueError):
+        return False
 
 
 def auth_token(keys):
     """Generate a token from the given private and secret keys."""
-    return Fernet(keys.private.encode()).encrypt(keys.secret.encode())
+    return _fernet(keys.private).encrypt(keys.secret.encode())
+
+
+class Authenticator():
+    """Authenticate the connections of gateways.
+
+    A connection is admitted while it is waiting for its token: it is
+    closed if no token was received after `timeout` seconds, and no more
+    than `max_pending` connections can wait at the same time.
+    A token is valid for `ttl` seconds and can only be used once during
+    this time. A ttl of 0 disables both checks. The token timestamp is set
+    by the gateway: a token more than `ttl` seconds ahead of the broker
+    clock is rejected too.
+
+    The failures are counted by reason in `failures`: 'invalid',
+    'replayed', 'timeout' and 'overloaded'.
+    """
+
+    def __init__(self, keys, timeout=AUTH_TIMEOUT, ttl=TOKEN_TTL,
+                 max_pending=MAX_PENDING):
+        self.keys = keys
+        self.timeout = timeout
+        self.ttl = ttl or None
+        self.max_pending = max_pending
+        self.failures = Counter()
+        self._pending = {}
+        self._used = OrderedDict()
+
+    def admit(self, connection):
+        """Start waiting for the token of a connection.
+
+        :return False if too many connections are already waiting
+        """
+        if len(self._pending) >= self.max_pending:
+            logger.warning("Too many connections waiting for "
+                           "authentication")
+            self.failures['overloaded'] += 1
+            return False
+        self._pending[connection] = IOLoop.current().call_later(
+            self.timeout, self._expire, connection)
+        return True
+
+    def verify(self, connection, token):
+        """Verify the token received on an admitted connection."""
+        self.discard(connection)
+        if not verify_auth_token(token, self.keys, ttl=self.ttl):
+            self.failures['invalid'] += 1
+            return False
+        if self.ttl is None:
+            return True
+        if isinstance(token, str):
+            token = token.encode()
+        return self._use(token)
+
+    def discard(self, connection):
+        """Stop waiting for the token of a connection."""
+        timeout = self._pending.pop(connection, None)
+        if timeout is not None:
+            IOLoop.current().remove_timeout(timeout)
+
+    def pending(self):
+        """Return the number of connections waiting for their token."""
+        return len(self._pending)
+
+    def _expire(self, connection):
+        if self._pending.pop(connection, None) is not None:
+            logger.info("Authentication timeout, closing connection")
+            self.failures['timeout'] += 1
+            connection.close()
+
+    def _use(self, token):
+        """Remember a token until it expires, False if already used."""
+        now = time.time()
+        while self._used and next(iter(self._used.values())) < now:
+            self._used.popitem(last=False)
+        if token in self._used:
+            logger.warning("Authentication token replayed")
+            self.failures['replayed'] += 1
+            return False
+        self._used[token] = now + self.ttl
+        return True
@@ -0,0 +1,82 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Pyaiot message batching module."""
+
+from tornado.ioloop import IOLoop
+
+from pyaiot.common.messaging import Message
+
+BATCH_DELAY = 5  # ms
+BATCH_MAX_SIZE = 64 * 1024
+
+
+class MessageBatcher():
+    """Group the text messages sent in a short time window.
+
+    Messages are kept until the delay (in seconds) expires or until their
+    total size reaches max_size, then they are written at once in a single
+    batch message.
+    """
+
+    def __init__(self, write, delay=BATCH_DELAY / 1000,
+                 max_size=BATCH_MAX_SIZE):
+        self.write = write
+        self.delay = delay
+        self.max_size = max_size
+        self._messages = []
+        self._size = 0
+        self._timeout = None
+
+    def __len__(self):
+        return len(self._messages)
+
+    def put(self, message):
+        """Add a message to the current batch."""
+        self._messages.append(message)
+        self._size += len(message)
+        if self._size >= self.max_size:
+            self.flush()
+        elif self._timeout is None:
+            self._timeout = IOLoop.current().call_later(self.delay,
+                                                        self.flush)
+
+    def flush(self):
+        """Write the current batch."""
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+        if not self._messages:
+            return
+        messages = self._messages
+        self._messages, self._size = [], 0
+        if len(messages) == 1:
+            self.write(messages[0])
+        else:
+            self.write(Message.batch(messages))
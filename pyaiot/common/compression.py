@@ -0,0 +1,126 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Websocket compression helpers module.
+
+Connections use the permessage-deflate extension (RFC 7692) when both ends
+enable it. Each message can be compressed or not: messages smaller than a
+threshold are sent uncompressed, they gain little and still cost a call to
+the compressor.
+
+Tornado has no public API to choose the compression window or to send an
+uncompressed frame on a compressed connection: both are done here only,
+and fall back to the default Tornado behavior if its internals change.
+"""
+
+import zlib
+
+from tornado.iostream import StreamClosedError
+from tornado.websocket import WebSocketClosedError
+
+COMPRESSION_THRESHOLD = 64
+COMPRESSION_LEVEL = 6
+COMPRESSION_WINDOW_BITS = zlib.MAX_WBITS
+# Raw deflate streams don't support a window of 8 bits
+MIN_WINDOW_BITS = 9
+
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+
+
+def check_window_bits(window_bits):
+    """Raise ValueError if a compression window size is not supported.
+
+    >>> check_window_bits(8)
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid compression window bits: 8, should be from 9 to 15
+    """
+    if not MIN_WINDOW_BITS <= window_bits <= zlib.MAX_WBITS:
+        raise ValueError("Invalid compression window bits: {}, should be "
+                         "from {} to {}".format(window_bits, MIN_WINDOW_BITS,
+                                                zlib.MAX_WBITS))
+
+
+def compression_options(options):
+    """Return the websocket compression options, None when disabled.
+
+    Tornado reads 'compression_level', 'max_wbits' is applied by
+    limit_window_bits.
+    """
+    if not options.compression:
+        return None
+    return {'compression_level': options.compression_level,
+            'max_wbits': options.compression_window_bits}
+
+
+def _protocol(connection):
+    """Return the websocket protocol of a handler or client connection."""
+    return getattr(connection, 'ws_connection',
+                   getattr(connection, 'protocol', None))
+
+
+def limit_window_bits(connection, options):
+    """Apply the 'max_wbits' compression option to a connection.
+
+    Tornado sizes the compression window from the negotiated parameters
+    only. A compressor can always use a smaller window than the one
+    negotiated, the peer decompresses the messages all the same. This must
+    be called before the first message is sent.
+
+    :param options: the compression options of the connection, e.g. the
+                    result of the handler get_compression_options()
+    """
+    window_bits = (options or {}).get('max_wbits')
+    compressor = getattr(_protocol(connection), '_compressor', None)
+    if (window_bits is None or compressor is None or
+            window_bits >= getattr(compressor, '_max_wbits', 0)):
+        return
+    check_window_bits(window_bits)
+    compressor._max_wbits = window_bits
+    if getattr(compressor, '_compressor', None) is not None:
+        compressor._compressor = compressor._create_compressor()
+
+
+def write_message(connection, message, threshold=COMPRESSION_THRESHOLD,
+                  binary=False):
+    """Write a message, only compressed above threshold bytes."""
+    protocol = _protocol(connection)
+    if (getattr(protocol, '_compressor', None) is None or
+            not hasattr(protocol, '_write_frame') or
+            len(message) >= threshold):
+        return connection.write_message(message, binary=binary)
+    if isinstance(message, str):
+        message = message.encode('utf-8')
+    try:
+        # A frame without the RSV1 bit is not compressed
+        return protocol._write_frame(
+            True, OPCODE_BINARY if binary else OPCODE_TEXT, message)
+    except StreamClosedError:
+        raise WebSocketClosedError()
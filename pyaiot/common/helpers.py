@@ -2,15 +2,23 @@
 
 import logging
 import signal
+import tempfile
 from functools import partial
 import tornado
+from tornado.httpserver import HTTPServer
 from tornado.options import define, options
 
 from pyaiot.common.auth import DEFAULT_KEY_FILENAME
-
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s - %(name)14s - '
-                           '%(levelname)5s - %(message)s')
+from pyaiot.common.batch import BATCH_DELAY, BATCH_MAX_SIZE
+from pyaiot.common.compression import (COMPRESSION_THRESHOLD,
+                                       COMPRESSION_LEVEL,
+                                       COMPRESSION_WINDOW_BITS,
+                                       check_window_bits)
+from pyaiot.common.log import LOG_FORMATS, parse_levels, setup_logging
+from pyaiot.common.messaging import JSON_CODECS, codec
+from pyaiot.common.monitor import LoopMonitor, SLOW_THRESHOLD
+from pyaiot.common.profiling import Profiler
+from pyaiot.common.wire import WIRE_FORMATS, available_formats
 
 logger = logging.getLogger("pyaiot.helpers")
 
@@ -28,6 +36,66 @@ def parse_command_line(extra_args_func=None):
     if not hasattr(options, "key_file"):
         define("key_file", default=DEFAULT_KEY_FILENAME,
                help="Secret and private keys filename.")
+    if not hasattr(options, "batch_messages"):
+        define("batch_messages", default=False,
+               help="Group messages sent in a short time window.")
+    if not hasattr(options, "batch_delay"):
+        define("batch_delay", default=BATCH_DELAY,
+               help="Maximum time (in ms) a message waits in a batch.")
+    if not hasattr(options, "batch_max_size"):
+        define("batch_max_size", default=BATCH_MAX_SIZE,
+               help="Maximum size (in bytes) of a batch.")
+    if not hasattr(options, "snapshot_messages"):
+        define("snapshot_messages", default=False,
+               help="Send the state of the gateway nodes in snapshot "
+               "messages, requires an up to date broker.")
+    if not hasattr(options, "compression"):
+        define("compression", default=False,
+               help="Compress websocket messages (permessage-deflate).")
+    if not hasattr(options, "compression_threshold"):
+        define("compression_threshold", default=COMPRESSION_THRESHOLD,
+               help="Minimum size (in bytes) of a compressed message.")
+    if not hasattr(options, "compression_level"):
+        define("compression_level", default=COMPRESSION_LEVEL,
+               help="Compression level, from 1 (fast) to 9 (small).")
+    if not hasattr(options, "compression_window_bits"):
+        define("compression_window_bits", default=COMPRESSION_WINDOW_BITS,
+               help="Compression window size (9 to 15 bits), smaller "
+               "windows use less memory per connection.")
+    if not hasattr(options, "wire_format"):
+        define("wire_format", default=WIRE_FORMATS[0],
+               help="Format of the messages sent by a gateway to the "
+               "broker: {}.".format(", ".join(WIRE_FORMATS)))
+    if not hasattr(options, "json_codec"):
+        define("json_codec", default=JSON_CODECS[0],
+               help="JSON library used for the messages: {}."
+               .format(", ".join(JSON_CODECS)))
+    if not hasattr(options, "log_levels"):
+        define("log_levels", default="",
+               help="Level of some loggers, e.g "
+               "'pyaiot.broker.messages=debug,tornado=warning'.")
+    if not hasattr(options, "log_format"):
+        define("log_format", default=LOG_FORMATS[0],
+               help="Format of the logs: {}.".format(", ".join(LOG_FORMATS)))
+    if not hasattr(options, "log_sample_rate"):
+        define("log_sample_rate", default=1,
+               help="Only log one per-message record out of this many.")
+    if not hasattr(options, "latency_tracing"):
+        define("latency_tracing", default=False,
+               help="Add the time a gateway received a value from a node to "
+               "the update messages, for latency tracing.")
+    if not hasattr(options, "profile_dir"):
+        define("profile_dir", default=tempfile.gettempdir(),
+               help="Directory of the profiles written on SIGUSR1 (CPU) and "
+               "SIGUSR2 (memory).")
+    if not hasattr(options, "loop_monitor"):
+        define("loop_monitor", default=False,
+               help="Measure the event loop lag and log the slow callbacks, "
+               "using the asyncio debug mode.")
+    if not hasattr(options, "loop_slow_threshold"):
+        define("loop_slow_threshold", default=SLOW_THRESHOLD,
+               help="Duration in ms above which a callback is logged by the "
+               "loop monitor.")
     if extra_args_func is not None:
         extra_args_func()
 
@@ -37,6 +105,19 @@ def parse_command_line(extra_args_func=None):
     # Parse the command line a second time to override config file options
     options.parse_command_line()
 
+    if options.log_format not in LOG_FORMATS:
+        raise ValueError("Invalid log format: '{}'"
+                         .format(options.log_format))
+    codec.use(options.json_codec)
+    check_window_bits(options.compression_window_bits)
+    if options.wire_format not in available_formats():
+        raise ValueError("Unsupported wire format: '{}'"
+                         .format(options.wire_format))
+    setup_logging(level=logging.DEBUG if options.debug else logging.INFO,
+                  levels=parse_levels(options.log_levels),
+                  log_format=options.log_format,
+                  sample_rate=options.log_sample_rate)
+
 
 def signal_handler(server, app_close, sig, frame):
     """Triggered when a signal is received from system."""
@@ -45,7 +126,6 @@ def signal_handler(server, app_close, sig, frame):
     def shutdown():
         """Force server and ioloop shutdown."""
         logger.info('Shuting down server')
-        tornado.platform.asyncio.AsyncIOMainLoop().stop()
         if app_close is not None:
             app_close()
         if server is not None:
@@ -56,11 +136,27 @@ def signal_handler(server, app_close, sig, frame):
     _ioloop.add_callback_from_signal(shutdown)
 
 
-def start_application(app, port=None, close_client=False):
-    """Start a tornado application."""
+def profile_handler(action, sig, frame):
+    """Triggered when a profiling signal is received from system."""
+    tornado.ioloop.IOLoop.current().add_callback_from_signal(action)
+
+
+def start_application(app, port=None, close_client=False, sockets=None):
+    """Start a tornado application.
+
+    SIGUSR1 and SIGUSR2 start and stop the CPU and memory profiling of the
+    application, see the profiling module. With the loop_monitor option,
+    the lag histograms are added to the metrics of the application, if it
+    has some.
+
+    :param sockets: already bound listening sockets, used instead of port
+    """
     _ioloop = tornado.ioloop.IOLoop.current()
     _server = None
-    if port is not None:
+    if sockets is not None:
+        _server = HTTPServer(app)
+        _server.add_sockets(sockets)
+    elif port is not None:
         _server = app.listen(port)
 
     if not close_client:
@@ -70,5 +166,15 @@ def start_application(app, port=None, close_client=False):
                   partial(signal_handler, _server, app.close_client))
     signal.signal(signal.SIGINT,
                   partial(signal_handler, _server, app.close_client))
+    if hasattr(signal, "SIGUSR1"):
+        profiler = Profiler(type(app).__name__.lower(), options.profile_dir)
+        signal.signal(signal.SIGUSR1,
+                      partial(profile_handler, profiler.toggle_cpu))
+        signal.signal(signal.SIGUSR2,
+                      partial(profile_handler, profiler.toggle_memory))
+    if options.loop_monitor:
+        metrics = getattr(app, "metrics", None)
+        LoopMonitor(registry=metrics.registry if metrics is not None else None,
+                    threshold=options.loop_slow_threshold).start()
 
     _ioloop.start()
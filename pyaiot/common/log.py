@@ -0,0 +1,130 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Pyaiot logging setup module.
+
+The loggers of all services are children of the 'pyaiot' logger and format
+their messages lazily: `logger.debug("message %s", arg)` only costs a level
+check when debug is disabled.
+
+The logs written for each relayed message go to the '<service>.messages'
+child logger of a service, so they can be enabled and sampled on their own.
+"""
+
+import json
+import logging
+
+LOG_FORMAT = '%(asctime)s - %(name)14s - %(levelname)5s - %(message)s'
+LOG_FORMATS = ('text', 'json')
+
+# Attributes of all log records, the other ones are extra fields
+_RECORD_ATTRIBUTES = set(logging.LogRecord(
+    '', 0, '', 0, '', (), None).__dict__) | {'message', 'asctime'}
+
+
+def parse_levels(value):
+    """Return the level of each logger given as 'name=level,...'.
+
+    >>> parse_levels("pyaiot.broker=debug, pyaiot.gw.coap=WARNING")
+    {'pyaiot.broker': 10, 'pyaiot.gw.coap': 30}
+    >>> parse_levels("pyaiot.broker=verbose")
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid log level 'verbose' for logger 'pyaiot.broker'
+    """
+    levels = {}
+    for item in (value or "").split(','):
+        if not item.strip():
+            continue
+        name, _, level = item.partition('=')
+        name, level = name.strip(), level.strip().upper()
+        if not isinstance(logging.getLevelName(level), int):
+            raise ValueError("Invalid log level '{}' for logger '{}'"
+                             .format(level.lower(), name))
+        levels[name] = logging.getLevelName(level)
+    return levels
+
+
+class SampleFilter(logging.Filter):
+    """Only let one per-message record out of rate pass."""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self._count = 0
+
+    def filter(self, record):
+        if self.rate <= 1 or not record.name.endswith(".messages"):
+            return True
+        self._count += 1
+        return self._count % self.rate == 1
+
+
+class JsonFormatter(logging.Formatter):
+    """Format log records as JSON objects, one per line.
+
+    The extra fields of a record, given with the `extra` argument of the
+    logging calls, are added to the object.
+    """
+
+    def format(self, record):
+        fields = {'time': self.formatTime(record),
+                  'level': record.levelname,
+                  'logger': record.name,
+                  'message': record.getMessage()}
+        fields.update({key: value for key, value in record.__dict__.items()
+                       if key not in _RECORD_ATTRIBUTES})
+        if record.exc_info:
+            fields['exception'] = self.formatException(record.exc_info)
+        return json.dumps(fields, default=str, ensure_ascii=False)
+
+
+def setup_logging(level=logging.INFO, levels=None, log_format='text',
+                  sample_rate=1):
+    """Configure the logging of a pyaiot service.
+
+    :param level: the level of all loggers
+    :param levels: a dict with the level of some loggers
+    :param log_format: 'text' or 'json'
+    :param sample_rate: only log one per-message record out of sample_rate
+    """
+    handler = logging.StreamHandler()
+    if log_format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(SampleFilter(sample_rate))
+    # Replace the handlers installed before, e.g by tornado options parsing
+    root = logging.getLogger()
+    for previous in list(root.handlers):
+        root.removeHandler(previous)
+    root.addHandler(handler)
+    root.setLevel(level)
+    for name, logger_level in (levels or {}).items():
+        logging.getLogger(name).setLevel(logger_level)
@@ -29,11 +29,110 @@
 
 """Pyaiot messaging utility module."""
 
+import re
 import json
 import logging
+from functools import partial
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+from pyaiot.common import wire
 
 logger = logging.getLogger("pyaiot.messaging")
 
+MESSAGE_TYPES = ('new', 'update', 'out', 'reset', 'snapshot', 'batch',
+                 'subscribe', 'unsubscribe', 'latency', 'resume')
+
+SNAPSHOT_MAX_SIZE = 64 * 1024
+
+JSON_CODECS = ('auto', 'orjson', 'ujson', 'json')
+
+# Longest excerpt of an invalid message written in logs and close reasons
+EXCERPT_SIZE = 48
+
+_decoder = json.JSONDecoder()
+_whitespace = re.compile(r'[ \t\n\r]*')
+_BATCH_PREFIXES = tuple('{{"type"{1}"batch"{0}"messages"{1}['.format(*sep)
+                        for sep in ((', ', ': '), (',', ':')))
+
+
+def excerpt(value, size=EXCERPT_SIZE):
+    """Return the beginning of a value, for logging invalid input.
+
+    >>> excerpt('x' * 100, size=5)
+    'xxxxx...'
+    """
+    text = str(value)
+    if len(text) <= size:
+        return text
+    return text[:size] + '...'
+
+
+def _orjson_dumps(message):
+    return orjson.dumps(message, option=orjson.OPT_NON_STR_KEYS).decode()
+
+
+class JsonCodec():
+    """JSON encoder and decoder of the messages.
+
+    A single codec is shared by all the services of a process, see use() to
+    select the JSON library.
+
+    >>> codec = JsonCodec('json')
+    >>> codec.dumps({'type': 'out', 'uid': 'é'})
+    '{"type": "out", "uid": "é"}'
+    >>> codec.loads('{"type": "out"}')
+    {'type': 'out'}
+    """
+
+    def __init__(self, name='auto'):
+        self.use(name)
+
+    def use(self, name):
+        """Select the JSON library of the codec.
+
+        'auto' decodes with the fastest installed library and encodes with
+        the standard library: the messages are the same whatever packages
+        are installed. 'orjson' and 'ujson' also encode with the library,
+        orjson writes compact JSON and ujson formats floats differently.
+
+        :raise ValueError: if the library is unknown or not installed
+        """
+        libraries = {'orjson': orjson, 'ujson': ujson, 'json': json}
+        if name not in JSON_CODECS:
+            raise ValueError("Unknown JSON codec: '{}'".format(name))
+        if name != 'auto' and libraries[name] is None:
+            raise ValueError("JSON codec '{}' is not installed".format(name))
+        if name == 'auto':
+            name = next(library for library in JSON_CODECS[1:]
+                        if libraries[library] is not None)
+            self.dumps = json.JSONEncoder(ensure_ascii=False).encode
+            self.separators = (', ', ': ')
+        elif name == 'orjson':
+            self.dumps = _orjson_dumps
+            self.separators = (',', ':')
+        elif name == 'ujson':
+            self.dumps = partial(ujson.dumps, ensure_ascii=False,
+                                 escape_forward_slashes=False,
+                                 separators=(', ', ': '))
+            self.separators = (', ', ': ')
+        else:
+            self.dumps = json.JSONEncoder(ensure_ascii=False).encode
+            self.separators = (', ', ': ')
+        self.loads = libraries[name].loads
+        self.name = name
+
+
+codec = JsonCodec()
+
 
 def check_broker_data(data):
     """"Utility function that checks the data object.
@@ -68,36 +167,260 @@ def check_broker_data(data):
     return False
 
 
+class NodeMessage():
+    """Base class of the messages sent by the gateways about their nodes.
+
+    Messages are compact records: their text is serialized once, when it
+    is first needed, and a message decoded from a received text keeps it.
+
+    >>> message = UpdateMessage('1234', 'led', '1')
+    >>> message.text
+    '{"type": "update", "uid": "1234", "endpoint": "led", "data": "1", \
+"dst": "all"}'
+    >>> NodeMessage.from_text(message.text) == message
+    True
+    """
+
+    __slots__ = ('_text',)
+    type = None
+    fields = ()
+    optional = ()
+
+    @property
+    def text(self):
+        """The serialized message."""
+        if self._text is None:
+            self._text = codec.dumps(self.to_dict())
+        return self._text
+
+    def to_dict(self):
+        """Return the message as a dict."""
+        message = {'type': self.type}
+        for field in self.fields:
+            message[field] = getattr(self, field)
+        for field in self.optional:
+            if getattr(self, field) is not None:
+                message[field] = getattr(self, field)
+        return message
+
+    def __eq__(self, other):
+        return (type(self) is type(other) and
+                all(getattr(self, field) == getattr(other, field)
+                    for field in self.fields))
+
+    def __repr__(self):
+        return "{}({})".format(
+            type(self).__name__,
+            ", ".join("{}={!r}".format(field, getattr(self, field))
+                      for field in self.fields))
+
+    @staticmethod
+    def from_dict(message, text=None):
+        """Return the node message of a decoded message, or None.
+
+        :param text: the text the message was decoded from
+        """
+        cls = NODE_MESSAGES.get(message.get('type'))
+        if (cls is None or any(field not in message for field in cls.fields)
+                or not isinstance(message.get('uid', ''), str) or
+                not isinstance(message.get('nodes', {}), dict)):
+            return None
+        return cls(*(message[field] for field in cls.fields), text=text,
+                   **{field: message[field] for field in cls.optional
+                      if field in message})
+
+    @staticmethod
+    def from_text(text):
+        """Return the node message of a JSON text message, or None."""
+        message = codec.loads(text)
+        if not isinstance(message, dict):
+            return None
+        return NodeMessage.from_dict(message, text)
+
+
+class NewMessage(NodeMessage):
+    """A node is available."""
+
+    __slots__ = ('uid', 'dst')
+    type = 'new'
+    fields = __slots__
+
+    def __init__(self, uid, dst="all", text=None):
+        self.uid = uid
+        self.dst = dst
+        self._text = text
+
+
+class OutMessage(NodeMessage):
+    """A node is gone."""
+
+    __slots__ = ('uid',)
+    type = 'out'
+    fields = __slots__
+
+    def __init__(self, uid, text=None):
+        self.uid = uid
+        self._text = text
+
+
+class ResetMessage(NodeMessage):
+    """A node has reset, its resources are cleared."""
+
+    __slots__ = ('uid',)
+    type = 'reset'
+    fields = __slots__
+
+    def __init__(self, uid, text=None):
+        self.uid = uid
+        self._text = text
+
+
+class UpdateMessage(NodeMessage):
+    """The value of a node resource.
+
+    :param ts: the time the gateway received the value from the node, in
+               seconds since the epoch, when latency tracing is enabled
+    """
+
+    __slots__ = ('uid', 'endpoint', 'data', 'dst', 'ts')
+    type = 'update'
+    fields = __slots__[:-1]
+    optional = ('ts',)
+
+    def __init__(self, uid, endpoint, data, dst="all", text=None, ts=None):
+        self.uid = uid
+        self.endpoint = endpoint
+        self.data = data
+        self.dst = dst
+        self.ts = ts
+        self._text = text
+
+
+class SnapshotMessage(NodeMessage):
+    """The resources of several nodes.
+
+    :param nodes: a dict mapping node uids to their resources dict
+    """
+
+    __slots__ = ('nodes', 'dst')
+    type = 'snapshot'
+    fields = __slots__
+
+    def __init__(self, nodes, dst="all", text=None):
+        self.nodes = nodes
+        self.dst = dst
+        self._text = text
+
+
+NODE_MESSAGES = {cls.type: cls for cls in (NewMessage, OutMessage,
+                                           ResetMessage, UpdateMessage,
+                                           SnapshotMessage)}
+
+
 class Message():
     """Utility class for generating and parsing service messages."""
 
     @staticmethod
     def serialize(message):
-        return json.dumps(message, ensure_ascii=False)
+        return codec.dumps(message)
 
     @staticmethod
     def new_node(uid, dst="all"):
         """Generate a text message indicating a new node."""
-        return Message.serialize({'type': 'new', 'uid': uid, 'dst': dst})
+        return NewMessage(uid, dst).text
 
     @staticmethod
     def out_node(uid):
         """Generate a text message indicating a node to remove."""
-        return Message.serialize({'type': 'out', 'uid': uid})
+        return OutMessage(uid).text
 
     @staticmethod
     def reset_node(uid):
         """Generate a text message indicating a node reset."""
-        return Message.serialize({'type': 'reset', 'uid': uid})
+        return ResetMessage(uid).text
 
     @staticmethod
     def update_node(uid, endpoint, data, dst="all"):
         """Generate a text message indicating a node update."""
-        return Message.serialize({'type': 'update',
-                                  'uid': uid,
-                                  'endpoint': endpoint,
-                                  'data': data,
-                                  'dst': dst})
+        return UpdateMessage(uid, endpoint, data, dst).text
+
+    @staticmethod
+    def snapshot(nodes, dst="all"):
+        """Generate a text message with the state of several nodes.
+
+        :param nodes: a dict mapping node uids to their resources dict
+        """
+        return SnapshotMessage(nodes, dst).text
+
+    @staticmethod
+    def snapshot_chunks(nodes, dst="all", max_size=SNAPSHOT_MAX_SIZE):
+        """Generate snapshot text messages of at most max_size bytes.
+
+        The nodes are split between as many messages as needed, a node is
+        never split: a message containing a single node can exceed max_size.
+        Each chunk is identical to the output of Message.snapshot with the
+        nodes it contains.
+        """
+        comma, colon = codec.separators
+        prefix = '{{"type"{0}"snapshot"{1}"nodes"{0}{{'.format(colon, comma)
+        suffix = '}}{}"dst"{}{}}}'.format(comma, colon,
+                                          Message.serialize(dst))
+        overhead = len(prefix) + len(suffix.encode('utf-8'))
+        parts, size = [], overhead
+        for uid, resources in nodes.items():
+            part = '{}{}{}'.format(Message.serialize(uid), colon,
+                                   Message.serialize(resources))
+            part_size = len(part.encode('utf-8')) + len(comma)
+            if parts and size + part_size > max_size:
+                yield prefix + comma.join(parts) + suffix
+                parts, size = [], overhead
+            parts.append(part)
+            size += part_size
+        if parts:
+            yield prefix + comma.join(parts) + suffix
+
+    @staticmethod
+    def batch(messages):
+        """Generate a text message grouping several text messages.
+
+        The messages are already serialized: they are embedded as is.
+        """
+        comma, colon = codec.separators
+        return '{{"type"{1}"batch"{0}"messages"{1}[{2}]}}'.format(
+            comma, colon, comma.join(messages))
+
+    @staticmethod
+    def subscribe(filters):
+        """Generate a text message subscribing a client to node endpoints.
+
+        :param filters: a list of dicts with optional 'uid' and 'endpoint'
+                        keys, '*' (the default) matching anything.
+        """
+        return Message.serialize({'type': 'subscribe', 'data': filters})
+
+    @staticmethod
+    def unsubscribe(filters):
+        """Generate a text message removing client subscriptions."""
+        return Message.serialize({'type': 'unsubscribe', 'data': filters})
+
+    @staticmethod
+    def session(session, seq, resumed=False):
+        """Generate a text message giving a client its session.
+
+        :param seq: the sequence number of the last message the client got
+        :param resumed: True when the client resumed a previous session
+        """
+        return Message.serialize({'type': 'session', 'session': session,
+                                  'seq': seq, 'resumed': resumed})
+
+    @staticmethod
+    def resume(session, seq):
+        """Generate a text message resuming a client session.
+
+        :param seq: the sequence number of the last message received
+        """
+        return Message.serialize({'type': 'resume', 'session': session,
+                                  'seq': seq})
 
     @staticmethod
     def discover_node():
@@ -105,31 +428,123 @@ class Message():
         return Message.serialize({'request': 'discover'})
 
     @staticmethod
-    def check_message(raw):
-        """Verify a received message is correctly formatted."""
+    def check_message(raw, wire_format='json'):
+        """Verify a received message is correctly formatted.
+
+        :param wire_format: the format of the binary messages, text
+                            messages are always JSON
+        """
         reason = None
         try:
-            message = json.loads(raw)
+            message = wire.decode(raw, wire_format, loads=codec.loads)
         except TypeError as exc:
             logger.warning(exc)
-            reason = "Invalid message '{}'.".format(raw)
+            reason = "Invalid message '{}'.".format(excerpt(raw))
             message = None
-        except json.JSONDecodeError:
+        except ValueError:
             reason = ("Invalid message received "
-                      "'{}'. Only JSON format is supported.".format(raw))
+                      "'{}'. Only {} format is supported."
+                      .format(excerpt(raw), wire_format.upper()))
             message = None
 
         if message is not None:
-            if not hasattr(message, '__iter__'):
-                reason = "Invalid message '{}'.".format(message)
-            elif 'type' not in message and 'data' not in message:
-                reason = "Invalid message '{}'.".format(message)
-            elif (message['type'] != 'new' and message['type'] != 'update' and
-                  message['type'] != 'out' and message['type'] != 'reset'):
-                reason = "Invalid message type '{}'.".format(message['type'])
+            if not isinstance(message, dict) or 'type' not in message:
+                reason = "Invalid message '{}'.".format(excerpt(message))
+            elif message['type'] not in MESSAGE_TYPES:
+                reason = "Invalid message type '{}'.".format(
+                    excerpt(message['type']))
+            elif message['type'] == 'batch':
+                reason = Message._check_batch(message)
 
         if reason is not None:
             logger.warning(reason)
             message = None
 
         return message, reason
+
+    @staticmethod
+    def split(raw, wire_format='json'):
+        """Verify a received message and split it into routable messages.
+
+        Return a list of (message, text) tuples, or None, and the reason
+        why the message is invalid. The text is the part of the received
+        text holding the message: it can be forwarded without serializing
+        the message again. It is None for binary messages and for batches
+        not generated by Message.batch.
+        """
+        if isinstance(raw, str) and raw.startswith(_BATCH_PREFIXES):
+            items = Message._split_batch(raw)
+            if items is not None:
+                reason = Message._check_batch(
+                    {'messages': [message for message, _ in items]})
+                if reason is not None:
+                    logger.warning(reason)
+                    return None, reason
+                return items, None
+
+        message, reason = Message.check_message(raw, wire_format)
+        if message is None:
+            return None, reason
+        if message['type'] == 'batch':
+            return [(item, None) for item in message['messages']], None
+        return [(message, raw if isinstance(raw, str) else None)], None
+
+    @staticmethod
+    def node_messages(raw, wire_format='json'):
+        """Verify a message received from a gateway.
+
+        Return the list of NodeMessage it contains, or None, and the reason
+        why the message is invalid. The messages that are not about nodes
+        are skipped.
+        """
+        items, reason = Message.split(raw, wire_format)
+        if items is None:
+            return None, reason
+        messages = []
+        for message, text in items:
+            node_message = NodeMessage.from_dict(message, text)
+            if node_message is None:
+                logger.debug("Message '%s' is not a node message, skipped",
+                             excerpt(message))
+                continue
+            messages.append(node_message)
+        return messages, None
+
+    @staticmethod
+    def _split_batch(raw):
+        """Return the (message, text) tuples of a batch text message.
+
+        Only the messages array is scanned, None is returned if the text
+        is not a batch generated by Message.batch.
+        """
+        items = []
+        index = _whitespace.match(raw, raw.index('[') + 1).end()
+        try:
+            while raw[index] != ']':
+                message, end = _decoder.raw_decode(raw, index)
+                items.append((message, raw[index:end]))
+                index = _whitespace.match(raw, end).end()
+                if raw[index] == ',':
+                    index = _whitespace.match(raw, index + 1).end()
+                    if raw[index] == ']':
+                        return None
+                elif raw[index] != ']':
+                    return None
+        except (ValueError, IndexError):
+            return None
+        if raw[index + 1:].strip() != '}':
+            return None
+        return items
+
+    @staticmethod
+    def _check_batch(message):
+        """Verify the messages contained in a batch message."""
+        messages = message.get('messages')
+        if not isinstance(messages, list):
+            return "Invalid batch message."
+        for item in messages:
+            if (not isinstance(item, dict) or
+                    item.get('type') not in MESSAGE_TYPES or
+                    item['type'] == 'batch'):
+                return "Invalid message in batch."
+        return None
@@ -0,0 +1,224 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Pyaiot metrics module.
+
+Counters, gauges and histograms rendered in the Prometheus text exposition
+format. Recording a value is a dict update, cheap enough to be left
+enabled on the message paths.
+
+>>> registry = Registry()
+>>> messages = registry.counter("messages_total", "Messages.", ("type",))
+>>> messages.inc(labels=("update",))
+>>> latency = registry.histogram("latency_seconds", "Latency.",
+...                              buckets=(0.1, 1))
+>>> latency.observe(0.5)
+>>> print(registry.render())
+# HELP messages_total Messages.
+# TYPE messages_total counter
+messages_total{type="update"} 1
+# HELP latency_seconds Latency.
+# TYPE latency_seconds histogram
+latency_seconds_bucket{le="0.1"} 0
+latency_seconds_bucket{le="1"} 1
+latency_seconds_bucket{le="+Inf"} 1
+latency_seconds_sum 0.5
+latency_seconds_count 1
+<BLANKLINE>
+"""
+
+import math
+from bisect import bisect_left
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Buckets in seconds, for durations from a few microseconds to a second
+LATENCY_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005,
+                   0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1)
+SIZE_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000,
+                10000)
+
+
+def _format_value(value):
+    """Return the text of a sample value.
+
+    >>> _format_value(3), _format_value(0.25), _format_value(math.inf)
+    ('3', '0.25', '+Inf')
+    """
+    if isinstance(value, float):
+        if math.isinf(value):
+            return "+Inf" if value > 0 else "-Inf"
+        if value.is_integer():
+            return str(int(value))
+    return repr(value)
+
+
+def _escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _format_labels(names, values):
+    if not names:
+        return ""
+    return "{{{}}}".format(",".join(
+        '{}="{}"'.format(name, _escape(value))
+        for name, value in zip(names, values)))
+
+
+class Metric():
+    """Base class of the metrics, with a value per tuple of label values.
+
+    When collect is given, the values are read when the metric is rendered:
+    collect returns a dict mapping tuples of label values to values.
+    """
+
+    kind = None
+
+    def __init__(self, name, help, labels=(), collect=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        self._values = {}
+
+    def samples(self):
+        """Yield the (name, label names, label values, value) samples."""
+        if self.collect is not None:
+            self._values = dict(self.collect())
+        for labels, value in sorted(self._values.items()):
+            yield self.name, self.labels, labels, value
+
+    def render(self, const_labels=()):
+        """Return the text exposition of the metric.
+
+        :param const_labels: (name, value) labels added to all samples
+        """
+        names = tuple(name for name, _ in const_labels)
+        values = tuple(value for _, value in const_labels)
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} {}".format(self.name, self.kind)]
+        for name, label_names, label_values, value in self.samples():
+            lines.append("{}{} {}".format(
+                name, _format_labels(names + label_names,
+                                     values + label_values),
+                _format_value(value)))
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """A value that only increases."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, labels=()):
+        """Increase the counter of the given label values."""
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        """Return the counter of the given label values."""
+        return self._values.get(labels, 0)
+
+
+class Gauge(Metric):
+    """A value that can go up and down."""
+
+    kind = "gauge"
+
+    def set(self, value, labels=()):
+        """Set the gauge of the given label values."""
+        self._values[labels] = value
+
+
+class Histogram(Metric):
+    """Distribution of observed values in buckets."""
+
+    kind = "histogram"
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, labels=()):
+        """Add a value to the histogram of the given label values."""
+        series = self._values.get(labels)
+        if series is None:
+            # Count of each bucket, the +Inf bucket, then the sum
+            series = self._values[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def count(self, labels=()):
+        """Return the number of values observed."""
+        series = self._values.get(labels)
+        return sum(series[:-1]) if series is not None else 0
+
+    def samples(self):
+        for labels, series in sorted(self._values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf,), series):
+                total += count
+                yield (self.name + "_bucket", self.labels + ("le",),
+                       labels + (_format_value(float(bound)),), total)
+            yield self.name + "_sum", self.labels, labels, series[-1]
+            yield self.name + "_count", self.labels, labels, total
+
+
+class Registry():
+    """A set of metrics rendered together.
+
+    :param labels: a dict of labels added to all the samples
+    """
+
+    def __init__(self, labels=None):
+        self.labels = tuple(sorted((labels or {}).items()))
+        self._metrics = []
+
+    def register(self, metric):
+        """Add a metric to the registry and return it."""
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=(), collect=None):
+        """Create and register a counter."""
+        return self.register(Counter(name, help, labels, collect))
+
+    def gauge(self, name, help, labels=(), collect=None):
+        """Create and register a gauge."""
+        return self.register(Gauge(name, help, labels, collect))
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        """Create and register a histogram."""
+        return self.register(Histogram(name, help, buckets, labels))
+
+    def render(self):
+        """Return the text exposition of all the metrics."""
+        return "".join(metric.render(self.labels) + "\n"
+                       for metric in self._metrics)
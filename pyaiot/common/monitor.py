@@ -0,0 +1,137 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Event loop monitor.
+
+All the connections of a service are handled by a single event loop: a
+slow synchronous step delays all of them. The monitor measures the delay
+of a periodic timer on the loop (the loop lag) and logs the callbacks
+slower than a threshold with their origin.
+
+The callbacks are timed by the asyncio debug mode, which also tracks where
+the callbacks and coroutines are created: it slows the loop down a bit, so
+the monitor is only started on demand.
+"""
+
+import logging
+
+from tornado.ioloop import IOLoop
+
+from pyaiot.common.metrics import Registry
+
+logger = logging.getLogger("pyaiot.monitor")
+
+# Delay in seconds between two lag measures
+LAG_INTERVAL = 0.25
+
+# Duration in milliseconds above which a callback is logged
+SLOW_THRESHOLD = 100
+
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+               2.5, 5)
+
+# Warning logged by the asyncio debug mode for each slow callback
+SLOW_CALLBACK_MESSAGE = 'Executing %s took %.3f seconds'
+
+
+class LoopMonitor():
+    """Measure the lag of the event loop and log the slow callbacks.
+
+    The monitor filters the slow callback warnings of the asyncio logger to
+    record their duration.
+
+    :param registry: the metrics registry of the histograms
+    :param threshold: the duration in milliseconds above which a callback
+                      is logged
+    :param interval: the delay in seconds between two lag measures
+    """
+
+    def __init__(self, registry=None, threshold=SLOW_THRESHOLD,
+                 interval=LAG_INTERVAL):
+        if registry is None:
+            registry = Registry()
+        self.threshold = threshold / 1000
+        self.interval = interval
+        self.lag = registry.histogram(
+            "pyaiot_loop_lag_seconds",
+            "Delay of the timers of the event loop.", LAG_BUCKETS)
+        self.slow = registry.histogram(
+            "pyaiot_loop_slow_callback_seconds",
+            "Duration of the callbacks slower than the threshold.",
+            LAG_BUCKETS)
+        self._ioloop = None
+        self._expected = None
+        self._timeout = None
+        self._debug = None
+
+    def start(self):
+        """Start monitoring the current event loop."""
+        self._ioloop = IOLoop.current()
+        self._expected = self._ioloop.time() + self.interval
+        self._timeout = self._ioloop.call_at(self._expected, self._measure)
+
+        loop = self._ioloop.asyncio_loop
+        self._debug = (loop.get_debug(), loop.slow_callback_duration)
+        loop.set_debug(True)
+        loop.slow_callback_duration = self.threshold
+        logging.getLogger("asyncio").addFilter(self)
+
+    def stop(self):
+        """Stop monitoring the event loop."""
+        if self._timeout is None:
+            return
+        self._ioloop.remove_timeout(self._timeout)
+        self._timeout = None
+        loop = self._ioloop.asyncio_loop
+        debug, loop.slow_callback_duration = self._debug
+        loop.set_debug(debug)
+        logging.getLogger("asyncio").removeFilter(self)
+
+    def _measure(self):
+        now = self._ioloop.time()
+        self.lag.observe(max(0, now - self._expected))
+        self._expected = now + self.interval
+        self._timeout = self._ioloop.call_at(self._expected, self._measure)
+
+    def filter(self, record):
+        """Replace the slow callback warnings of the asyncio logger."""
+        if record.msg != SLOW_CALLBACK_MESSAGE:
+            return True
+        origin, duration = record.args
+        self.on_slow_callback(origin, duration)
+        return False
+
+    def on_slow_callback(self, origin, duration):
+        """Record and log a callback slower than the threshold.
+
+        :param origin: the description of the callback by asyncio
+        """
+        self.slow.observe(duration)
+        logger.warning("Slow callback blocked the event loop for %.3fs: %s",
+                       duration, origin)
@@ -0,0 +1,125 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""On-demand profiling of the services.
+
+The services started with start_application can be profiled without being
+restarted, by sending them signals:
+
+- SIGUSR1 starts a cProfile session, the next SIGUSR1 stops it and dumps
+  the stats to a '.prof' file, to be read with pstats or snakeviz,
+- SIGUSR2 starts tracing the memory allocations, the next SIGUSR2 writes
+  the allocations that grew in between to a '.txt' file and stops tracing.
+
+The files are written in the `profile_dir` directory.
+"""
+
+import os
+import time
+import logging
+import cProfile
+import tracemalloc
+
+logger = logging.getLogger("pyaiot.profiling")
+
+# Number of allocation sites written in a memory diff
+MEMORY_TOP = 50
+
+# The allocations of tracemalloc itself are not reported
+_FILTERS = (tracemalloc.Filter(False, tracemalloc.__file__),)
+
+
+class Profiler():
+    """Start and stop CPU and memory profiling sessions.
+
+    :param name: the name of the profiled service, used in the file names
+    :param directory: the directory the profiles are written to
+    """
+
+    def __init__(self, name, directory):
+        self.name = name
+        self.directory = directory
+        self._profile = None
+        self._snapshot = None
+
+    def _path(self, kind, extension):
+        return os.path.join(self.directory, "{}-{}-{}-{}.{}".format(
+            self.name, os.getpid(), kind,
+            time.strftime("%Y%m%d-%H%M%S"), extension))
+
+    def toggle_cpu(self):
+        """Start a cProfile session, or stop it and dump its stats.
+
+        :return the path of the stats file, None when starting
+        """
+        if self._profile is None:
+            logger.warning("Starting CPU profiling")
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+            return None
+        self._profile.disable()
+        path = self._path("cpu", "prof")
+        try:
+            self._profile.dump_stats(path)
+        except OSError as exc:
+            logger.error("Cannot write CPU profile: %s", exc)
+            path = None
+        else:
+            logger.warning("CPU profile written to %s", path)
+        self._profile = None
+        return path
+
+    def toggle_memory(self):
+        """Start tracing allocations, or stop and write the memory growth.
+
+        :return the path of the memory diff file, None when starting
+        """
+        if self._snapshot is None:
+            logger.warning("Starting memory tracing")
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self._snapshot = tracemalloc.take_snapshot().filter_traces(
+                _FILTERS)
+            return None
+        snapshot = tracemalloc.take_snapshot().filter_traces(_FILTERS)
+        tracemalloc.stop()
+        stats = snapshot.compare_to(self._snapshot, 'lineno')
+        self._snapshot = None
+        path = self._path("memory", "txt")
+        try:
+            with open(path, "w") as output:
+                output.write("Memory growth of {} ({}), top {}:\n".format(
+                    self.name, os.getpid(), MEMORY_TOP))
+                for stat in stats[:MEMORY_TOP]:
+                    output.write("{}\n".format(stat))
+        except OSError as exc:
+            logger.error("Cannot write memory diff: %s", exc)
+            return None
+        logger.warning("Memory diff written to %s", path)
+        return path
@@ -0,0 +1,125 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Pyaiot wire formats module.
+
+Messages are exchanged as JSON text by default. A gateway can send its
+messages to the broker in a binary format instead: the format is
+negotiated with a websocket subprotocol when the connection is opened and
+a broker that doesn't know it keeps using JSON. Binary formats require
+their optional dependency:
+
+- 'msgpack': MessagePack, requires the msgpack package.
+
+The broker decodes the binary messages and sends JSON to its clients.
+"""
+
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+WIRE_FORMATS = ('json', 'msgpack')
+SUBPROTOCOL_PREFIX = 'pyaiot.'
+
+
+def available_formats():
+    """Return the wire formats whose dependency is installed."""
+    return [wire_format for wire_format in WIRE_FORMATS
+            if wire_format == 'json' or
+            (wire_format == 'msgpack' and msgpack is not None)]
+
+
+def subprotocol(wire_format):
+    """Return the websocket subprotocol announcing a wire format.
+
+    >>> subprotocol('msgpack')
+    'pyaiot.msgpack'
+    """
+    return SUBPROTOCOL_PREFIX + wire_format
+
+
+def select_subprotocol(subprotocols):
+    """Return the first subprotocol of a supported binary format, or None.
+
+    >>> select_subprotocol(['chat', 'pyaiot.unknown']) is None
+    True
+    """
+    for offered in subprotocols:
+        wire_format = offered[len(SUBPROTOCOL_PREFIX):]
+        if (offered.startswith(SUBPROTOCOL_PREFIX) and
+                wire_format != 'json' and
+                wire_format in available_formats()):
+            return offered
+    return None
+
+
+def negotiated_format(selected_subprotocol):
+    """Return the wire format of the subprotocol selected by the broker.
+
+    >>> negotiated_format(None)
+    'json'
+    """
+    if (selected_subprotocol is None or
+            not selected_subprotocol.startswith(SUBPROTOCOL_PREFIX)):
+        return 'json'
+    return selected_subprotocol[len(SUBPROTOCOL_PREFIX):]
+
+
+def decode(raw, wire_format='json', loads=json.loads):
+    """Decode a received message.
+
+    Text messages are always JSON, only binary messages use the wire format.
+
+    :param loads: the function decoding JSON messages
+    :raise ValueError: if the message cannot be decoded
+    """
+    if wire_format == 'json' or isinstance(raw, str):
+        return loads(raw)
+    try:
+        return msgpack.unpackb(raw, raw=False)
+    except Exception as exc:
+        raise ValueError("Invalid {} message: {}".format(wire_format, exc))
+
+
+def encode(message, wire_format):
+    """Encode a message dict in the given binary wire format."""
+    return msgpack.packb(message, use_bin_type=True)
+
+
+def transcode(raw, wire_format, loads=json.loads):
+    """Convert a JSON text message to the given wire format.
+
+    :param loads: the function decoding JSON messages
+    """
+    if wire_format == 'json':
+        return raw
+    return encode(loads(raw), wire_format)
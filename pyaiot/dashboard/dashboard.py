@@ -75,8 +75,8 @@ class Dashboard(web.Application):
                     'template_path': options.static_path
                     }
         super().__init__(handlers, **settings)
-        logger.info('Application started, listening on port {0}'
-                    .format(options.web_port))
+        logger.info('Application started, listening on port %s',
+                    options.web_port)
 
 
 def extra_args():
@@ -113,10 +113,13 @@ def run(arguments=[]):
     try:
         parse_command_line(extra_args_func=extra_args)
     except SyntaxError as exc:
-        logger.error("Invalid config file: {}".format(exc))
+        logger.error("Invalid config file: %s", exc)
         return
     except FileNotFoundError as exc:
-        logger.error("Config file not found: {}".format(exc))
+        logger.error("Config file not found: %s", exc)
+        return
+    except ValueError as exc:
+        logger.error("Invalid options: %s", exc)
         return
 
     start_application(Dashboard(), port=options.web_port)
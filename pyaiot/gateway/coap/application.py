@@ -39,9 +39,6 @@ from pyaiot.common.helpers import start_application, parse_command_line
 
 from .gateway import CoapGateway, MAX_TIME, COAP_PORT
 
-logging.basicConfig(level=logging.DEBUG,
-                    format='%(asctime)s - %(name)14s - '
-                           '%(levelname)5s - %(message)s')
 logger = logging.getLogger("pyaiot.gw.coap")
 
 
@@ -62,10 +59,13 @@ def run(arguments=[]):
     try:
         parse_command_line(extra_args_func=extra_args)
     except SyntaxError as exc:
-        logger.critical("Invalid config file: {}".format(exc))
+        logger.critical("Invalid config file: %s", exc)
         return
     except FileNotFoundError as exc:
-        logger.error("Config file not found: {}".format(exc))
+        logger.error("Config file not found: %s", exc)
+        return
+    except ValueError as exc:
+        logger.error("Invalid options: %s", exc)
         return
 
     try:
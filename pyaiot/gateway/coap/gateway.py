@@ -72,7 +72,7 @@ def _coap_resource(url, method=GET, payload=b''):
     finally:
         yield from protocol.shutdown()
 
-    logger.debug('Code: {0} - Payload: {1}'.format(code, payload))
+    logger.debug('Code: %s - Payload: %s', code, payload)
 
     return code, payload
 
@@ -92,7 +92,7 @@ class CoapAliveResource(resource.Resource):
             remote = request.remote[0]
         except TypeError:
             remote = request.remote.sockaddr[0]
-        logger.debug("CoAP Alive POST received from {}".format(remote))
+        logger.debug("CoAP Alive POST received from %s", remote)
 
         # Let the controller handle this message
         self._gateway.handle_coap_check(remote, reset=(payload == 'reset'))
@@ -118,8 +118,8 @@ class CoapServerResource(resource.Resource):
             remote = request.remote[0]
         except TypeError:
             remote = request.remote.sockaddr[0]
-        logger.debug("CoAP POST received from {} with payload: {}"
-                     .format(remote, payload))
+        logger.debug("CoAP POST received from %s with payload: %s",
+                     remote, payload)
 
         path, data = payload.split(":", 1)
         self._gateway.handle_coap_post(remote, path, data)
@@ -159,7 +159,7 @@ class CoapGateway(GatewayBase):
         """Discover resources available on a node."""
         address = node.resources['ip']
         coap_node_url = 'coap://[{}]'.format(address)
-        logger.debug("Discovering CoAP node {}".format(address))
+        logger.debug("Discovering CoAP node %s", address)
         _, payload = yield _coap_resource('{0}/.well-known/core'
                                           .format(coap_node_url),
                                           method=GET)
@@ -167,7 +167,7 @@ class CoapGateway(GatewayBase):
         endpoints = [endpoint
                      for endpoint in _coap_endpoints(payload)
                      if 'well-known/core' not in endpoint]
-        logger.debug("Fetching CoAP node resources: {}".format(endpoints))
+        logger.debug("Fetching CoAP node resources: %s", endpoints)
 
         for endpoint in endpoints:
             elems = endpoint.split(';')
@@ -177,22 +177,21 @@ class CoapGateway(GatewayBase):
                 code, payload = yield _coap_resource(
                     '{0}{1}'.format(coap_node_url, path), method=GET)
             except:
-                logger.debug("Cannot discover resource {} on node {}"
-                             .format(endpoint, address))
+                logger.debug("Cannot discover resource %s on node %s",
+                             endpoint, address)
                 return
 
             # Remove '/' from path
             self.forward_data_from_node(node, path[1:], payload)
 
-        logger.debug("CoAP node resources '{}' sent to broker"
-                     .format(endpoints))
+        logger.debug("CoAP node resources '%s' sent to broker", endpoints)
 
     @gen.coroutine
     def update_node_resource(self, node, endpoint, payload):
         """"""
         address = node.resources['ip']
-        logger.debug("Updating CoAP node '{}' resource '{}'"
-                     .format(address, endpoint))
+        logger.debug("Updating CoAP node '%s' resource '%s'",
+                     address, endpoint)
         code, p = yield _coap_resource(
             'coap://[{0}]/{1}'.format(address, endpoint),
             method=PUT,
@@ -203,7 +202,7 @@ class CoapGateway(GatewayBase):
     def handle_coap_post(self, address, endpoint, value):
         """Handle CoAP post message sent from coap node."""
         if address not in self.node_mapping:
-            logger.debug("Unknown CoAP node '{}'".format(address))
+            logger.debug("Unknown CoAP node '%s'", address)
             return
         node = self.get_node(self.node_mapping[address])
         self.forward_data_from_node(node, endpoint, value)
@@ -233,6 +232,6 @@ class CoapGateway(GatewayBase):
         to_remove = [node for node in self.nodes.values()
                      if int(time.time()) > node.last_seen + self.max_time]
         for node in to_remove:
-            logger.info("Removing inactive node {}".format(node.uid))
+            logger.info("Removing inactive node %s", node.uid)
             self.node_mapping.pop(node.resources['ip'])
             self.remove_node(node)
@@ -29,22 +29,32 @@
 
 """Base class for gateways."""
 
-import json
+import time
 import logging
 from abc import ABCMeta, abstractmethod
 from tornado import web, gen
 from tornado.websocket import websocket_connect
 
 from pyaiot.common.auth import auth_token
-from pyaiot.common.messaging import check_broker_data, Message
+from pyaiot.common.batch import MessageBatcher
+from pyaiot.common.compression import (compression_options,
+                                       limit_window_bits, write_message)
+from pyaiot.common.messaging import (check_broker_data, codec, Message,
+                                     NodeMessage, NewMessage, OutMessage,
+                                     ResetMessage, UpdateMessage)
+from pyaiot.common.wire import (subprotocol, negotiated_format, encode,
+                                transcode)
 
 logger = logging.getLogger("pyaiot.gw.common.gateway")
+messages_logger = logging.getLogger("pyaiot.gw.common.gateway.messages")
 
 
 class GatewayBaseMixin():
     """Class that manages the internal behaviour of a node controller."""
 
     PROTOCOL = None
+    batcher = None
+    wire_format = 'json'
 
     def has_node(self, uid):
         """Check if the node uid is already present."""
@@ -55,9 +65,9 @@ class GatewayBaseMixin():
         """Add a new node to the list of nodes and notify the broker."""
         node.set_resource_value('protocol', self.PROTOCOL)
         self.nodes.update({node.uid: node})
-        self.send_to_broker(Message.new_node(node.uid))
+        self.send_to_broker(NewMessage(node.uid))
         for res, value in node.resources.items():
-            self.send_to_broker(Message.update_node(node.uid, res, value))
+            self.send_to_broker(UpdateMessage(node.uid, res, value))
         yield self.discover_node(node)
 
     def reset_node(self, node, default_resources={}):
@@ -66,14 +76,14 @@ class GatewayBaseMixin():
         node.set_resource_value('protocol', self.PROTOCOL)
         for resource, value in default_resources.items():
             node.set_resource_value(resource, value)
-        self.send_to_broker(Message.reset_node(node.uid))
+        self.send_to_broker(ResetMessage(node.uid))
         self.discover_node(node)
 
     def remove_node(self, node):
         """Remove the given node from known nodes and notify the broker."""
         self.nodes.pop(node.uid)
-        logger.debug("Remaining nodes {}".format(self.nodes))
-        self.send_to_broker(Message.out_node(node.uid))
+        logger.debug("Remaining nodes %s", self.nodes)
+        self.send_to_broker(OutMessage(node.uid))
 
     def get_node(self, uid):
         """Return the node matching the given uid."""
@@ -81,25 +91,39 @@ class GatewayBaseMixin():
 
     @gen.coroutine
     def forward_data_from_node(self, node, resource, value):
-        """Send data received from a node to the broker via the gateway."""
-        logger.debug("Sending data received from node '{}': '{}', '{}'."
-                     .format(node, resource, value))
+        """Send data received from a node to the broker via the gateway.
+
+        With latency tracing, the message carries the time the data was
+        received.
+        """
+        ts = time.time() if self.options.latency_tracing else None
+        messages_logger.debug(
+            "Sending data received from node '%s': '%s', '%s'.",
+            node, resource, value)
         node.set_resource_value(resource, value)
-        self.send_to_broker(Message.update_node(node.uid, resource, value))
+        self.send_to_broker(UpdateMessage(node.uid, resource, value, ts=ts))
 
     @gen.coroutine
     def fetch_nodes_cache(self, client):
         """Send cached nodes information to a given client.
 
+        The nodes are sent in snapshot messages when enabled: older brokers
+        don't understand them.
+
         :param client: the ID of the client
         """
-        logger.debug("Fetching cached information of registered nodes '{}'."
-                     .format(self.nodes))
+        logger.debug("Fetching cached information of registered nodes '%s'.",
+                     self.nodes)
+        if self.options.snapshot_messages:
+            nodes = {node.uid: node.resources for node in self.nodes.values()}
+            for message in Message.snapshot_chunks(nodes, dst=client):
+                self.send_to_broker(message)
+            return
         for node in self.nodes.values():
-            self.send_to_broker(Message.new_node(node.uid, dst=client))
+            self.send_to_broker(NewMessage(node.uid, dst=client))
             for resource, value in node.resources.items():
                 self.send_to_broker(
-                    Message.update_node(node.uid, resource, value, dst=client))
+                    UpdateMessage(node.uid, resource, value, dst=client))
 
     def close_client(self):
         """Close client websocket"""
@@ -110,12 +134,23 @@ class GatewayBaseMixin():
     def create_broker_connection(self, url):
         """Create an asynchronous connection to the broker."""
         while True:
+            # A binary wire format is only used when the broker accepts it
+            subprotocols = None
+            if self.options.wire_format != 'json':
+                subprotocols = [subprotocol(self.options.wire_format)]
             try:
-                self.broker = yield websocket_connect(url)
+                self.broker = yield websocket_connect(
+                    url, compression_options=compression_options(self.options),
+                    subprotocols=subprotocols)
             except ConnectionRefusedError:
                 logger.warning("Cannot connect, retrying in 3s")
             else:
-                logger.info("Connected to broker, sending auth token")
+                self.wire_format = negotiated_format(
+                    self.broker.selected_subprotocol)
+                logger.info("Connected to broker (%s), sending auth token",
+                            self.wire_format)
+                limit_window_bits(self.broker,
+                                  compression_options(self.options))
                 self.broker.write_message(auth_token(self.keys))
                 yield gen.sleep(1)
                 self.fetch_nodes_cache('all')
@@ -130,16 +165,42 @@ class GatewayBaseMixin():
 
     @gen.coroutine
     def send_to_broker(self, message):
-        """Send a string message to the parent broker."""
+        """Send a node message or a string message to the parent broker.
+
+        When batching is enabled, the message is grouped with the other
+        messages sent in the same time window.
+        """
+        if self.batcher is not None:
+            if isinstance(message, NodeMessage):
+                message = message.text
+            self.batcher.put(message)
+        else:
+            self.write_to_broker(message)
+
+    def write_to_broker(self, message):
+        """Write a node message or a string message on the broker websocket.
+
+        Node messages are encoded in the wire format of the connection.
+        """
         if self.broker is not None:
-            logger.debug("Sending message '{}' to broker.".format(message))
-            self.broker.write_message(message)
+            messages_logger.debug("Sending message '%s' to broker.", message)
+            binary = self.wire_format != 'json'
+            if binary and isinstance(message, NodeMessage):
+                message = encode(message.to_dict(), self.wire_format)
+            elif binary:
+                message = transcode(message, self.wire_format,
+                                    loads=codec.loads)
+            elif isinstance(message, NodeMessage):
+                message = message.text
+            write_message(self.broker, message,
+                          threshold=self.options.compression_threshold,
+                          binary=binary)
 
     def on_broker_message(self, message):
         """Handle a message received from the broker websocket."""
-        logger.debug("Handling message '{}' received from broker."
-                     .format(message))
-        message = json.loads(message)
+        messages_logger.debug("Handling message '%s' received from broker.",
+                              message)
+        message = codec.loads(message)
 
         if message['type'] == "new":
             # Received when a new client connects => fetching the nodes
@@ -148,8 +209,8 @@ class GatewayBaseMixin():
         elif (message['type'] == "update" and
               check_broker_data(message['data'])):
             data = message['data']
-            logger.debug("Forwarding message ('{}') received from broker to "
-                         "node".format(data))
+            messages_logger.debug("Forwarding message ('%s') received from "
+                                  "broker to node", data)
             # Received when a client update a node
             uid = data['uid']
             endpoint = data['endpoint']
@@ -159,8 +220,8 @@ class GatewayBaseMixin():
                     self.update_node_resource(node, endpoint, payload)
                     break
         else:
-            logger.debug("Invalid data received from broker '{}'."
-                         .format(message['data']))
+            logger.debug("Invalid data received from broker '%s'.",
+                         message['data'])
 
 
 class GatewayBase(web.Application, GatewayBaseMixin, metaclass=ABCMeta):
@@ -178,6 +239,10 @@ class GatewayBase(web.Application, GatewayBaseMixin, metaclass=ABCMeta):
         self.nodes = {}
         self.broker = None
         self.keys = keys
+        if options.batch_messages:
+            self.batcher = MessageBatcher(self.write_to_broker,
+                                          delay=options.batch_delay / 1000,
+                                          max_size=options.batch_max_size)
         settings = {'debug': True}
 
         # Create connection to broker
@@ -32,7 +32,6 @@
 import logging
 import time
 import uuid
-import json
 import asyncio
 
 from tornado import gen
@@ -41,9 +40,11 @@ from tornado.ioloop import PeriodicCallback
 from hbmqtt.client import MQTTClient, ClientException
 from hbmqtt.mqtt.constants import QOS_1
 
+from pyaiot.common.messaging import codec
 from pyaiot.gateway.common import Node, GatewayBase
 
 logger = logging.getLogger("pyaiot.gw.mqtt")
+messages_logger = logging.getLogger("pyaiot.gw.mqtt.messages")
 
 
 MQTT_HOST = 'localhost'
@@ -89,20 +90,20 @@ class MQTTGateway(GatewayBase):
                 # Blocked here until a message is received
                 message = yield from self.mqtt_client.deliver_message()
             except ClientException as ce:
-                logger.error("Client exception: {}".format(ce))
+                logger.error("Client exception: %s", ce)
                 break
             except Exception as exc:
-                logger.error("General exception: {}".format(exc))
+                logger.error("General exception: %s", exc)
                 break
             packet = message.publish_packet
             topic_name = packet.variable_header.topic_name
             try:
-                data = json.loads(packet.payload.data.decode('utf-8'))
+                data = codec.loads(packet.payload.data.decode('utf-8'))
             except:
                 # Skip data if not valid
                 continue
-            logger.debug("Received message from node: {} => {}"
-                         .format(topic_name, data))
+            messages_logger.debug("Received message from node: %s => %s",
+                                  topic_name, data)
             if topic_name.endswith("/check"):
                 asyncio.get_event_loop().create_task(
                     self.handle_node_check(data))
@@ -127,8 +128,8 @@ class MQTTGateway(GatewayBase):
         discover_topic = 'gateway/{}/discover'.format(node.resources['id'])
         yield from self.mqtt_client.publish(discover_topic, b"resources",
                                             qos=QOS_1)
-        logger.debug("Published '{}' to topic: {}"
-                     .format("resources", discover_topic))
+        messages_logger.debug("Published '%s' to topic: %s",
+                              "resources", discover_topic)
 
     @gen.coroutine
     def update_node_resource(self, node, endpoint, payload):
@@ -147,7 +148,7 @@ class MQTTGateway(GatewayBase):
 
             resources_topic = 'node/{}/resources'.format(node_id)
             yield from self.mqtt_client.subscribe([(resources_topic, QOS_1)])
-            logger.debug("Subscribed to topic: {}".format(resources_topic))
+            logger.debug("Subscribed to topic: %s", resources_topic)
 
             self.add_node(node)
         else:
@@ -191,7 +192,7 @@ class MQTTGateway(GatewayBase):
         to_remove = [node for node in self.nodes.values()
                      if int(time.time()) > node.last_seen + self.max_time]
         for node in to_remove:
-            logger.info("Removing inactive node {}".format(node.uid))
+            logger.info("Removing inactive node %s", node.uid)
             asyncio.get_event_loop().create_task(
                 self._disconnect_from_node(node))
             self.node_mapping.pop(node.resources['id'])
@@ -31,13 +31,13 @@
 
 import logging
 import uuid
-import json
 from tornado import gen, websocket
 
-from pyaiot.common.messaging import Message
+from pyaiot.common.messaging import Message, codec
 from pyaiot.gateway.common import GatewayBase, Node
 
 logger = logging.getLogger("pyaiot.gw.ws")
+messages_logger = logging.getLogger("pyaiot.gw.ws.messages")
 
 
 class WebsocketNodeHandler(websocket.WebSocketHandler):
@@ -87,8 +87,8 @@ class WebsocketGateway(GatewayBase):
 
         self.node_mapping = {}
 
-        logger.info('WS gateway started, listening on port {}'
-                    .format(options.gateway_port))
+        logger.info('WS gateway started, listening on port %s',
+                    options.gateway_port)
 
     @gen.coroutine
     def discover_node(self, node):
@@ -101,14 +101,15 @@ class WebsocketGateway(GatewayBase):
     def update_node_resource(self, node, resource, value):
         for ws, uid in self.node_mapping.items():
             if node.uid == uid:
-                ws.write_message(json.dumps({"endpoint": resource,
-                                             "payload": value}))
+                ws.write_message(codec.dumps({"endpoint": resource,
+                                              "payload": value}))
                 break
 
     def on_node_message(self, ws, message):
         """Handle a message received from a node websocket."""
         if message['type'] == "update":
-            logger.debug("New update message received from node websocket")
+            messages_logger.debug(
+                "New update message received from node websocket")
             for key, value in message['data'].items():
                 node = self.get_node(self.node_mapping[ws])
                 self.forward_data_from_node(node, key, value)
@@ -0,0 +1,128 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""pyaiot authentication test module."""
+
+import time
+
+from cryptography.fernet import Fernet
+from pytest import fixture, mark
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from pyaiot.common.auth import (Authenticator, Keys, auth_token,
+                                generate_private_key, generate_secret_key,
+                                verify_auth_token)
+
+
+class FakeConnection():
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+@fixture
+def keys():
+    return Keys(private=generate_private_key(), secret=generate_secret_key())
+
+
+def test_auth_token(keys):
+    token = auth_token(keys)
+    assert verify_auth_token(token, keys)
+    assert verify_auth_token(token.decode(), keys, ttl=60)
+
+
+@mark.parametrize('token', ['invalid', b'', 'é'])
+def test_invalid_auth_token(keys, token):
+    assert not verify_auth_token(token, keys)
+
+
+def test_auth_token_other_keys(keys):
+    other = Keys(private=generate_private_key(), secret=keys.secret)
+    assert not verify_auth_token(auth_token(other), keys)
+
+
+def test_auth_token_ttl(keys):
+    authenticator = Authenticator(keys, ttl=60)
+    token = Fernet(keys.private.encode()).encrypt_at_time(
+        keys.secret.encode(), int(time.time()) - 120)
+    assert verify_auth_token(token, keys)
+    assert not authenticator.verify(FakeConnection(), token)
+
+    # Tokens ahead of the broker clock are rejected as well
+    token = Fernet(keys.private.encode()).encrypt_at_time(
+        keys.secret.encode(), int(time.time()) + 120)
+    assert not authenticator.verify(FakeConnection(), token)
+
+    # By default, the token timestamp is not checked
+    assert Authenticator(keys).verify(FakeConnection(), token)
+
+
+def test_auth_token_replay(keys):
+    authenticator = Authenticator(keys, ttl=60)
+    token = auth_token(keys)
+    assert authenticator.verify(FakeConnection(), token)
+    assert not authenticator.verify(FakeConnection(), token)
+    assert authenticator.verify(FakeConnection(), auth_token(keys))
+
+    # Without ttl, tokens can be used again
+    authenticator = Authenticator(keys, ttl=0)
+    assert authenticator.verify(FakeConnection(), token)
+    assert authenticator.verify(FakeConnection(), token)
+
+
+def test_authenticator_max_pending(keys):
+    authenticator = Authenticator(keys, max_pending=2)
+    connections = [FakeConnection() for _ in range(3)]
+    assert [authenticator.admit(connection)
+            for connection in connections] == [True, True, False]
+
+    # Room is made as soon as a connection sent its token
+    authenticator.verify(connections[0], auth_token(keys))
+    assert authenticator.pending() == 1
+    assert authenticator.admit(connections[2])
+
+
+def test_authenticator_timeout(keys):
+    authenticator = Authenticator(keys, timeout=0.01)
+    late, on_time = FakeConnection(), FakeConnection()
+
+    @gen.coroutine
+    def authenticate():
+        authenticator.admit(late)
+        authenticator.admit(on_time)
+        authenticator.verify(on_time, auth_token(keys))
+        yield gen.sleep(0.05)
+
+    IOLoop.current().run_sync(authenticate)
+    assert late.closed
+    assert not on_time.closed
+    assert authenticator.pending() == 0
@@ -0,0 +1,975 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""pyaiot broker test module."""
+
+import json
+import socket
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+from pytest import fixture, mark, raises
+from tornado import gen, web
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream
+from tornado.testing import bind_unused_port
+
+from pyaiot.broker import federation
+from pyaiot.broker.broker import Broker
+from pyaiot.broker.bus import LocalBus, UnixSocketBus
+from pyaiot.broker.fanout import encode_frame
+from pyaiot.broker.outbound import OutboundQueue
+from pyaiot.common.auth import Keys
+from pyaiot.common.messaging import (Message, NodeMessage, NewMessage,
+                                     OutMessage, ResetMessage, UpdateMessage,
+                                     SnapshotMessage)
+
+
+class FakeStream():
+    """Stream recording the raw frames written to it."""
+
+    def __init__(self):
+        self.frames = []
+        self.is_closed = False
+        self.pending = None
+
+    def write(self, data):
+        self.frames.append(data)
+        return self.pending
+
+    def closed(self):
+        return self.is_closed
+
+
+class FakeClient():
+    """Stand-in for a client websocket handler."""
+
+    def __init__(self, uid, compressed=False, **queue_kwargs):
+        self.uid = uid
+        self.messages = []
+        self.close_code = None
+        self.ws_connection = SimpleNamespace(
+            stream=FakeStream(), mask_outgoing=False, server_terminated=False,
+            _compressor=object() if compressed else None)
+        self.ws_connection.is_closing = lambda: (
+            self.ws_connection.stream.closed() or
+            self.ws_connection.server_terminated)
+        self.queue = OutboundQueue(self, **queue_kwargs)
+
+    @property
+    def frames(self):
+        return self.ws_connection.stream.frames
+
+    def write_message(self, message, binary=False):
+        self.messages.append(message)
+
+    def close(self, code=None, reason=None):
+        self.close_code = code
+        self.ws_connection.stream.is_closed = True
+
+    def block(self):
+        """Make the next writes wait until the returned future is done."""
+        self.ws_connection.stream.pending = Future()
+        return self.ws_connection.stream.pending
+
+
+def broker_options(**kwargs):
+    """Return broker options with default values."""
+    options = dict(debug=False, broker_port=8000,
+                   client_queue_size=1000, client_queue_policy='drop-oldest',
+                   client_replay_size=1000, client_session_timeout=60,
+                   batch_messages=False, batch_delay=5, batch_max_size=65536,
+                   broker_id=None, broker_peers=[], peer_timeout=30,
+                   peer_replay_size=1000, auth_timeout=2, auth_token_ttl=60,
+                   auth_max_pending=1000, compression=False,
+                   compression_threshold=64, compression_window_bits=15,
+                   latency_trace_file=None, latency_trace_sample=100,
+                   history_depth=100, telemetry_log_dir=None,
+                   telemetry_log_segment_size=16,
+                   telemetry_log_retention_size=1024,
+                   telemetry_log_retention_age=3600,
+                   telemetry_log_sync_delay=1000)
+    options.update(kwargs)
+    return SimpleNamespace(**options)
+
+
+@fixture
+def broker():
+    return Broker(Keys(private='private', secret='secret'),
+                  options=broker_options())
+
+
+def add_clients(broker, count, **kwargs):
+    clients = [FakeClient(str(index), **kwargs) for index in range(count)]
+    for client in clients:
+        broker.on_client_message(client, {'type': 'new', 'data': 'client'})
+    return clients
+
+
+def add_gateway(broker):
+    gateway = FakeClient('gateway')
+    broker.gateways.add(gateway)
+    return gateway
+
+
+def decode_frames(data):
+    """Return the payloads of the websocket frames contained in data."""
+    payloads = []
+    while data:
+        length, offset = data[1] & 0x7f, 2
+        if length == 126:
+            length, offset = int.from_bytes(data[2:4], 'big'), 4
+        elif length == 127:
+            length, offset = int.from_bytes(data[2:10], 'big'), 10
+        payloads.append(data[offset:offset + length].decode())
+        data = data[offset + length:]
+    return payloads
+
+
+def received(client):
+    """Return the messages received by a client, decoded."""
+    return [json.loads(payload) for frame in client.frames
+            for payload in decode_frames(frame)]
+
+
+def test_broadcast_encodes_frame_once(broker):
+    clients = add_clients(broker, 5)
+    message = Message.update_node('1234', 'temperature', '22.5°C')
+    broker.broadcast(message)
+
+    frame = clients[0].frames[0]
+    assert frame == encode_frame(message)
+    for client in clients:
+        assert client.frames == [frame]
+        assert client.frames[0] is frame
+        assert client.messages == []
+
+
+def test_broadcast_skips_closing_client(broker):
+    closing, client = add_clients(broker, 2)
+    # The close frame was sent, the stream is still opened
+    closing.ws_connection.server_terminated = True
+    message = Message.out_node('1234')
+    broker.broadcast(message)
+
+    assert closing.frames == []
+    assert closing.queue.closed
+    assert client.frames == [encode_frame(message)]
+
+
+@mark.parametrize('size', [10, 200, 70000])
+def test_encode_frame_header(size):
+    message = json.dumps({'data': 'x' * size})
+    frame = encode_frame(message)
+    assert frame[0] == 0x81
+    assert frame.endswith(message.encode())
+    if len(message) < 126:
+        assert frame[1] == len(message)
+    elif len(message) <= 0xFFFF:
+        assert frame[1] == 126
+        assert int.from_bytes(frame[2:4], 'big') == len(message)
+    else:
+        assert frame[1] == 127
+        assert int.from_bytes(frame[2:10], 'big') == len(message)
+
+
+def test_broadcast_compressed_client_fallback(broker):
+    plain = add_clients(broker, 1)[0]
+    compressed = FakeClient('compressed', compressed=True)
+    broker.on_client_message(compressed, {'type': 'new', 'data': 'client'})
+    message = Message.out_node('1234')
+    broker.broadcast(message)
+
+    assert plain.frames == [encode_frame(message)]
+    assert compressed.frames == []
+    assert compressed.messages == [message]
+
+
+def test_queue_compression_threshold():
+    client = FakeClient('client', compressed=True, compression_threshold=64)
+    small = Message.out_node('1234')
+    large = Message.snapshot({'1234': {'name': 'x' * 100}})
+    client.queue.put(small)
+    client.queue.put(large)
+
+    # Small messages are written uncompressed
+    assert client.frames == [encode_frame(small)]
+    assert client.messages == [large]
+
+
+def test_queue_written_bytes():
+    plain = FakeClient('plain')
+    compressed = FakeClient('compressed', compressed=True)
+    message = Message.update_node('1234', 'temperature', '22.5°C')
+    for client in (plain, compressed):
+        client.queue.put(message)
+
+    # The payload bytes are counted, whatever the connection
+    assert plain.queue.written == len(message.encode())
+    assert compressed.queue.written == plain.queue.written
+
+
+def test_broadcast_skips_closed_client(broker):
+    closed, opened = add_clients(broker, 2)
+    closed.close()
+    message = Message.reset_node('1234')
+    broker.broadcast(message)
+
+    assert closed.frames == []
+    assert opened.frames == [encode_frame(message)]
+
+
+def update(uid, endpoint, value):
+    return Message.update_node(uid, endpoint, value), (uid, endpoint)
+
+
+def put_update(client, uid, endpoint, value):
+    message, key = update(uid, endpoint, value)
+    return client.queue.put(message, key=key)
+
+
+def test_queue_while_write_in_flight():
+    client = FakeClient('client')
+    pending = client.block()
+    client.queue.put('first')
+    client.queue.put('second')
+    client.queue.put('third')
+    assert client.frames == [encode_frame('first')]
+    assert len(client.queue) == 2
+
+    @gen.coroutine
+    def flush():
+        pending.set_result(None)
+        yield gen.moment
+        yield gen.moment
+
+    client.ws_connection.stream.pending = None
+    IOLoop.current().run_sync(flush)
+    assert client.frames[1] == encode_frame('second') + encode_frame('third')
+    assert len(client.queue) == 0
+
+
+def test_queue_drop_oldest():
+    client = FakeClient('client', maxsize=2, policy='drop-oldest')
+    client.block()
+    for value in range(5):
+        put_update(client, 'node', 'temperature', value)
+    # First message is in flight, last 2 ones are queued
+    assert client.queue.stats() == {
+        'depth': 2, 'max_depth': 2, 'dropped': 2, 'conflated': 0}
+
+
+def test_queue_conflate():
+    client = FakeClient('client', maxsize=2, policy='conflate')
+    client.block()
+    client.queue.put(Message.new_node('node'))
+    for value in range(5):
+        put_update(client, 'node', 'temperature', value)
+    put_update(client, 'node', 'pressure', 1)
+    put_update(client, 'node', 'temperature', 5)
+    assert client.queue.stats() == {
+        'depth': 2, 'max_depth': 2, 'dropped': 0, 'conflated': 5}
+    assert [message for message, _ in client.queue._pending.values()] == [
+        update('node', 'pressure', 1)[0], update('node', 'temperature', 5)[0]]
+
+
+def test_queue_disconnect():
+    client = FakeClient('client', maxsize=2, policy='disconnect')
+    client.block()
+    for value in range(3):
+        assert put_update(client, 'node', 'temperature', value)
+    assert not put_update(client, 'node', 'temperature', 4)
+    assert client.close_code == 1008
+    assert client.queue.closed
+    assert not put_update(client, 'node', 'temperature', 5)
+    assert client.queue.stats()['dropped'] == 3
+
+
+def test_queue_invalid_policy():
+    with raises(ValueError):
+        OutboundQueue(None, policy='invalid')
+
+
+def test_clients_stats(broker):
+    clients = add_clients(broker, 2, maxsize=1)
+    clients[0].block()
+    for value in range(3):
+        broker.broadcast(Message.update_node('node', 'temperature', value),
+                         node_uid='node', endpoint='temperature')
+    stats = broker.clients_stats()
+    assert stats['0']['dropped'] == 1
+    assert stats['1']['dropped'] == 0
+
+
+def test_subscriptions_routing(broker):
+    gateway = add_gateway(broker)
+    everything, temperature, node = add_clients(broker, 3)
+    broker.on_client_message(temperature, json.loads(
+        Message.subscribe([{'endpoint': 'temperature'}])))
+    broker.on_client_message(node, json.loads(
+        Message.subscribe([{'uid': 'node1', 'endpoint': '*'}])))
+    for uid in ('node1', 'node2'):
+        broker.on_gateway_message(gateway, NewMessage(uid))
+        for endpoint in ('temperature', 'pressure'):
+            broker.on_gateway_message(gateway,
+                                      UpdateMessage(uid, endpoint, 42))
+
+    assert len(received(everything)) == 6
+    assert [(msg['type'], msg['uid'], msg.get('endpoint'))
+            for msg in received(temperature)] == [
+        ('new', 'node1', None), ('update', 'node1', 'temperature'),
+        ('new', 'node2', None), ('update', 'node2', 'temperature')]
+    assert [(msg['type'], msg['uid'], msg.get('endpoint'))
+            for msg in received(node)] == [
+        ('new', 'node1', None), ('update', 'node1', 'temperature'),
+        ('update', 'node1', 'pressure')]
+    # Subscriptions are not forwarded to gateways
+    assert [json.loads(msg)['type'] for msg in gateway.messages] == [
+        'new', 'new', 'new']
+
+
+def test_unsubscribe(broker):
+    gateway = add_gateway(broker)
+    client = add_clients(broker, 1)[0]
+    broker.on_client_message(client, json.loads(
+        Message.subscribe([{'uid': 'node1'}, {'uid': 'node2'}])))
+    broker.on_client_message(client, json.loads(
+        Message.unsubscribe([{'uid': 'node1'}])))
+    broker.on_gateway_message(gateway, NewMessage('node1'))
+    broker.on_gateway_message(gateway, NewMessage('node2'))
+
+    assert [msg['uid'] for msg in received(client)] == ['node2']
+    assert broker.subscriptions.filters(client.uid) == {('node2', '*')}
+
+
+def test_subscriptions_removed_with_client(broker):
+    client = add_clients(broker, 1)[0]
+    broker.on_client_message(client, json.loads(
+        Message.subscribe({'uid': 'node1'})))
+    broker.remove_ws(client.uid)
+
+    assert client.uid not in broker.subscriptions
+    assert broker.subscriptions.match_node('node1') == set()
+
+
+def test_subscriptions_removed_with_unregistered_client(broker):
+    # The client subscribes and disconnects without a 'new' message
+    client = FakeClient('client')
+    broker.on_client_message(client, json.loads(
+        Message.subscribe({'uid': 'node1', 'endpoint': 'led'})))
+    broker.remove_ws(client.uid)
+
+    assert client.uid not in broker.subscriptions
+    assert broker.subscriptions.match('node1', 'led') == set()
+    assert broker.subscriptions.match_node('node1') == set()
+
+
+def test_invalid_subscription_ignored(broker):
+    client = add_clients(broker, 1)[0]
+    broker.on_client_message(client, {'type': 'subscribe', 'data': 'node'})
+
+    assert client.uid not in broker.subscriptions
+    assert client.uid in broker.subscriptions.unfiltered
+
+
+def add_session_client(broker, uid='session'):
+    client = FakeClient(uid)
+    broker.on_client_message(client, {'type': 'new', 'data': 'client',
+                                      'session': True})
+    return client
+
+
+def resume(broker, uid, session, seq):
+    client = FakeClient(uid)
+    broker.on_client_message(client, json.loads(Message.resume(session, seq)))
+    return client
+
+
+def test_session_sequence_numbers(broker):
+    gateway = add_gateway(broker)
+    legacy = add_clients(broker, 1)[0]
+    session = add_session_client(broker)
+    broker.on_gateway_message(gateway, NewMessage('node1'))
+    broker.on_gateway_message(gateway, UpdateMessage('node1', 'led', '1'))
+
+    assert received(session) == [
+        {'type': 'session', 'session': session.uid, 'seq': 0,
+         'resumed': False},
+        {'seq': 1, 'type': 'new', 'uid': 'node1', 'dst': 'all'},
+        {'seq': 2, 'type': 'update', 'uid': 'node1', 'endpoint': 'led',
+         'data': '1', 'dst': 'all'}]
+    # Clients without session still receive the messages as sent by the
+    # gateway
+    assert legacy.frames == [encode_frame(Message.new_node('node1')),
+                             encode_frame(Message.update_node('node1', 'led',
+                                                              '1'))]
+
+    # Messages sent to a single client carry the last sequence number
+    late = add_session_client(broker, 'late')
+    assert [message.get('seq') for message in received(late)] == [2, 2]
+
+
+def test_session_resume_replays_missed_messages(broker):
+    gateway = add_gateway(broker)
+    client = add_session_client(broker)
+    broker.on_client_message(client, json.loads(
+        Message.subscribe({'uid': 'node1'})))
+    broker.on_gateway_message(gateway, NewMessage('node1'))
+    broker.remove_ws(client.uid)
+    for uid in ('node1', 'node2'):
+        broker.on_gateway_message(gateway, UpdateMessage(uid, 'led', '0'))
+    gateway.messages.clear()
+
+    resumed = resume(broker, 'other', client.uid, 1)
+    assert resumed.uid == client.uid
+    assert received(resumed) == [
+        {'type': 'session', 'session': client.uid, 'seq': 1,
+         'resumed': True},
+        {'seq': 2, 'type': 'update', 'uid': 'node1', 'endpoint': 'led',
+         'data': '0', 'dst': 'all'}]
+    assert broker.subscriptions.filters(client.uid) == {('node1', '*')}
+    # Gateways are not asked for the state of their nodes
+    assert gateway.messages == []
+
+
+def test_session_resume_falls_back_to_snapshot():
+    broker = Broker(Keys(private='private', secret='secret'),
+                    options=broker_options(client_replay_size=2))
+    gateway = add_gateway(broker)
+    client = add_session_client(broker)
+    broker.remove_ws(client.uid)
+    for value in range(3):
+        broker.on_gateway_message(gateway,
+                                  NewMessage('node{}'.format(value)))
+    empty_gateway = add_gateway(broker)
+
+    resumed = resume(broker, 'other', client.uid, 0)
+    messages = received(resumed)
+    assert messages[0] == {'type': 'session', 'session': 'other', 'seq': 3,
+                           'resumed': False}
+    assert messages[1]['type'] == 'snapshot'
+    assert sorted(messages[1]['nodes']) == ['node0', 'node1', 'node2']
+    assert messages[1]['seq'] == 3
+    # Like a new client, the gateways without known nodes are queried
+    assert json.loads(empty_gateway.messages[0]) == {
+        'type': 'new', 'data': 'client', 'src': 'other'}
+
+    # Unknown sessions are new sessions too
+    assert received(resume(broker, 'unknown', 'invalid', 3))[0] == {
+        'type': 'session', 'session': 'unknown', 'seq': 3, 'resumed': False}
+
+
+def test_session_resume_replaces_previous_connection(broker):
+    gateway = add_gateway(broker)
+    client = add_session_client(broker)
+    broker.on_gateway_message(gateway, NewMessage('node1'))
+
+    session = client.uid
+    resumed = resume(broker, 'other', session, 1)
+    assert client.ws_connection.stream.closed()
+    assert broker.clients == {session: resumed}
+    broker.on_gateway_message(gateway, OutMessage('node1'))
+    assert [message['seq'] for message in received(resumed)] == [1, 2]
+
+
+def test_new_client_served_from_cache(broker):
+    gateway = add_gateway(broker)
+    broker.on_gateway_message(gateway, NewMessage('node1'))
+    broker.on_gateway_message(
+        gateway, UpdateMessage('node1', 'temperature', '21'))
+    broker.on_gateway_message(
+        gateway, UpdateMessage('node1', 'temperature', '22'))
+    empty_gateway = add_gateway(broker)
+
+    client = add_clients(broker, 1)[0]
+    assert received(client) == [
+        {'type': 'snapshot', 'nodes': {'node1': {'temperature': '22'}},
+         'dst': client.uid}]
+    # Only the gateway without known nodes is queried
+    assert gateway.messages == []
+    assert len(empty_gateway.messages) == 1
+
+
+def test_cache_follows_gateway_messages(broker):
+    gateway = add_gateway(broker)
+    for uid in ('node1', 'node2'):
+        broker.on_gateway_message(gateway, NewMessage(uid))
+        broker.on_gateway_message(gateway, UpdateMessage(uid, 'led', '1'))
+    broker.on_gateway_message(gateway, ResetMessage('node1'))
+    broker.on_gateway_message(gateway, OutMessage('node2'))
+    assert dict(broker.cache) == {'node1': {}}
+
+    broker.remove_ws(gateway)
+    assert len(broker.cache) == 0
+
+
+def test_gateway_messages_forwarded_as_received(broker):
+    gateway = add_gateway(broker)
+    client = add_clients(broker, 1)[0]
+    texts = ['{"type":"new","uid":"node1","dst":"all"}',
+             '{"type":"update","uid":"node1","endpoint":"led",'
+             '"data":{"on": [1, 2.50]},"dst":"all"}']
+    messages, reason = Message.node_messages(Message.batch(texts))
+    for message in messages:
+        broker.on_gateway_message(gateway, message)
+    assert [payload for frame in client.frames
+            for payload in decode_frames(frame)] == texts
+    assert broker.cache.nodes() == {'node1': {'led': {'on': [1, 2.5]}}}
+
+
+def test_commands_sent_to_owning_gateway(broker):
+    gateways = [add_gateway(broker) for _ in range(3)]
+    for index, gateway in enumerate(gateways):
+        broker.on_gateway_message(
+            gateway, NewMessage('node{}'.format(index)))
+    client = add_clients(broker, 1)[0]
+    command = {'type': 'update', 'src': client.uid,
+               'data': {'uid': 'node1', 'endpoint': 'led', 'payload': '0'}}
+    broker.on_client_message(client, command)
+    assert [len(gateway.messages) for gateway in gateways] == [0, 1, 0]
+
+    # Unknown nodes have no gateway to send the command to
+    command['data']['uid'] = 'unknown'
+    broker.on_client_message(client, command)
+    assert [len(gateway.messages) for gateway in gateways] == [0, 1, 0]
+
+    # Invalid uids are dropped
+    for uid in (['node1'], {'uid': 'node1'}, None):
+        command['data']['uid'] = uid
+        broker.on_client_message(client, command)
+    assert [len(gateway.messages) for gateway in gateways] == [0, 1, 0]
+
+
+def test_node_moved_to_other_gateway(broker):
+    gateways = [add_gateway(broker) for _ in range(2)]
+    for gateway in gateways:
+        broker.on_gateway_message(gateway,
+                                  NewMessage('node1'))
+    assert broker.gateways.owner('node1') is gateways[1]
+
+    # The previous gateway doesn't own the node anymore
+    broker.on_gateway_message(gateways[0],
+                              OutMessage('node1'))
+    assert 'node1' in broker.cache
+    broker.remove_ws(gateways[0])
+    assert 'node1' in broker.cache
+
+
+def test_gateway_snapshot(broker):
+    gateway = add_gateway(broker)
+    everything, subscribed = add_clients(broker, 2)
+    broker.on_client_message(subscribed, json.loads(
+        Message.subscribe({'uid': 'node2', 'endpoint': 'led'})))
+    nodes = {'node1': {'led': '0', 'temperature': '21'},
+             'node2': {'led': '1', 'temperature': '22'}}
+    broker.on_gateway_message(gateway, SnapshotMessage(nodes))
+
+    assert everything.frames == [encode_frame(Message.snapshot(nodes))]
+    assert received(subscribed) == [
+        {'type': 'snapshot', 'nodes': {'node2': {'led': '1'}},
+         'dst': subscribed.uid}]
+    assert broker.gateways.nodes(gateway) == {'node1', 'node2'}
+    assert broker.cache.nodes() == nodes
+
+
+def test_cached_snapshot_chunks(broker):
+    gateway = add_gateway(broker)
+    nodes = {'node{}'.format(index): {'text': 'x' * 1000}
+             for index in range(200)}
+    broker.on_gateway_message(gateway, SnapshotMessage(nodes))
+    client = add_clients(broker, 1)[0]
+
+    snapshots = received(client)
+    assert len(snapshots) > 1
+    merged = {}
+    for snapshot in snapshots:
+        merged.update(snapshot['nodes'])
+    assert merged == nodes
+
+
+def test_queue_batch():
+    client = FakeClient('client', batch_delay=0.001)
+    messages = [Message.update_node('node', 'led', value)
+                for value in range(3)]
+
+    @gen.coroutine
+    def send():
+        for message in messages:
+            client.queue.put(message)
+        assert client.frames == []
+        yield gen.sleep(0.01)
+
+    IOLoop.current().run_sync(send)
+    assert client.frames == [encode_frame(Message.batch(messages))]
+
+
+def test_queue_batch_max_size():
+    client = FakeClient('client', batch_delay=10, batch_max_size=250)
+    messages = [Message.update_node('node', 'led', 'x' * 30)
+                for _ in range(3)]
+    for message in messages:
+        client.queue.put(message)
+    # Size limit reached by the third message, batches are kept smaller
+    # than the limit
+    assert received(client) == [
+        {'type': 'batch', 'messages': [json.loads(messages[0]),
+                                       json.loads(messages[1])]},
+        json.loads(messages[2])]
+    client.queue.close()
+
+
+def test_gateway_removal_batched(broker):
+    gateway = add_gateway(broker)
+    client = add_clients(broker, 1, batch_delay=0)[0]
+    for index in range(50):
+        broker.on_gateway_message(gateway, NewMessage('node{}'.format(index)))
+
+    @gen.coroutine
+    def remove():
+        yield gen.sleep(0.01)
+        client.frames.clear()
+        broker.remove_ws(gateway)
+        yield gen.sleep(0.01)
+
+    IOLoop.current().run_sync(remove)
+    assert len(client.frames) == 1
+    batch = received(client)[0]
+    assert batch['type'] == 'batch'
+    assert [message['type'] for message in batch['messages']] == ['out'] * 50
+
+
+@fixture
+def workers():
+    hub = {}
+    return [Broker(Keys(private='private', secret='secret'),
+                   options=broker_options(), bus=LocalBus(hub, worker_id))
+            for worker_id in range(2)]
+
+
+def gateway_send(broker, gateway, raw):
+    """Handle a gateway message like the gateway websocket handler."""
+    broker.relay('gateway', raw)
+    broker.on_gateway_message(gateway, NodeMessage.from_text(raw))
+
+
+def test_workers_relay_gateway_messages(workers):
+    gateway = add_gateway(workers[0])
+    client = add_clients(workers[1], 1)[0]
+    gateway_send(workers[0], gateway, Message.new_node('node1'))
+    gateway_send(workers[0], gateway,
+                 Message.update_node('node1', 'led', '1'))
+
+    assert [message['type'] for message in received(client)] == [
+        'new', 'update']
+    assert workers[1].cache.nodes() == {'node1': {'led': '1'}}
+
+    # Client commands reach the gateway through the worker owning it
+    workers[1].on_client_message(client, {
+        'type': 'update', 'src': client.uid,
+        'data': {'uid': 'node1', 'endpoint': 'led', 'payload': '0'}})
+    assert json.loads(gateway.messages[-1])['data']['payload'] == '0'
+
+    # Nodes are out when their gateway is gone
+    workers[0].remove_ws(gateway)
+    assert received(client)[-1] == {'type': 'out', 'uid': 'node1'}
+    assert len(workers[1].cache) == 0
+
+
+def test_workers_state_sync(workers):
+    gateway = add_gateway(workers[0])
+    gateway_send(workers[0], gateway, Message.snapshot({'node1': {}}))
+    hub = workers[0].bus.hub
+    worker = Broker(Keys(private='private', secret='secret'),
+                    options=broker_options(), bus=LocalBus(hub, 2))
+    assert worker.cache.nodes() == {'node1': {}}
+
+    # Nodes of a lost worker are out
+    client = add_clients(worker, 1)[0]
+    workers[0].bus.close()
+    assert received(client)[-1] == {'type': 'out', 'uid': 'node1'}
+
+
+def test_unix_socket_bus(tmpdir):
+    received_messages = []
+    peers = []
+    buses = [UnixSocketBus(str(tmpdir), worker_id, 2)
+             for worker_id in range(2)]
+
+    @gen.coroutine
+    def relay():
+        for bus in buses:
+            bus.start(lambda *args: received_messages.append(args),
+                      peers.append, lambda worker_id: None)
+        while len(peers) < 2:
+            yield gen.sleep(0.01)
+        buses[0].publish('gateway', Message.new_node('node1'))
+        buses[1].send(0, 'client', Message.out_node('node1'))
+        # Gateway messages are relayed as received, newlines included
+        buses[0].publish('gateway', multiline)
+        while len(received_messages) < 3:
+            yield gen.sleep(0.01)
+        for bus in buses:
+            bus.close()
+
+    multiline = json.dumps({'type': 'new', 'uid': 'nœud', 'dst': 'all'},
+                           indent=2, ensure_ascii=False)
+    IOLoop.current().run_sync(relay, timeout=5)
+    assert sorted(received_messages) == sorted([
+        (0, 'gateway', Message.new_node('node1')),
+        (0, 'gateway', multiline),
+        (1, 'client', Message.out_node('node1'))])
+
+
+def test_unix_socket_bus_invalid_data(tmpdir):
+    lost = []
+    bus = UnixSocketBus(str(tmpdir), 0, 1)
+
+    @gen.coroutine
+    def send_invalid():
+        bus.start(lambda *args: None, lambda worker_id: None, lost.append)
+        stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        yield stream.connect(bus.socket_path(0))
+        yield stream.write(b'hello 1\ngateway invalid\n')
+        while not lost:
+            yield gen.sleep(0.01)
+        bus.close()
+
+    IOLoop.current().run_sync(send_invalid, timeout=5)
+    assert lost == [1]
+
+
+class PeerConnection():
+    """In-memory end of a connection between two peered brokers."""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.other = None
+        self.closed = False
+        self.sent = []
+
+    def write_message(self, text):
+        if not self.closed:
+            self.sent.append(text)
+
+    def close(self):
+        self.closed = True
+
+
+def peer_brokers(*ids, **kwargs):
+    return {broker_id: Broker(Keys(private='private', secret='secret'),
+                              options=broker_options(broker_id=broker_id,
+                                                     **kwargs))
+            for broker_id in ids}
+
+
+def connect_peers(first, second):
+    """Connect two brokers and exchange the messages until idle."""
+    connections = PeerConnection(second), PeerConnection(first)
+    connections[0].other, connections[1].other = connections[1], connections[0]
+    first.federation.open(connections[0])
+    second.federation.open(connections[1])
+    return connections
+
+
+def deliver(*connections):
+    """Deliver the messages sent on the peer connections until idle."""
+    while any(connection.sent for connection in connections):
+        for connection in connections:
+            sent, connection.sent = connection.sent, []
+            for text in sent:
+                connection.broker.federation.on_connection_message(
+                    connection.other, text)
+
+
+def disconnect_peers(connections):
+    for connection in connections:
+        connection.close()
+        connection.other.broker.federation.close(connection)
+
+
+def test_federation_relay():
+    brokers = peer_brokers('a', 'b', 'c')
+    links = (connect_peers(brokers['a'], brokers['b']) +
+             connect_peers(brokers['b'], brokers['c']))
+    deliver(*links)
+    gateway = add_gateway(brokers['a'])
+    client = add_clients(brokers['c'], 1)[0]
+    gateway_send(brokers['a'], gateway, Message.new_node('node1'))
+    gateway_send(brokers['a'], gateway,
+                 Message.update_node('node1', 'led', '1'))
+    deliver(*links)
+
+    assert [message['type'] for message in received(client)] == [
+        'new', 'update']
+    assert brokers['c'].cache.nodes() == {'node1': {'led': '1'}}
+
+    # Client commands reach the gateway through the peers
+    brokers['c'].on_client_message(client, {
+        'type': 'update', 'src': client.uid,
+        'data': {'uid': 'node1', 'endpoint': 'led', 'payload': '0'}})
+    deliver(*links)
+    assert json.loads(gateway.messages[-1])['data']['payload'] == '0'
+
+
+def test_federation_mesh_without_duplicates():
+    brokers = peer_brokers('a', 'b', 'c')
+    links = (connect_peers(brokers['a'], brokers['b']) +
+             connect_peers(brokers['b'], brokers['c']) +
+             connect_peers(brokers['c'], brokers['a']))
+    deliver(*links)
+    gateway = add_gateway(brokers['a'])
+    client = add_clients(brokers['b'], 1)[0]
+    gateway_send(brokers['a'], gateway, Message.new_node('node1'))
+    for value in range(3):
+        gateway_send(brokers['a'], gateway,
+                     Message.update_node('node1', 'led', value))
+    deliver(*links)
+
+    assert [message.get('data') for message in received(client)] == [
+        None, 0, 1, 2]
+
+
+def test_federation_link_flap_replays_missed_messages():
+    brokers = peer_brokers('a', 'b')
+    links = connect_peers(brokers['a'], brokers['b'])
+    deliver(*links)
+    gateway = add_gateway(brokers['a'])
+    gateway_send(brokers['a'], gateway, Message.new_node('node1'))
+    deliver(*links)
+
+    disconnect_peers(links)
+    client = add_clients(brokers['b'], 1)[0]
+    gateway_send(brokers['a'], gateway,
+                 Message.update_node('node1', 'led', '1'))
+    assert brokers['b'].cache.nodes() == {'node1': {}}
+
+    links = connect_peers(brokers['a'], brokers['b'])
+    # Only the missed update is sent, no state of all the nodes
+    deliver(links[1])
+    sent = [json.loads(text)['type'] for text in links[0].sent]
+    assert sent == ['hello', 'relay']
+    deliver(*links)
+    assert received(client)[-1]['data'] == '1'
+    assert brokers['b'].cache.nodes() == {'node1': {'led': '1'}}
+
+
+def test_federation_sync_when_replay_is_too_short():
+    brokers = peer_brokers('a', 'b', peer_replay_size=2)
+    links = connect_peers(brokers['a'], brokers['b'])
+    deliver(*links)
+    gateway = add_gateway(brokers['a'])
+    gateway_send(brokers['a'], gateway, Message.new_node('node1'))
+    gateway_send(brokers['a'], gateway, Message.new_node('node2'))
+    deliver(*links)
+
+    disconnect_peers(links)
+    gateway_send(brokers['a'], gateway, Message.out_node('node1'))
+    for value in range(3):
+        gateway_send(brokers['a'], gateway,
+                     Message.update_node('node2', 'led', value))
+
+    links = connect_peers(brokers['a'], brokers['b'])
+    deliver(*links)
+    assert brokers['b'].cache.nodes() == {'node2': {'led': 2}}
+
+
+def test_federation_lost_peer_expires():
+    brokers = peer_brokers('a', 'b')
+    links = connect_peers(brokers['a'], brokers['b'])
+    deliver(*links)
+    gateway = add_gateway(brokers['a'])
+    gateway_send(brokers['a'], gateway, Message.new_node('node1'))
+    deliver(*links)
+    client = add_clients(brokers['b'], 1)[0]
+
+    disconnect_peers(links)
+    assert brokers['b'].cache.nodes() == {'node1': {}}
+    link = brokers['b'].federation.links['a']
+    brokers['b'].federation.expire(link)
+    assert received(client)[-1] == {'type': 'out', 'uid': 'node1'}
+    assert link not in brokers['b'].gateways
+
+
+def test_federation_retries_handshake_errors(monkeypatch):
+    attempts = []
+
+    class UnavailableHandler(web.RequestHandler):
+        def get(self):
+            attempts.append(self.request.path)
+            self.set_status(503)
+
+    monkeypatch.setattr(federation, 'RECONNECT_DELAY', 0.01)
+    sock, port = bind_unused_port()
+    server = HTTPServer(web.Application([(r"/peer", UnavailableHandler)]))
+    server.add_sockets([sock])
+    broker = peer_brokers('a')['a']
+
+    @gen.coroutine
+    def connect():
+        broker.federation.connect("ws://127.0.0.1:{}/peer".format(port))
+        while len(attempts) < 2:
+            yield gen.sleep(0.01)
+
+    IOLoop.current().run_sync(connect, timeout=5)
+    server.stop()
+    assert attempts == ['/peer', '/peer']
+
+
+@mark.parametrize('owner', ['a', 'b'])
+def test_federation_link_expires_in_mesh(owner):
+    brokers = peer_brokers('a', 'b', 'c')
+    links = (connect_peers(brokers['a'], brokers['b']) +
+             connect_peers(brokers['b'], brokers['c']) +
+             connect_peers(brokers['c'], brokers['a']))
+    deliver(*links)
+    gateway = add_gateway(brokers['a'])
+    gateway_send(brokers['a'], gateway, Message.new_node('node1'))
+    deliver(*links)
+    # The node is reached from c through the link with a or with b
+    federation = brokers['c'].federation
+    brokers['c'].gateways.add_node(federation.links[owner], 'node1')
+    client = add_clients(brokers['c'], 1)[0]
+    client.frames.clear()
+
+    disconnect_peers(links[:2])
+    for first, second in (('a', 'b'), ('b', 'a')):
+        federation = brokers[first].federation
+        federation.expire(federation.links[second])
+    deliver(*links[2:])
+    gateway_send(brokers['a'], gateway,
+                 Message.update_node('node1', 'led', '1'))
+    deliver(*links[2:])
+
+    types = [message['type'] for message in received(client)]
+    assert types == (['update'] if owner == 'a' else
+                     ['out', 'new', 'update'])
+    for broker_id in ('b', 'c'):
+        assert brokers[broker_id].cache.nodes() == {'node1': {'led': '1'}}
+    assert brokers['c'].node_gateway('node1') == 'peer:a'
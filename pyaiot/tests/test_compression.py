@@ -0,0 +1,107 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""pyaiot websocket compression test module."""
+
+from types import SimpleNamespace
+
+from pytest import mark, raises
+from tornado import gen, web, websocket
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+
+from pyaiot.common.compression import (check_window_bits,
+                                       compression_options,
+                                       limit_window_bits, write_message)
+
+
+class RecordingHandler(websocket.WebSocketHandler):
+
+    def get_compression_options(self):
+        return self.application.settings['compression']
+
+    def open(self):
+        limit_window_bits(self, self.get_compression_options())
+        self.write_message('opened')
+
+    def on_message(self, message):
+        self.application.settings['received'].append(message)
+
+
+def options(**kwargs):
+    values = dict(compression=True, compression_level=6,
+                  compression_window_bits=15)
+    values.update(kwargs)
+    return SimpleNamespace(**values)
+
+
+def test_compression_options():
+    assert compression_options(options(compression=False)) is None
+    assert compression_options(options(compression_level=1)) == {
+        'compression_level': 1, 'max_wbits': 15}
+
+
+def test_check_window_bits():
+    check_window_bits(9)
+    check_window_bits(15)
+    for window_bits in (8, 16):
+        with raises(ValueError):
+            check_window_bits(window_bits)
+
+
+@mark.parametrize('window_bits', [9, 15])
+def test_write_message(window_bits):
+    received = []
+    compression = compression_options(
+        options(compression_window_bits=window_bits))
+    app = web.Application([(r"/ws", RecordingHandler)],
+                          compression=compression, received=received)
+    sock, port = bind_unused_port()
+    server = HTTPServer(app)
+    server.add_sockets([sock])
+    messages = ['small', 'x' * 1000, 'small again', 'y' * 1000]
+
+    @gen.coroutine
+    def send():
+        connection = yield websocket.websocket_connect(
+            "ws://127.0.0.1:{}/ws".format(port),
+            compression_options=compression)
+        assert connection.protocol._compressor is not None
+        limit_window_bits(connection, compression)
+        assert (yield connection.read_message()) == 'opened'
+        for message in messages:
+            yield write_message(connection, message, threshold=64)
+        while len(received) < len(messages):
+            yield gen.sleep(0.01)
+        connection.close()
+
+    IOLoop.current().run_sync(send, timeout=5)
+    server.stop()
+    assert received == messages
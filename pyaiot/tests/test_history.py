@@ -0,0 +1,130 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""pyaiot broker history test module."""
+
+import json
+
+from pytest import fixture, raises
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+
+from pyaiot.broker.broker import Broker
+from pyaiot.broker.history import Series
+from pyaiot.common.auth import Keys
+from pyaiot.common.messaging import NewMessage, OutMessage, UpdateMessage
+from pyaiot.tests.test_broker import add_gateway, broker_options
+
+
+def test_series_ring():
+    series = Series(depth=3)
+    for time in range(5):
+        series.append(time, '{}.5°C'.format(time))
+    assert series.numeric
+    assert series.unit == '°C'
+    assert len(series) == 3
+    assert series.items() == [[2, 2.5], [3, 3.5], [4, 4.5]]
+    assert series.items(since=2.5) == [[3, 3.5], [4, 4.5]]
+    assert series.items(until=3) == [[2, 2.5], [3, 3.5]]
+    assert series.items(limit=1) == [[4, 4.5]]
+
+
+def test_series_not_numeric():
+    series = Series(depth=3)
+    series.append(0, '20°C')
+    series.append(1, '21hPa')
+    series.append(2, 'on')
+    assert not series.numeric
+    assert series.unit is None
+    assert series.items() == [[0, '20°C'], [1, '21hPa'], [2, 'on']]
+    series.append(3, {'x': 1})
+    assert series.items(limit=2) == [[2, 'on'], [3, {'x': 1}]]
+
+
+def test_broker_history():
+    broker = Broker(Keys(private='private', secret='secret'),
+                    options=broker_options(history_depth=2))
+    gateway = add_gateway(broker)
+    broker.on_gateway_message(gateway, NewMessage('node1'))
+    for value in range(3):
+        broker.on_gateway_message(
+            gateway, UpdateMessage('node1', 'led', str(value)))
+    # The cached values sent to a new client are not recorded
+    broker.on_gateway_message(
+        gateway, UpdateMessage('node1', 'led', '5', dst='client'))
+    assert [value for _, value in
+            broker.history.series('node1', 'led').items()] == [1, 2]
+
+    broker.on_gateway_message(gateway, OutMessage('node1'))
+    assert broker.history.endpoints('node1') == {}
+
+
+@fixture
+def history_server():
+    broker = Broker(Keys(private='private', secret='secret'),
+                    options=broker_options())
+    for time, value in enumerate(['20°C', '21°C', '22°C']):
+        broker.history.update(
+            UpdateMessage('node1', 'temperature', value), time)
+    broker.history.update(UpdateMessage('node1', 'led', 'on'), 1)
+    sock, port = bind_unused_port()
+    server = HTTPServer(broker)
+    server.add_sockets([sock])
+    yield "http://127.0.0.1:{}/history".format(port)
+    server.stop()
+
+
+def fetch(url):
+    return IOLoop.current().run_sync(
+        lambda: AsyncHTTPClient().fetch(url), timeout=5)
+
+
+def test_history_handler(history_server):
+    response = fetch(history_server + "?uid=node1&endpoint=temperature"
+                     "&since=1&limit=1")
+    assert response.headers['Access-Control-Allow-Origin'] == '*'
+    assert json.loads(response.body) == {
+        'uid': 'node1',
+        'endpoints': {'temperature': {'unit': '°C', 'values': [[2, 22]]}}}
+
+    response = fetch(history_server + "?uid=node1")
+    endpoints = json.loads(response.body)['endpoints']
+    assert endpoints['led'] == {'unit': None, 'values': [[1, 'on']]}
+    assert len(endpoints['temperature']['values']) == 3
+
+
+def test_history_handler_errors(history_server):
+    for query, code in (("", 400), ("?uid=node1&since=yesterday", 400),
+                        ("?uid=node2", 404),
+                        ("?uid=node1&endpoint=pressure", 404)):
+        with raises(HTTPClientError) as error:
+            fetch(history_server + query)
+        assert error.value.code == code
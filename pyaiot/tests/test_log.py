@@ -0,0 +1,63 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""pyaiot logging setup test module."""
+
+import json
+import logging
+
+from pytest import mark
+
+from pyaiot.common.log import JsonFormatter, SampleFilter
+
+
+def log_record(name, message="message %s", args=("arg",), **extra):
+    record = logging.LogRecord(name, logging.DEBUG, __file__, 0, message,
+                               args, None)
+    record.__dict__.update(extra)
+    return record
+
+
+@mark.parametrize('rate,passed', [(1, 10), (3, 4), (10, 1)])
+def test_sample_filter(rate, passed):
+    sample = SampleFilter(rate)
+    records = [log_record("pyaiot.broker.messages") for _ in range(10)]
+    assert sum(sample.filter(record) for record in records) == passed
+
+    # Only per-message records are sampled
+    assert all(sample.filter(log_record("pyaiot.broker")) for _ in range(10))
+
+
+def test_json_formatter():
+    output = JsonFormatter().format(log_record("pyaiot.broker", uid="node1"))
+    fields = json.loads(output)
+    assert fields['logger'] == "pyaiot.broker"
+    assert fields['level'] == "DEBUG"
+    assert fields['message'] == "message arg"
+    assert fields['uid'] == "node1"
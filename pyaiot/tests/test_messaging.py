@@ -1,9 +1,24 @@
 """pyaiot messaging test module."""
 
 import json
-from pytest import mark
+from pytest import fixture, mark, raises, skip
+from tornado import gen
+from tornado.ioloop import IOLoop
 
-from pyaiot.common.messaging import Message
+from pyaiot.common.batch import MessageBatcher
+from pyaiot.common.messaging import (JSON_CODECS, Message, NodeMessage,
+                                     NewMessage, UpdateMessage,
+                                     SnapshotMessage, codec)
+
+
+@fixture(params=JSON_CODECS)
+def json_codec(request):
+    try:
+        codec.use(request.param)
+    except ValueError:
+        skip("{} is not installed".format(request.param))
+    yield codec
+    codec.use('auto')
 
 
 @mark.parametrize('message', [1234, "test", "àéèïôû"])
@@ -73,9 +88,207 @@ def test_check_message_bad_type():
     assert "Invalid message type" in reason
 
 
-@mark.parametrize('msg_type', ["new", "out", "update", "reset"])
+@mark.parametrize('msg_type', ["new", "out", "update", "reset",
+                               "subscribe", "unsubscribe", "resume"])
 def test_check_message_valid(msg_type):
     to_test = json.dumps({"type": msg_type, "data": "test"})
     message, reason = Message.check_message(to_test)
     assert message is not None
     assert reason is None
+
+
+def test_subscribe():
+    filters = [{'uid': '1234', 'endpoint': 'temperature'}]
+    serialized = Message.subscribe(filters)
+    assert serialized == Message.serialize(
+        {'type': 'subscribe', 'data': filters})
+
+    serialized = Message.unsubscribe(filters)
+    assert serialized == Message.serialize(
+        {'type': 'unsubscribe', 'data': filters})
+
+
+def test_session():
+    serialized = Message.session('abcd', 12)
+    assert serialized == Message.serialize(
+        {'type': 'session', 'session': 'abcd', 'seq': 12, 'resumed': False})
+
+    serialized = Message.resume('abcd', 12)
+    assert serialized == Message.serialize(
+        {'type': 'resume', 'session': 'abcd', 'seq': 12})
+
+
+def test_snapshot():
+    nodes = {'1234': {'led': '0', 'name': 'àéèïôû'}, '5678': {}}
+    serialized = Message.snapshot(nodes, dst='client')
+    assert serialized == Message.serialize(
+        {'type': 'snapshot', 'nodes': nodes, 'dst': 'client'})
+    assert list(Message.snapshot_chunks(nodes, dst='client')) == [serialized]
+
+
+def test_snapshot_chunks():
+    nodes = {str(uid): {'value': 'x' * 100} for uid in range(50)}
+    chunks = list(Message.snapshot_chunks(nodes, max_size=1024))
+    assert len(chunks) > 1
+    merged = {}
+    for chunk in chunks:
+        assert len(chunk.encode('utf-8')) <= 1024
+        merged.update(json.loads(chunk)['nodes'])
+    assert merged == nodes
+
+    big = {'big': {'value': 'x' * 2048}}
+    assert list(Message.snapshot_chunks(big, max_size=1024)) == [
+        Message.snapshot(big)]
+    assert list(Message.snapshot_chunks({})) == []
+
+
+def test_batch():
+    messages = [Message.new_node('1234'), Message.out_node('5678')]
+    serialized = Message.batch(messages)
+    assert serialized == Message.serialize(
+        {'type': 'batch', 'messages': [json.loads(message)
+                                       for message in messages]})
+
+    message, reason = Message.check_message(serialized)
+    assert reason is None
+    assert message['messages'][1] == {'type': 'out', 'uid': '5678'}
+
+
+def test_check_message_without_type():
+    message, reason = Message.check_message('{"data": "test"}')
+    assert message is None
+    assert reason == "Invalid message '{'data': 'test'}'."
+
+
+def test_check_message_reason_excerpt():
+    message, reason = Message.check_message('{"type": "%s"}' % ('x' * 1000))
+    assert message is None
+    assert len(reason) < 100
+    message, reason = Message.check_message('garbage' * 1000)
+    assert len(reason) < 150
+
+
+def test_split():
+    messages = [Message.new_node('1234'),
+                '{"type":"update","uid":"1234","endpoint":"led",'
+                '"data":{"on": [1, 2.50]}}']
+    items, reason = Message.split(Message.batch(messages))
+    assert reason is None
+    assert [text for _, text in items] == messages
+    assert items[1][0]['data'] == {'on': [1, 2.5]}
+
+    raw = Message.out_node('1234')
+    assert Message.split(raw) == ([({'type': 'out', 'uid': '1234'}, raw)],
+                                  None)
+
+    # Other batches are decoded without the text of their messages
+    raw = json.dumps({'messages': [json.loads(messages[0])],
+                      'type': 'batch'})
+    assert Message.split(raw) == ([(json.loads(messages[0]), None)], None)
+
+
+@mark.parametrize('raw', ['{"type": "batch", "messages": [1]}',
+                          '{"type": "batch", "messages": [{}]}',
+                          '{"type": "batch", "messages": [{"type": "out"},]}',
+                          '{"type": "batch", "messages": [{"type": "out"}'])
+def test_split_invalid_batch(raw):
+    items, reason = Message.split(raw)
+    assert items is None
+    assert "Invalid " in reason
+
+
+def test_node_messages():
+    message = UpdateMessage('1234', 'led', 'àé')
+    assert not hasattr(message, '__dict__')
+    assert message.text == Message.update_node('1234', 'led', 'àé')
+    assert message.text is message.text
+    assert json.loads(message.text) == message.to_dict()
+    assert NewMessage('1234', dst='5678').text == Message.new_node(
+        '1234', '5678')
+
+    # The received text is kept
+    text = '{"type":"new","uid":"1234","dst":"all"}'
+    message = NodeMessage.from_text(text)
+    assert message == NewMessage('1234')
+    assert message.text is text
+    assert repr(message) == "NewMessage(uid='1234', dst='all')"
+
+
+def test_traced_update_message():
+    assert 'ts' not in UpdateMessage('1234', 'led', '1').to_dict()
+    message = UpdateMessage('1234', 'led', '1', ts=1500000000.25)
+    assert json.loads(message.text)['ts'] == 1500000000.25
+    decoded = NodeMessage.from_text(message.text)
+    assert decoded == message
+    assert decoded.ts == 1500000000.25
+
+
+@mark.parametrize('message', [{'type': 'subscribe', 'data': []},
+                              {'type': 'update', 'uid': '1234'},
+                              {'type': 'new', 'uid': 1234, 'dst': 'all'},
+                              {'type': 'snapshot', 'nodes': [], 'dst': 'all'}])
+def test_invalid_node_message(message):
+    assert NodeMessage.from_dict(message) is None
+
+
+def test_split_node_messages():
+    raw = Message.batch([Message.snapshot({'1234': {}}),
+                         Message.subscribe([]),
+                         Message.out_node('1234')])
+    messages, reason = Message.node_messages(raw)
+    assert reason is None
+    assert [message.type for message in messages] == ['snapshot', 'out']
+    assert messages[0] == SnapshotMessage({'1234': {}})
+    assert messages[0].text == Message.snapshot({'1234': {}})
+
+
+def test_json_codec(json_codec):
+    nodes = {'1234': {'led': '0', 'name': 'àéèïôû'}, '5678': {}}
+    assert list(Message.snapshot_chunks(nodes, dst='client')) == [
+        json_codec.dumps({'type': 'snapshot', 'nodes': nodes,
+                          'dst': 'client'})]
+    messages = [Message.new_node('1234'), Message.out_node('5678')]
+    assert Message.batch(messages) == json_codec.dumps(
+        {'type': 'batch', 'messages': [json_codec.loads(message)
+                                       for message in messages]})
+    message, reason = Message.check_message(Message.update_node(
+        '1234', 'path', 'a/b'))
+    assert message['data'] == 'a/b'
+
+
+def test_json_codec_errors():
+    with raises(ValueError):
+        codec.use('simplejson')
+    assert codec.dumps({'a': [1, 2.5]}) == json.dumps({'a': [1, 2.5]})
+
+
+@mark.parametrize('badbatch', [{'type': 'batch'},
+                               {'type': 'batch', 'messages': 'test'},
+                               {'type': 'batch', 'messages': ['test']},
+                               {'type': 'batch', 'messages': [{}]},
+                               {'type': 'batch', 'messages': [
+                                   {'type': 'batch', 'messages': []}]}])
+def test_check_message_bad_batch(badbatch):
+    message, reason = Message.check_message(json.dumps(badbatch))
+    assert message is None
+    assert "Invalid " in reason
+
+
+def test_message_batcher():
+    written = []
+    batcher = MessageBatcher(written.append, delay=0.001, max_size=50)
+
+    @gen.coroutine
+    def send():
+        batcher.put(Message.out_node('1'))
+        yield gen.sleep(0.01)
+        batcher.put(Message.out_node('2'))
+        batcher.put(Message.out_node('3'))
+        batcher.put(Message.out_node('4'))
+        yield gen.sleep(0.01)
+
+    IOLoop.current().run_sync(send)
+    assert written == [
+        Message.out_node('1'),
+        Message.batch([Message.out_node('2'), Message.out_node('3')]),
+        Message.out_node('4')]
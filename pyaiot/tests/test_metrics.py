@@ -0,0 +1,192 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""pyaiot metrics test module."""
+
+import json
+import time
+
+from tornado.httpclient import AsyncHTTPClient
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+
+from pyaiot.broker.broker import Broker
+from pyaiot.common.auth import Keys
+from pyaiot.common.messaging import NewMessage, UpdateMessage
+from pyaiot.common.metrics import Registry
+from pyaiot.tests.test_broker import (FakeClient, add_clients, add_gateway,
+                                      broker_options, received)
+
+
+def test_counter_labels():
+    registry = Registry(labels={'worker': 1})
+    counter = registry.counter("test_total", "Test.", ("name",))
+    counter.inc(labels=('a "quoted"\nname',))
+    counter.inc(2, labels=('b',))
+    counter.inc(0.5, labels=('b',))
+    assert counter.value(('b',)) == 2.5
+    assert registry.render().splitlines()[2:] == [
+        'test_total{worker="1",name="a \\"quoted\\"\\nname"} 1',
+        'test_total{worker="1",name="b"} 2.5']
+
+
+def test_histogram():
+    registry = Registry()
+    histogram = registry.histogram("size", "Size.", buckets=(10, 1, 5))
+    for value in (0, 1, 3, 5, 7, 100):
+        histogram.observe(value)
+    assert histogram.count() == 6
+    assert registry.render().splitlines()[2:] == [
+        'size_bucket{le="1"} 2',
+        'size_bucket{le="5"} 4',
+        'size_bucket{le="10"} 5',
+        'size_bucket{le="+Inf"} 6',
+        'size_sum 116',
+        'size_count 6']
+
+
+def test_collected_gauge():
+    values = {}
+    registry = Registry()
+    registry.gauge("depth", "Depth.", ("queue",), collect=lambda: values)
+    assert registry.render().splitlines()[2:] == []
+    values[('q1',)] = 3
+    assert registry.render().splitlines()[2:] == ['depth{queue="q1"} 3']
+
+
+def test_broker_metrics():
+    broker = Broker(Keys(private='private', secret='secret'),
+                    options=broker_options())
+    gateway = add_gateway(broker)
+    clients = add_clients(broker, 3, bytes_counter=broker.metrics.written)
+    broker.on_gateway_message(gateway, NewMessage('node1'))
+    broker.on_gateway_message(gateway, UpdateMessage('node1', 'led', '1'))
+    broker.authenticator.verify(FakeClient('gateway'), 'invalid')
+
+    metrics = broker.metrics
+    assert metrics.received.value(('client', 'new')) == 3
+    assert metrics.received.value(('gateway', 'update')) == 1
+    assert metrics.sent.value(('update',)) == 3
+    assert metrics.fanout.count() == 2
+    assert metrics.handler_seconds.count(('on_gateway_message',)) == 2
+    assert metrics.written.value() == sum(
+        client.queue.written for client in clients) > 0
+
+    lines = metrics.render().splitlines()
+    assert 'pyaiot_broker_connections{type="client"} 3' in lines
+    assert 'pyaiot_broker_connections{type="gateway"} 1' in lines
+    assert 'pyaiot_broker_nodes 1' in lines
+    assert 'pyaiot_broker_auth_failures_total{reason="invalid"} 1' in lines
+    assert 'pyaiot_broker_client_queue_depth 0' in lines
+    assert 'pyaiot_broker_client_queue_depth_max 0' in lines
+
+
+def test_broker_queue_metrics():
+    broker = Broker(Keys(private='private', secret='secret'),
+                    options=broker_options())
+    gateway = add_gateway(broker)
+    slow, fast = add_clients(broker, 2, maxsize=2,
+                             dropped_counter=broker.metrics.dropped)
+    broker.on_gateway_message(gateway, NewMessage('node1'))
+    slow.block()
+    for value in range(5):
+        broker.on_gateway_message(gateway,
+                                  UpdateMessage('node1', 'led', value))
+
+    lines = broker.metrics.render().splitlines()
+    assert 'pyaiot_broker_client_queue_depth 2' in lines
+    assert 'pyaiot_broker_client_queue_depth_max 2' in lines
+    assert 'pyaiot_broker_client_queue_dropped_total 2' in lines
+
+    # Dropped messages are still counted once the client is gone
+    broker.remove_ws(slow.uid)
+    assert 'pyaiot_broker_client_queue_dropped_total 2' in \
+        broker.metrics.render().splitlines()
+
+
+def test_latency_tracing(tmp_path):
+    trace_file = tmp_path / "trace.log"
+    broker = Broker(Keys(private='private', secret='secret'),
+                    options=broker_options(
+                        latency_trace_file=str(trace_file),
+                        latency_trace_sample=2))
+    gateway = add_gateway(broker)
+    gateway.name = '10.0.0.1'
+    clients = add_clients(broker, 1)
+    broker.on_gateway_message(gateway, NewMessage('node1'))
+    ingress = time.time() - 0.01
+    for value in range(3):
+        broker.on_gateway_message(
+            gateway, UpdateMessage('node1', 'led', value, ts=ingress))
+    broker.on_gateway_message(gateway, UpdateMessage('node1', 'led', 3))
+
+    # The ingress time is forwarded to the clients
+    updates = received(clients[0])[-2:]
+    assert updates[0]['ts'] == ingress
+    assert 'ts' not in updates[1]
+
+    broker.on_client_message(clients[0], {
+        'type': 'latency', 'src': '0',
+        'data': [{'uid': 'node1', 'endpoint': 'led', 'ts': ingress,
+                  'received': ingress + 0.05}]})
+    broker.on_client_message(clients[0], {
+        'type': 'latency', 'src': '0', 'data': [{'uid': 'node1'}]})
+    # Non-finite values, decoded by json, are rejected
+    for value in ('NaN', 'Infinity', '-Infinity'):
+        broker.on_client_message(clients[0], json.loads(
+            '{"type": "latency", "src": "0", "data": [{"uid": "node1", '
+            '"ts": 0, "received": %s}]}' % value))
+    broker.close_client()
+
+    latency = broker.tracer.latency
+    assert latency.count(('uplink', '10.0.0.1')) == 3
+    assert latency.count(('broker', '10.0.0.1')) == 3
+    assert latency.count(('end_to_end', '10.0.0.1')) == 1
+    assert broker.metrics.received.value(('client', 'latency')) == 5
+
+    traces = [json.loads(line) for line in trace_file.read_text().splitlines()]
+    assert [trace['stage'] for trace in traces] == ['broker', 'broker']
+    assert traces[0]['ingress'] == ingress
+    assert traces[0]['received'] <= traces[0]['sent']
+
+
+def test_metrics_handler():
+    broker = Broker(Keys(private='private', secret='secret'),
+                    options=broker_options())
+    sock, port = bind_unused_port()
+    server = HTTPServer(broker)
+    server.add_sockets([sock])
+
+    response = IOLoop.current().run_sync(
+        lambda: AsyncHTTPClient().fetch(
+            "http://127.0.0.1:{}/metrics".format(port)), timeout=5)
+    server.stop()
+    assert response.headers['Content-Type'].startswith('text/plain')
+    assert b'# TYPE pyaiot_broker_handler_seconds histogram' in response.body
@@ -0,0 +1,81 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""pyaiot event loop monitor test module."""
+
+import time
+import asyncio
+import logging
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+
+from pyaiot.common.metrics import Registry
+from pyaiot.common.monitor import LoopMonitor
+
+
+def blocking():
+    time.sleep(0.05)
+
+
+async def blocking_coroutine():
+    await asyncio.sleep(0)
+    time.sleep(0.05)
+    await asyncio.sleep(0.01)
+
+
+def test_loop_monitor(caplog):
+    registry = Registry()
+    monitor = LoopMonitor(registry, threshold=20, interval=0.01)
+
+    @gen.coroutine
+    def run():
+        monitor.start()
+        IOLoop.current().add_callback(blocking)
+        yield gen.sleep(0.1)
+        yield blocking_coroutine()
+        monitor.stop()
+
+    with caplog.at_level(logging.WARNING, logger="pyaiot.monitor"):
+        IOLoop.current().run_sync(run, timeout=5)
+
+    assert monitor.lag.count() > 1
+    assert monitor.slow.count() == 2
+    messages = [record.getMessage() for record in caplog.records]
+    assert messages[0].startswith(
+        "Slow callback blocked the event loop for 0.05")
+    # Coroutines are described with the line they stopped at
+    assert "blocking_coroutine() running at" in messages[1]
+    assert "test_monitor.py" in messages[1]
+    assert "pyaiot_loop_lag_seconds_count" in registry.render()
+
+    # The callbacks are not timed anymore
+    IOLoop.current().run_sync(gen.coroutine(blocking))
+    assert monitor.slow.count() == 2
+    assert not IOLoop.current().asyncio_loop.get_debug()
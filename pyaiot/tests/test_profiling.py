@@ -0,0 +1,62 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""pyaiot profiling test module."""
+
+import pstats
+
+from pyaiot.common.profiling import Profiler
+
+
+def busy(count):
+    return [str(value) for value in range(count)]
+
+
+def test_cpu_profile(tmp_path):
+    profiler = Profiler("broker", str(tmp_path))
+    assert profiler.toggle_cpu() is None
+    busy(1000)
+    path = profiler.toggle_cpu()
+    assert path.startswith(str(tmp_path / "broker-"))
+    assert path.endswith(".prof")
+    stats = pstats.Stats(path)
+    assert any(function[2] == 'busy' for function in stats.stats)
+
+
+def test_memory_diff(tmp_path):
+    profiler = Profiler("broker", str(tmp_path))
+    assert profiler.toggle_memory() is None
+    kept = busy(10000)
+    path = profiler.toggle_memory()
+    assert path.endswith(".txt")
+    with open(path) as diff:
+        lines = diff.read().splitlines()
+    assert lines[0].startswith("Memory growth of broker")
+    assert "test_profiling.py" in lines[1]
+    assert len(kept) == 10000
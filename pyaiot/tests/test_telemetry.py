@@ -0,0 +1,150 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""pyaiot broker telemetry log test module."""
+
+import os
+import time
+
+from pyaiot.broker.broker import Broker
+from pyaiot.broker.telemetry import TelemetryLog, replay, scan, segments
+from pyaiot.common.auth import Keys
+from pyaiot.common.messaging import (NewMessage, OutMessage, ResetMessage,
+                                     UpdateMessage)
+from pyaiot.tests.test_broker import add_gateway, broker_options
+
+
+def write_log(directory, count, start=1000, **kwargs):
+    log = TelemetryLog(str(directory), **kwargs)
+    for value in range(count):
+        log.append(UpdateMessage('node1', 'led', str(value)), start + value)
+    log.close()
+    return log
+
+
+def test_telemetry_log(tmp_path):
+    log = TelemetryLog(str(tmp_path))
+    messages = [NewMessage('node1'), UpdateMessage('node1', 'led', 'é'),
+                ResetMessage('node1'), OutMessage('node1')]
+    for timestamp, message in enumerate(messages):
+        log.append(message, 1000 + timestamp)
+    # Records are buffered until the next sync
+    assert list(scan(str(tmp_path))) == []
+    log.sync()
+    assert list(scan(str(tmp_path))) == [
+        (1000 + timestamp, message.text)
+        for timestamp, message in enumerate(messages)]
+    log.close()
+    assert list(replay(str(tmp_path), since=1001, until=1002)) == [
+        (1001, messages[1]), (1002, messages[2])]
+
+
+def test_telemetry_log_segments(tmp_path):
+    write_log(tmp_path, 100, segment_size=1000)
+    paths = segments(str(tmp_path))
+    assert len(paths) > 5
+    assert all(os.path.getsize(path) <= 1000 for _, path in paths)
+    assert [timestamp for timestamp, _ in scan(str(tmp_path))] == list(
+        range(1000, 1100))
+    records = scan(str(tmp_path), since=1050, until=1052)
+    assert [timestamp for timestamp, _ in records] == [1050, 1051, 1052]
+
+
+def test_telemetry_log_sync_before_close(tmp_path, monkeypatch):
+    synced = []
+
+    def slow_fsync(fd, fsync=os.fsync):
+        time.sleep(0.01)
+        # Fails if the descriptor was closed in the meantime
+        synced.append(os.fstat(fd).st_size)
+        fsync(fd)
+
+    monkeypatch.setattr(os, 'fsync', slow_fsync)
+    log = TelemetryLog(str(tmp_path), segment_size=100)
+    for value in range(4):
+        log.append(UpdateMessage('node1', 'led', str(value)), 1000 + value)
+        log.sync()
+    log.close()
+    assert len(synced) == 8
+    assert [timestamp for timestamp, _ in scan(str(tmp_path))] == list(
+        range(1000, 1004))
+
+
+def test_telemetry_log_truncated(tmp_path):
+    write_log(tmp_path, 3)
+    _, path = segments(str(tmp_path))[0]
+    with open(path, 'ab') as segment:
+        segment.write(b'\0' * 20)
+    assert len(list(scan(str(tmp_path)))) == 3
+
+    # A corrupted record stops the reading
+    with open(path, 'r+b') as segment:
+        segment.seek(-30, os.SEEK_END)
+        segment.write(b'x')
+    assert len(list(scan(str(tmp_path)))) == 2
+
+
+def test_telemetry_log_retention(tmp_path):
+    write_log(tmp_path, 100, segment_size=1000, retention_size=3000)
+    assert sum(os.path.getsize(path)
+               for _, path in segments(str(tmp_path))) <= 3000
+    assert [timestamp for timestamp, _ in scan(str(tmp_path))][-1] == 1099
+
+    for _, path in segments(str(tmp_path))[:-1]:
+        os.utime(path, (0, 0))
+    TelemetryLog(str(tmp_path), retention_age=3600)
+    assert len(segments(str(tmp_path))) == 1
+
+
+def test_broker_telemetry_log(tmp_path):
+    options = broker_options(telemetry_log_dir=str(tmp_path))
+    broker = Broker(Keys(private='private', secret='secret'),
+                    options=options)
+    gateway = add_gateway(broker)
+    broker.on_gateway_message(gateway, NewMessage('node1'))
+    broker.on_gateway_message(gateway, UpdateMessage('node1', 'led', '1'))
+    broker.on_gateway_message(
+        gateway, UpdateMessage('node1', 'led', '1', dst='client'))
+    # Updates of the nodes of other gateways are rejected, not logged
+    broker.on_gateway_message(add_gateway(broker),
+                              UpdateMessage('node1', 'led', '2'))
+    broker.remove_ws(gateway)
+    # The buffered records are written when the broker stops
+    broker.close_client()
+    assert [message for _, message in replay(str(tmp_path))] == [
+        NewMessage('node1'), UpdateMessage('node1', 'led', '1'),
+        OutMessage('node1')]
+
+    # The history starts with the messages logged after the node went out
+    write_log(tmp_path, 2, start=time.time())
+    broker = Broker(Keys(private='private', secret='secret'),
+                    options=options)
+    broker.close_client()
+    assert [value for _, value in
+            broker.history.series('node1', 'led').items()] == [0, 1]
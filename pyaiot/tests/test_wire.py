@@ -0,0 +1,131 @@
+# Copyright 2017 IoT-Lab Team
+# Contributor(s) : see AUTHORS file
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""pyaiot wire formats test module."""
+
+import json
+
+from pytest import importorskip, raises
+from tornado import gen, websocket
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.testing import bind_unused_port
+
+from pyaiot.broker.broker import Broker
+from pyaiot.common.auth import (Keys, auth_token, generate_private_key,
+                                generate_secret_key)
+from pyaiot.common.messaging import Message
+from pyaiot.common.wire import (decode, negotiated_format, select_subprotocol,
+                                transcode)
+from pyaiot.tests.test_broker import broker_options
+
+msgpack = importorskip('msgpack')
+
+
+def test_select_subprotocol():
+    assert select_subprotocol(['pyaiot.msgpack']) == 'pyaiot.msgpack'
+    assert select_subprotocol(['pyaiot.json', 'pyaiot.cbor']) is None
+    assert select_subprotocol([]) is None
+    assert negotiated_format('pyaiot.msgpack') == 'msgpack'
+    assert negotiated_format('other') == 'json'
+
+
+def test_transcode():
+    message = Message.update_node('1234', 'temperature', 'é 21.5')
+    raw = transcode(message, 'msgpack')
+    assert isinstance(raw, bytes)
+    assert len(raw) < len(message.encode('utf-8'))
+    assert decode(raw, 'msgpack') == json.loads(message)
+    assert transcode(message, 'json') is message
+
+
+def test_decode():
+    message = Message.out_node('1234')
+    # Text messages are always JSON
+    assert decode(message, 'msgpack') == json.loads(message)
+    with raises(ValueError):
+        decode(b'\xc1', 'msgpack')
+    assert Message.check_message(b'\xc1', 'msgpack') == (
+        None, "Invalid message received 'b'\\xc1''. "
+              "Only MSGPACK format is supported.")
+
+
+def test_check_message_batch():
+    raw = transcode(Message.batch([Message.new_node('1234'),
+                                   Message.out_node('1234')]), 'msgpack')
+    message, reason = Message.check_message(raw, 'msgpack')
+    assert reason is None
+    assert [item['type'] for item in message['messages']] == ['new', 'out']
+
+
+def test_binary_gateway():
+    keys = Keys(private=generate_private_key(), secret=generate_secret_key())
+    broker = Broker(keys, options=broker_options())
+    sock, port = bind_unused_port()
+    server = HTTPServer(broker)
+    server.add_sockets([sock])
+    url = "ws://127.0.0.1:{}".format(port)
+
+    @gen.coroutine
+    def exchange():
+        gateway = yield websocket.websocket_connect(
+            url + "/gw", subprotocols=['pyaiot.msgpack'])
+        assert negotiated_format(gateway.selected_subprotocol) == 'msgpack'
+        gateway.write_message(auth_token(keys))
+        while not len(broker.gateways):
+            yield gen.sleep(0.01)
+        client = yield websocket.websocket_connect(url + "/ws")
+        client.write_message(json.dumps({'type': 'new', 'data': 'client'}))
+        # The gateway is notified of the new client
+        message = yield gateway.read_message()
+        assert json.loads(message)['type'] == "new"
+        for message in (Message.new_node('1234'),
+                        Message.update_node('1234', 'led', 'on')):
+            gateway.write_message(transcode(message, 'msgpack'),
+                                  binary=True)
+        received = []
+        for _ in range(2):
+            received.append(json.loads((yield client.read_message())))
+        # Commands are still sent as JSON text to the gateway
+        client.write_message(json.dumps(
+            {'type': 'update',
+             'data': {'uid': '1234', 'endpoint': 'led', 'payload': 'off'}}))
+        command = yield gateway.read_message()
+        client.close()
+        gateway.close()
+        return received, command
+
+    received, command = IOLoop.current().run_sync(exchange, timeout=5)
+    server.stop()
+    assert received == [
+        {'type': 'new', 'uid': '1234', 'dst': 'all'},
+        {'type': 'update', 'uid': '1234', 'endpoint': 'led', 'data': 'on',
+         'dst': 'all'}]
+    assert isinstance(command, str)
+    assert json.loads(command)['data']['payload'] == 'off'
@@ -79,6 +79,9 @@ if __name__ == '__main__':
             'hbmqtt>=0.8',
             'cryptography>=1.7.2'
           ],
+          extras_require={
+            'msgpack': ['msgpack>=0.5.2'],
+          },
           classifiers=[
             'Development Status :: 4 - Beta',
             'Programming Language :: Python :: 3 :: Only',